@@ -0,0 +1,4 @@
+'''
+    Benchmarks for openvpn_client_connect.
+    Run these from the top of the repo, as modules:  python -m benchmarks.<name>
+'''
@@ -0,0 +1,130 @@
+"""
+    Startup of the precompiled bundles against an installed package.
+
+    The same connects as bench_startup, run three ways:
+
+    installed: our package and netaddr in a site directory as an RPM
+        lays them out, with no bytecode, so every start compiles them
+    installed-pyc: the same, with bytecode compiled ahead (what a
+        byte-compiled RPM has)
+    bundle: the build_bundle.py zipapps, run with -sE as their #! line does
+
+    Numbers are median milliseconds above a bare interpreter.
+"""
+import os
+import sys
+import json
+import shutil
+import statistics
+import compileall
+import tempfile
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+# pylint: disable=wrong-import-position
+import build_bundle  # noqa: E402
+from benchmarks.bench_startup import (  # noqa: E402
+    write_stand_in_iam, make_env, time_command, REJECT_CONF, CONNECT_CONF)
+
+LAYOUTS = ('installed', 'installed-pyc', 'bundle')
+# scenario: (bundle name, entry module, arguments, extra environment)
+SCENARIOS = {
+    'reject-openvpn_script': (
+        'openvpn-client-connect', 'openvpn_client_connect.openvpn_script',
+        ['--conf', REJECT_CONF, 'OUTPUT'],
+        {'common_name': 'bob', 'username': 'bob', 'trusted_ip': '8.7.6.5', 'IV_VER': '2.2.0'}),
+    'connect-openvpn_script': (
+        'openvpn-client-connect', 'openvpn_client_connect.openvpn_script',
+        ['--conf', CONNECT_CONF, 'OUTPUT'],
+        {'common_name': 'bob', 'username': 'bob', 'trusted_ip': '8.7.6.5', 'IV_VER': '2.6.8'}),
+    'connect-vpn_user_routes': (
+        'vpn-user-routes', 'openvpn_client_connect.vpn_user_routes',
+        ['--conf', CONNECT_CONF, '--trusted-ip', '8.7.6.5', 'bob'], {}),
+}
+
+
+def install_layout(site_dir, compiled):
+    """
+        Our package and netaddr copied into site_dir, like an install.
+    """
+    for name in ('openvpn_client_connect', 'netaddr'):
+        source = build_bundle.find_package(name)
+        shutil.copytree(source, os.path.join(site_dir, name),
+                        ignore=shutil.ignore_patterns('__pycache__', '*.pyc', 'tests'))
+    if compiled:
+        compileall.compile_dir(site_dir, quiet=1)
+
+
+def commands(layout, tmpdir, iam_dir):
+    """
+        {scenario: (argv, env)} for one layout.
+    """
+    output_file = os.path.join(tmpdir, 'push.conf')
+    result = {}
+    for scenario, (bundle, module, arguments, extra) in SCENARIOS.items():
+        arguments = [output_file if arg == 'OUTPUT' else arg for arg in arguments]
+        if layout == 'bundle':
+            argv = [sys.executable, '-sE', os.path.join(tmpdir, 'dist', f'{bundle}.pyz')]
+            env = make_env(iam_dir, **extra)
+        else:
+            # What the console_scripts wrapper does.
+            argv = [sys.executable, '-s'] + (['-B'] if layout == 'installed' else []) + [
+                '-c', f'import sys; from {module} import main; sys.argv[0] = "x"; main()']
+            site_dir = os.path.join(tmpdir, layout)
+            env = make_env(iam_dir, **extra)
+            env['PYTHONPATH'] = os.pathsep.join([iam_dir, site_dir])
+        result[scenario] = (argv + arguments, env)
+    return result
+
+
+def measure(runs):
+    """
+        {layout: {scenario: median ms above the bare interpreter}}, and
+        that interpreter's median.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        iam_dir = os.path.join(tmpdir, 'iam')
+        write_stand_in_iam(iam_dir)
+        for layout in LAYOUTS:
+            if layout != 'bundle':
+                os.makedirs(os.path.join(tmpdir, layout))
+                install_layout(os.path.join(tmpdir, layout), layout == 'installed-pyc')
+        os.makedirs(os.path.join(tmpdir, 'dist'))
+        for bundle in {scenario[0] for scenario in SCENARIOS.values()}:
+            build_bundle.build_bundle(os.path.join(tmpdir, 'dist', f'{bundle}.pyz'),
+                                      build_bundle.BUNDLES[bundle],
+                                      search_path=[iam_dir] + sys.path)
+        floor = statistics.median(time_command([sys.executable, '-sE', '-c', 'pass'],
+                                               make_env(iam_dir), runs))
+        for layout in LAYOUTS:
+            results[layout] = {}
+            for scenario, (argv, env) in commands(layout, tmpdir, iam_dir).items():
+                results[layout][scenario] = statistics.median(
+                    time_command(argv, env, runs)) - floor
+    return results, floor
+
+
+def main():
+    """ Measure and print """
+    parser = ArgumentParser(description='Startup of bundles against installed packages')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Runs per scenario (we take the median)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results, floor = measure(args.runs)
+    if args.json:
+        print(json.dumps({'interpreter_ms': floor, 'results': results}, indent=2))
+        return
+    print(f'bare interpreter: {floor:.1f} ms (not included below)')
+    print(f'{"scenario":>24}' + ''.join(f'{layout:>15}' for layout in LAYOUTS))
+    for scenario in SCENARIOS:
+        print(f'{scenario:>24}' + ''.join(f'{results[layout][scenario]:>12.1f} ms'
+                                          for layout in LAYOUTS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+    Memory footprint of a connect, per phase, with tracemalloc.
+
+    Hosts run many openvpn instances, and in a reconnect storm each runs
+    many client-connect processes at once, so peak memory per connect
+    is what runs out.  For users with small, medium and huge ACL lists,
+    this reports:
+
+    main_work: openvpn_script's whole connect, against the fake IAM
+    and build_user_routes' work, step by step, the way it does it:
+        config: parsing the config (ClientConnect and GetUserRoutes)
+        ipnetwork: turning the ACL strings into IPNetwork objects
+        subtraction: route_subtraction of the free and office routes
+        merge: cidr_merge and sort of the non-office routes
+        exclusion: the office routes for where the user is (route_exclusion)
+        render: push lines for the routes, and the whole push block
+
+    For each, peak_kib is the most memory the phase had allocated above
+    what was allocated when it started, and blocks is how many more memory
+    blocks were allocated at its end than at its start (what it kept).
+    The steps are checked against build_routes_from_acls, so if that code
+    changes and this doesn't follow, we fail rather than measure the wrong
+    thing.  With --check, we exit non-zero if any peak is over the stored
+    baseline by more than the tolerance.
+"""
+import os
+import sys
+import json
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks', 'fake_iam'))
+# pylint: disable=wrong-import-position
+from netaddr import IPNetwork, cidr_merge  # noqa: E402
+from openvpn_client_connect.client_connect import ClientConnect  # noqa: E402
+from openvpn_client_connect.per_user_configs import GetUserRoutes  # noqa: E402
+from openvpn_client_connect import openvpn_script  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baselines', 'memory.json')
+CONNECT_CONF = os.path.join(REPO_DIR, 'test_configs', 'udp_dynamic.conf')
+SIZES = {'small': 5, 'medium': 100, 'huge': 5000}
+PHASES = ('config', 'ipnetwork', 'subtraction', 'merge', 'exclusion', 'render')
+USER = 'bob'
+# Connecting from the nyc1 office, so the office routes have a piece cut out.
+CLIENT_IP = '8.7.6.5'
+
+
+class PhaseMeter:
+    """
+        Measures memory for one phase at a time, with tracemalloc running.
+    """
+    def __init__(self):
+        self.results = {}
+        self._start = None
+        self._base = 0
+        self._name = None
+
+    @staticmethod
+    def _snapshot():
+        """ Our allocations, leaving out tracemalloc's own """
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def start(self, name):
+        """ Begin measuring a phase """
+        self._name = name
+        self._start = self._snapshot()
+        tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        """ Finish measuring the phase we're in """
+        peak = tracemalloc.get_traced_memory()[1]
+        blocks = sum(stat.count_diff for stat in
+                     self._snapshot().compare_to(self._start, 'filename'))
+        self.results[self._name] = {'peak_kib': (peak - self._base) / 1024,
+                                    'blocks': blocks}
+        self._start = None
+
+
+def set_acls_per_user(count):
+    """ Tell the fake IAM how many ACLs users have, and to answer at once """
+    os.environ['FAKE_IAM_CONFIG'] = json.dumps({
+        'latency_ms': 0, 'jitter_ms': 0, 'connect_ms': 0, 'deny_fraction': 0,
+        'acls_per_user': count})
+
+
+def measure_phases():
+    """
+        build_user_routes' steps, and the render after them, one phase at a
+        time.  Returns {phase: {'peak_kib', 'blocks'}}.
+    """
+    meter = PhaseMeter()
+    tracemalloc.start()
+    try:
+        meter.start('config')
+        config_object = ClientConnect(CONNECT_CONF)
+        user_routes = GetUserRoutes(CONNECT_CONF)
+        meter.stop()
+        # Asking IAM isn't ours to measure.
+        tracemalloc.stop()
+        acl_strings = user_routes.iam_searcher.get_allowed_vpn_ips(USER)
+        office = config_object.get_client_office(CLIENT_IP)
+        tracemalloc.start()
+
+        meter.start('ipnetwork')
+        user_acls = [IPNetwork(aclstring) for aclstring in acl_strings]
+        meter.stop()
+
+        meter.start('subtraction')
+        user_acls = user_routes.route_subtraction(user_acls,
+                                                  user_routes.config['FREE_ROUTES'])
+        user_acls = user_routes.route_subtraction(
+            user_acls, user_routes.config['COMPREHENSIVE_OFFICE_ROUTES'])
+        meter.stop()
+
+        meter.start('merge')
+        nonoffice = sorted(cidr_merge(user_routes.config['FREE_ROUTES'] + user_acls))
+        meter.stop()
+
+        meter.start('exclusion')
+        routes = sorted(nonoffice + user_routes.get_office_routes(office, CLIENT_IP))
+        meter.stop()
+
+        meter.start('render')
+        config_object.render_push_block(config_object.format_route_lines(routes))
+        meter.stop()
+    finally:
+        tracemalloc.stop()
+
+    expected = GetUserRoutes(CONNECT_CONF).build_routes_from_acls(acl_strings, office,
+                                                                  CLIENT_IP)
+    if [str(route) for route in routes] != [str(route) for route in expected]:
+        print('the phases here no longer match build_routes_from_acls!', file=sys.stderr)
+        sys.exit(1)
+    return meter.results
+
+
+def measure_main_work(output_file):
+    """
+        A whole connect through openvpn_script.main_work.
+        Returns {'peak_kib', 'blocks'}.
+    """
+    argv = ['openvpn-client-connect', '--conf', CONNECT_CONF, output_file]
+    # Once untraced, so that imports done on first use aren't counted.
+    if not openvpn_script.main_work(argv):
+        print('main_work failed', file=sys.stderr)
+        sys.exit(1)
+    meter = PhaseMeter()
+    tracemalloc.start()
+    try:
+        meter.start('main_work')
+        openvpn_script.main_work(argv)
+        meter.stop()
+    finally:
+        tracemalloc.stop()
+    return meter.results['main_work']
+
+
+def measure():
+    """
+        {size: {phase: {'peak_kib', 'blocks'}}} for every ACL size.
+    """
+    os.environ.update({'common_name': USER, 'username': USER, 'trusted_ip': CLIENT_IP,
+                       'IV_VER': '2.6.8'})
+    os.environ.pop('ifconfig_local', None)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size, count in SIZES.items():
+            set_acls_per_user(count)
+            results[size] = measure_phases()
+            results[size]['main_work'] = measure_main_work(os.path.join(tmpdir, 'push.conf'))
+    return results
+
+
+def flatten(results):
+    """ {'size-phase': peak_kib}, the form baselines are kept in """
+    return {f'{size}-{phase}': values['peak_kib']
+            for size, phases in results.items() for phase, values in phases.items()}
+
+
+def check(results, baseline, tolerance, slack_kib):
+    """
+        Return a list of (metric, measured, allowed) that went over.
+    """
+    regressions = []
+    for metric, base in sorted(baseline.items()):
+        if metric not in results:
+            continue
+        allowed = base * (1 + tolerance) + slack_kib
+        if results[metric] > allowed:
+            regressions.append((metric, results[metric], allowed))
+    return regressions
+
+
+def main():
+    """ Measure, print, and optionally check or update the baseline """
+    parser = ArgumentParser(description='Per-phase memory benchmark')
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE,
+                        help='Baseline file')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit 1 if any peak is over the baseline')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Write these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed fractional growth over baseline')
+    parser.add_argument('--slack-kib', type=float, default=16.0,
+                        help='Allowed absolute growth, for small numbers')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = measure()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f'{"phase":>12}' + ''.join(f'{f"{size} ({SIZES[size]} ACLs)":>26}'
+                                         for size in SIZES))
+        print(f'{"":>12}' + f'{"peak KiB":>16}{"blocks":>10}' * len(SIZES))
+        for phase in PHASES + ('main_work',):
+            print(f'{phase:>12}' + ''.join(
+                f'{results[size][phase]["peak_kib"]:>16.1f}{results[size][phase]["blocks"]:>10}'
+                for size in SIZES))
+
+    flat = flatten(results)
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as filehandle:
+            json.dump({metric: round(value, 1) for metric, value in flat.items()},
+                      filehandle, indent=2, sort_keys=True)
+            filehandle.write('\n')
+        print(f'baseline written to {args.baseline}')
+    if args.check:
+        with open(args.baseline, 'r', encoding='utf-8') as filehandle:
+            baseline = json.load(filehandle)
+        regressions = check(flat, baseline, args.tolerance, args.slack_kib)
+        for metric, measured, allowed in regressions:
+            print(f'REGRESSION {metric}: {measured:.1f} KiB, allowed {allowed:.1f} KiB')
+        if regressions:
+            sys.exit(1)
+        print('memory within baseline')
+
+
+if __name__ == '__main__':
+    main()
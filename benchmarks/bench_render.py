@@ -0,0 +1,82 @@
+"""
+    Compare the two ways of rendering a push file:
+
+    per-connect: format every section from the config's lists each time,
+        join, and write (what we did before static sections were prerendered).
+    prerendered: format only the per-user lines, and glue them between the
+        config-only blocks that ClientConnect rendered at load.
+
+    The interesting case is a config with hundreds of static routes.
+"""
+import os
+import sys
+import timeit
+import tempfile
+from argparse import ArgumentParser
+from openvpn_client_connect.client_connect import ClientConnect
+sys.dont_write_bytecode = True
+
+
+def write_config(directory, num_routes):
+    """
+        Write out a config with num_routes static routes of each family.
+    """
+    routes_4 = [f'10.{num // 256}.{num % 256}.0 255.255.255.0' for num in range(num_routes)]
+    routes_6 = [f'2001:db8:{num:x}::/48' for num in range(num_routes)]
+    conffile = os.path.join(directory, 'bench.conf')
+    with open(conffile, 'w', encoding='utf-8') as filehandle:
+        filehandle.write('[client-connect]\nprotocol = udp\n'
+                         "GLOBAL_DNS_SERVERS = ['10.20.75.120', '10.30.75.120']\n"
+                         '[static-mapping]\n'
+                         f'ROUTES_4 = {routes_4!r}\n'
+                         f'ROUTES_6 = {routes_6!r}\n')
+    return conffile
+
+
+def render_per_connect(config_object, user_lines):
+    """
+        The old path: format everything, every time.
+    """
+    output_array = []
+    output_array += config_object._render_dns_server_lines()  # pylint: disable=protected-access
+    output_array += user_lines
+    output_array += config_object._render_static_route_lines()  # pylint: disable=protected-access
+    output_array += config_object._render_protocol_lines()  # pylint: disable=protected-access
+    return '\n'.join(output_array) + '\n'
+
+
+def render_prerendered(config_object, user_lines):
+    """
+        The new path: only the per-user lines are formatted.
+    """
+    return config_object.render_push_block(user_lines)
+
+
+def main():
+    """ Run the comparison and print a small table """
+    parser = ArgumentParser(description='Compare push-file render paths')
+    parser.add_argument('--routes', type=int, nargs='+', default=[10, 100, 500, 1000],
+                        help='Numbers of static routes (per family) to try')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='Renders per timing run')
+    args = parser.parse_args()
+
+    user_lines = ['push "dhcp-option DOMAIN example.com"'] + [
+        f'push "route 10.{num}.0.0 255.255.0.0"' for num in range(40)]
+    print(f'{"routes":>8} {"per-connect us":>15} {"prerendered us":>15} {"speedup":>8}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_routes in args.routes:
+            config_object = ClientConnect(write_config(tmpdir, num_routes))
+            if (render_per_connect(config_object, user_lines) !=
+                    render_prerendered(config_object, user_lines)):
+                print('render paths disagree!')
+                sys.exit(1)
+            old = min(timeit.repeat(lambda: render_per_connect(config_object, user_lines),
+                                    number=args.number, repeat=5)) / args.number
+            new = min(timeit.repeat(lambda: render_prerendered(config_object, user_lines),
+                                    number=args.number, repeat=5)) / args.number
+            print(f'{num_routes:>8} {old * 1e6:>15.1f} {new * 1e6:>15.1f} {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+    Startup and import-time regression benchmark.
+
+    Every connect execs a fresh interpreter, so interpreter start plus
+    imports is the floor on connect latency.  This runs the entry points
+    as openvpn would, many times over, and reports:
+
+    interpreter: a bare 'python -c pass', for scale
+    import-*: '-X importtime' cumulative time for each entry point module
+    reject-*: time until the script gives up on a too-old IV_VER
+    connect-*: the full path, against a stand-in IAM library
+
+    The reject and connect numbers are milliseconds above the bare
+    interpreter (and import numbers are import cost alone), so that a
+    baseline taken on one box is roughly usable on another.  Each number
+    is the fastest of the runs: the median of ~100 ms subprocess timings
+    wanders by more than a small regression, but the minimum is close
+    to what the code itself costs.  With --check, we exit non-zero if
+    anything is over the stored baseline by more than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baselines', 'startup.json')
+REJECT_CONF = os.path.join(REPO_DIR, 'test_configs', 'min_version.conf')
+CONNECT_CONF = os.path.join(REPO_DIR, 'test_configs', 'udp_dynamic.conf')
+ENTRY_MODULES = {
+    'openvpn_script': 'openvpn_client_connect.openvpn_script',
+    'vpn_user_routes': 'openvpn_client_connect.vpn_user_routes',
+}
+
+# A stand-in for iamvpnlibrary: same interface, answers from memory,
+# and only imports what the real one can't avoid.  We are measuring
+# our startup, not IAM's.
+STAND_IN_IAM = '''
+from collections import namedtuple
+ParsedACL = namedtuple('ParsedACL', ['rule', 'address', 'portstring', 'description'])
+
+class IAMVPNLibrary:
+    def user_allowed_to_vpn(self, user):
+        return True
+    def verify_sudo_user(self, username_is, username_as=None):
+        return username_is
+    def get_allowed_vpn_ips(self, user):
+        return ['10.0.0.0/8', '192.168.50.0/24', '10.8.3.0/24']
+    def get_allowed_vpn_acls(self, user):
+        return [ParsedACL('vpn_example', '10.0.0.0/8', '', '')]
+'''
+
+
+def write_stand_in_iam(directory):
+    """
+        Drop the stand-in iamvpnlibrary into directory, which the caller
+        puts at the front of PYTHONPATH.
+    """
+    package_dir = os.path.join(directory, 'iamvpnlibrary')
+    os.makedirs(package_dir, exist_ok=True)
+    with open(os.path.join(package_dir, '__init__.py'), 'w', encoding='utf-8') as filehandle:
+        filehandle.write(STAND_IN_IAM)
+
+
+def make_env(iam_dir, **extra):
+    """
+        The environment for a child: stand-in IAM first, then this repo.
+    """
+    env = {key: val for key, val in os.environ.items()
+           if key not in ('IV_VER', 'common_name', 'username', 'trusted_ip')}
+    env['PYTHONPATH'] = os.pathsep.join([iam_dir, REPO_DIR])
+    env.update(extra)
+    return env
+
+
+def time_command(argv, env, runs):
+    """
+        Run argv runs times and return the wall times in milliseconds.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, env=env, cwd=REPO_DIR, check=False,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def import_time(module, env, runs):
+    """
+        Return the '-X importtime' cumulative milliseconds for module,
+        one per run, and the slowest of our own modules on the last run.
+    """
+    times = []
+    own_modules = {}
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-B', '-X', 'importtime', '-c',
+                               f'import {module}'],
+                              env=env, cwd=REPO_DIR, check=False,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              text=True)
+        own_modules = {}
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if len(fields) != 3 or not fields[0].startswith('import time:'):
+                continue
+            try:
+                cumulative = int(fields[1])
+            except ValueError:
+                continue
+            name = fields[2].strip()
+            if name == module:
+                times.append(cumulative / 1000)
+            if name.startswith('openvpn_client_connect'):
+                own_modules[name] = cumulative / 1000
+    return times, own_modules
+
+
+def measure(runs):
+    """
+        Run every scenario and return {metric: fastest ms above the bare
+        interpreter}, the interpreter's own fastest, and our import breakdown.
+    """
+    results = {}
+    breakdown = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_stand_in_iam(tmpdir)
+        output_file = os.path.join(tmpdir, 'push.conf')
+        env = make_env(tmpdir)
+        floor = min(time_command([sys.executable, '-B', '-c', 'pass'],
+                                 env, runs))
+        for label, module in ENTRY_MODULES.items():
+            times, own_modules = import_time(module, env, runs)
+            if times:
+                results[f'import-{label}'] = min(times)
+            breakdown.update(own_modules)
+
+        script = [sys.executable, '-B', '-m', ENTRY_MODULES['openvpn_script']]
+        reject_env = make_env(tmpdir, common_name='bob', username='bob',
+                              trusted_ip='8.7.6.5', IV_VER='2.2.0')
+        results['reject-openvpn_script'] = min(time_command(
+            script + ['--conf', REJECT_CONF, output_file], reject_env, runs)) - floor
+        connect_env = make_env(tmpdir, common_name='bob', username='bob',
+                               trusted_ip='8.7.6.5', IV_VER='2.6.8')
+        results['connect-openvpn_script'] = min(time_command(
+            script + ['--conf', CONNECT_CONF, output_file], connect_env, runs)) - floor
+        results['connect-vpn_user_routes'] = min(time_command(
+            [sys.executable, '-B', '-m', ENTRY_MODULES['vpn_user_routes'],
+             '--conf', CONNECT_CONF, '--trusted-ip', '8.7.6.5', 'bob'],
+            env, runs)) - floor
+    return results, floor, breakdown
+
+
+def check(results, baseline, tolerance, slack_ms):
+    """
+        Return a list of (metric, measured, allowed) that went over.
+    """
+    regressions = []
+    for metric, base in sorted(baseline.items()):
+        if metric not in results:
+            continue
+        allowed = base * (1 + tolerance) + slack_ms
+        if results[metric] > allowed:
+            regressions.append((metric, results[metric], allowed))
+    return regressions
+
+
+def main():
+    """ Measure, print, and optionally check or update the baseline """
+    parser = ArgumentParser(description='Startup/import-time regression benchmark')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Runs per scenario (we take the fastest)')
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE,
+                        help='Baseline file')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit 1 if anything is over the baseline')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Write these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed fractional slowdown over baseline')
+    parser.add_argument('--slack-ms', type=float, default=10.0,
+                        help='Allowed absolute slowdown, for noise on small numbers')
+    args = parser.parse_args()
+
+    results, floor, breakdown = measure(args.runs)
+    print(f'bare interpreter: {floor:.1f} ms (not included below)')
+    for metric, value in sorted(results.items()):
+        print(f'{metric:>28}: {value:7.1f} ms')
+    print('our modules, cumulative import ms:')
+    for name, value in sorted(breakdown.items(), key=lambda item: -item[1]):
+        print(f'{name:>45}: {value:7.1f}')
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as filehandle:
+            json.dump({metric: round(value, 1) for metric, value in results.items()},
+                      filehandle, indent=2, sort_keys=True)
+            filehandle.write('\n')
+        print(f'baseline written to {args.baseline}')
+    if args.check:
+        with open(args.baseline, 'r', encoding='utf-8') as filehandle:
+            baseline = json.load(filehandle)
+        regressions = check(results, baseline, args.tolerance, args.slack_ms)
+        for metric, measured, allowed in regressions:
+            print(f'REGRESSION {metric}: {measured:.1f} ms, allowed {allowed:.1f} ms')
+        if regressions:
+            sys.exit(1)
+        print('startup within baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+    Differential test, and speed comparison, for route engines.
+
+    Any faster way of working out routes (a new route_subtraction,
+    route_exclusion, get_office_routes, or a whole new engine) has to give
+    exactly the same routes, in the same order, written the same way, as
+    the per-user code always has.  This generates classes of inputs meant
+    to find the differences, runs the reference engine and each candidate
+    on them, and fails loudly on the first disagreement.  When everyone
+    agrees, it reports each candidate's speedup per input class.
+
+    reference: GetUserRoutes' own code with no memo or cache: a fresh
+        _compute_nonoffice_routes and add_office_routes per user.
+    memo: build_routes_from_acls, as connects use it (memoized by ACL set).
+    batch: BatchRouteEngine, all users at once (needs numpy).
+
+    A replacement for one of GetUserRoutes' helpers is tested by adding
+    it as a candidate that patches it in; its effect shows in the routes.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Building a GetUserRoutes connects to IAM; the fake will do.
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks', 'fake_iam'))
+# pylint: disable=wrong-import-position
+from openvpn_client_connect.per_user_configs import GetUserRoutes  # noqa: E402
+from openvpn_client_connect import batch_routes  # noqa: E402
+
+BASE_CONFIG = {
+    'FREE_ROUTES': ['10.8.0.0/16', '10.10.0.0/16'],
+    'COMPREHENSIVE_OFFICE_ROUTES': ['10.192.0.0/10'],
+    'PER_OFFICE_ROUTES': {'site1': '10.238.0.0/16', 'site2': '10.239.0.0/16'},
+}
+# (from_office, client_ip, server_ip): out of office, in an office, at home.
+BASE_SITUATIONS = [(None, None, None), ('site1', '198.51.100.7', '10.48.0.1'),
+                   (None, '203.0.113.5', '10.48.0.1')]
+
+
+def _address(rand, base=None, low_bits=32):
+    """ A dotted quad: random, or base with its low low_bits randomized """
+    value = rand.getrandbits(32) if base is None else base | rand.getrandbits(low_bits)
+    return f'{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}'
+
+
+def _cidr(rand, base=None, low_bits=32, prefixes=(8, 12, 16, 20, 24, 28, 32)):
+    """ A CIDR, with host bits cleared """
+    prefix = rand.choice(prefixes)
+    value = rand.getrandbits(32) if base is None else base | rand.getrandbits(low_bits)
+    value &= (0xffffffff << (32 - prefix)) & 0xffffffff
+    return f'{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}/{prefix}'
+
+
+def random_case(rand, users):
+    """ Anything anywhere """
+    return BASE_CONFIG, {f'u{num}': [_cidr(rand) for _ in range(rand.randrange(0, 10))]
+                         for num in range(users)}, BASE_SITUATIONS
+
+
+def overlapping_case(rand, users):
+    """ Nested, overlapping, adjacent and repeated CIDRs in a small space """
+    space = 0xac100000  # 172.16.0.0/12
+    users_acls = {}
+    for num in range(users):
+        acls = [_cidr(rand, space, 20, prefixes=(12, 14, 16, 18, 20, 22, 23, 24))
+                for _ in range(rand.randrange(1, 12))]
+        acls += rand.sample(acls, min(2, len(acls)))
+        users_acls[f'u{num}'] = acls
+    return BASE_CONFIG, users_acls, BASE_SITUATIONS
+
+
+def host_routes_case(rand, users):
+    """ Lots of /32s, some in runs that merge into bigger blocks """
+    users_acls = {}
+    for num in range(users):
+        start = 0xc0a80000 | rand.getrandbits(12)  # in 192.168.0.0/16
+        run = [f'{_address(rand, start + offset, 0)}/32'
+               for offset in range(rand.randrange(0, 40))]
+        scattered = [f'{_address(rand, 0x0a000000, 24)}/32' for _ in range(rand.randrange(8))]
+        users_acls[f'u{num}'] = run + scattered
+    return BASE_CONFIG, users_acls, BASE_SITUATIONS
+
+
+def office_supernets_case(rand, users):
+    """ ACLs above, below and across the free and office routes """
+    around = ['0.0.0.0/0', '10.0.0.0/8', '10.128.0.0/9', '10.192.0.0/10', '10.192.0.0/11',
+              '10.238.0.0/16', '10.238.5.0/24', '10.8.0.0/16', '10.8.0.0/15', '10.9.0.0/16',
+              '10.10.3.4/32', '10.191.255.255/32', '10.255.0.0/16']
+    return BASE_CONFIG, {f'u{num}': rand.sample(around, rand.randrange(1, 6)) +
+                         [_cidr(rand) for _ in range(rand.randrange(3))]
+                         for num in range(users)}, BASE_SITUATIONS
+
+
+def client_in_office_case(rand, users):
+    """ Clients whose own address is inside office routes, with ifconfig_local set """
+    situations = [(None, '10.238.1.5', '10.238.0.1'), ('site2', '10.239.4.4', '10.239.0.1'),
+                  (None, '10.200.0.9', '10.200.0.1'), ('site1', '10.238.1.5', '10.48.0.1'),
+                  ('nowhere', '10.192.0.1', '10.192.0.2'), (None, '10.238.1.5', None)]
+    return BASE_CONFIG, {f'u{num}': [_cidr(rand, 0x0a000000, 24) for _ in range(
+        rand.randrange(1, 8))] for num in range(users)}, situations
+
+
+def odd_forms_case(rand, users):
+    """ Host bits set, IPv6, and free routes in both families """
+    config = dict(BASE_CONFIG, FREE_ROUTES=BASE_CONFIG['FREE_ROUTES'] + ['2001:db8::/32'])
+    users_acls = {}
+    for num in range(users):
+        acls = [f'{_address(rand)}/{rand.choice((8, 16, 23, 24, 30))}'
+                for _ in range(rand.randrange(0, 5))]
+        acls += [f'2001:db{rand.choice("89")}:{rand.randrange(4):x}::/{rand.choice((32, 48, 64))}'
+                 for _ in range(rand.randrange(0, 3))]
+        users_acls[f'u{num}'] = acls
+    return config, users_acls, BASE_SITUATIONS
+
+
+INPUT_CLASSES = {
+    'random': random_case,
+    'overlapping': overlapping_case,
+    'host-routes': host_routes_case,
+    'office-supernets': office_supernets_case,
+    'client-in-office': client_in_office_case,
+    'odd-forms': odd_forms_case,
+}
+
+
+def reference_engine(user_routes):
+    """ The per-user code, with nothing memoized """
+    def _run(users_acls, situation):
+        results = {}
+        for user, acls in users_acls.items():
+            if not acls:
+                results[user] = []
+                continue
+            # pylint: disable=protected-access
+            nonoffice = user_routes._compute_nonoffice_routes(acls)
+            results[user] = user_routes.add_office_routes(nonoffice, *situation)
+        return results
+    return _run
+
+
+def memo_engine(user_routes):
+    """ The per-user code as connects run it """
+    def _run(users_acls, situation):
+        return {user: user_routes.build_routes_from_acls(acls, *situation)
+                for user, acls in users_acls.items()}
+    return _run
+
+
+def batch_engine(user_routes):
+    """ Everyone at once """
+    engine = batch_routes.BatchRouteEngine(user_routes)
+
+    def _run(users_acls, situation):
+        return engine.build_routes(users_acls, *situation)
+    return _run
+
+
+CANDIDATES = {'memo': memo_engine}
+if batch_routes.numpy is not None:
+    CANDIDATES['batch'] = batch_engine
+
+
+def write_config(directory, config):
+    """ A route config file """
+    conffile = os.path.join(directory, 'routes.conf')
+    with open(conffile, 'w', encoding='utf-8') as filehandle:
+        filehandle.write('[dynamic-mapping]\n')
+        for option, value in config.items():
+            filehandle.write(f'{option} = {value!r}\n')
+    return conffile
+
+
+def run_engine(factory, conffile, users_acls, situations, repeat):
+    """
+        Everyone's routes in every situation, and the best time of repeat
+        runs.  Each run gets a fresh GetUserRoutes, so nothing carries over.
+    """
+    best = None
+    for _ in range(repeat):
+        engine = factory(GetUserRoutes(conffile))
+        started = time.perf_counter()
+        outputs = [engine(users_acls, situation) for situation in situations]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return outputs, best
+
+
+def first_difference(reference, candidate, users_acls, situations):
+    """ A description of the first disagreement, or None """
+    for situation, ref_routes, cand_routes in zip(situations, reference, candidate):
+        for user, acls in users_acls.items():
+            expected = [str(route) for route in ref_routes[user]]
+            got = [str(route) for route in cand_routes.get(user, [])]
+            if expected != got:
+                return {'user': user, 'acls': acls, 'situation': situation,
+                        'expected': expected, 'got': got}
+    return None
+
+
+def main():
+    """ Run every candidate against the reference on every input class """
+    parser = ArgumentParser(description='Differential test of route engines')
+    parser.add_argument('--classes', choices=sorted(INPUT_CLASSES), nargs='+',
+                        default=list(INPUT_CLASSES))
+    parser.add_argument('--candidates', choices=sorted(CANDIDATES), nargs='+',
+                        default=list(CANDIDATES))
+    parser.add_argument('--users', type=int, default=2000, help='Users per input class')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing runs; best is kept')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    # get_office_routes falls back to this; the situations say what they mean.
+    os.environ.pop('ifconfig_local', None)
+    report, failures = [], []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.classes:
+            config, users_acls, situations = INPUT_CLASSES[name](random.Random(args.seed),
+                                                                 args.users)
+            conffile = write_config(tmpdir, config)
+            reference, ref_time = run_engine(reference_engine, conffile, users_acls,
+                                             situations, args.repeat)
+            for candidate in args.candidates:
+                outputs, cand_time = run_engine(CANDIDATES[candidate], conffile, users_acls,
+                                                situations, args.repeat)
+                difference = first_difference(reference, outputs, users_acls, situations)
+                if difference is not None:
+                    failures.append(dict(difference, input_class=name, candidate=candidate))
+                report.append({'class': name, 'candidate': candidate,
+                               'connects': len(users_acls) * len(situations),
+                               'identical': difference is None,
+                               'reference_ms': ref_time * 1000, 'candidate_ms': cand_time * 1000,
+                               'speedup': ref_time / cand_time if cand_time else None})
+
+    if args.json:
+        print(json.dumps({'results': report, 'failures': failures}, indent=2))
+    else:
+        print(f'{"class":>17} {"candidate":>9} {"n":>7} {"same":>5} {"ref ms":>9} '
+              f'{"cand ms":>9} {"speedup":>8}')
+        for row in report:
+            print(f'{row["class"]:>17} {row["candidate"]:>9} {row["connects"]:>7} '
+                  f'{"yes" if row["identical"] else "NO":>5} {row["reference_ms"]:>9.1f} '
+                  f'{row["candidate_ms"]:>9.1f} {row["speedup"]:>7.1f}x')
+        for failure in failures:
+            print(f'MISMATCH: {json.dumps(failure)}', file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
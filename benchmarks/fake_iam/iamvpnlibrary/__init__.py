@@ -0,0 +1,100 @@
+"""
+    A fake iamvpnlibrary for load tests.
+
+    Put benchmarks/fake_iam at the front of sys.path (or PYTHONPATH) and
+    this is what openvpn_client_connect gets instead of the real library.
+    It answers from a synthetic directory, with IAM-like latency, and its
+    behavior comes from a JSON blob in the FAKE_IAM_CONFIG environment
+    variable so that subprocesses and threads see the same backend:
+
+        latency_ms:       mean latency of each query
+        jitter_ms:        +/- uniform spread around that
+        connect_ms:       latency of constructing the library (connecting)
+        deny_fraction:    share of users who aren't allowed to VPN
+        acls_per_user:    how many ACLs each user has
+        brownouts:        list of {start, end, latency_factor, error_rate},
+                          start/end in epoch seconds.  During a brownout,
+                          latency is multiplied and connecting fails with
+                          RuntimeError at error_rate.
+"""
+import os
+import json
+import time
+import random
+import hashlib
+from collections import namedtuple
+
+ParsedACL = namedtuple('ParsedACL', ['rule', 'address', 'portstring', 'description'])
+CONFIG_ENV = 'FAKE_IAM_CONFIG'
+DEFAULTS = {
+    'latency_ms': 5.0,
+    'jitter_ms': 2.0,
+    'connect_ms': 10.0,
+    'deny_fraction': 0.02,
+    'acls_per_user': 12,
+    'brownouts': [],
+}
+
+
+def load_config():
+    """ Our behavior, from the environment """
+    config = dict(DEFAULTS)
+    config.update(json.loads(os.environ.get(CONFIG_ENV) or '{}'))
+    return config
+
+
+def _user_random(user):
+    """ A Random that gives the same answers for the same user, every time """
+    return random.Random(hashlib.sha256(user.encode('utf-8')).digest())
+
+
+class IAMVPNLibrary:
+    """ The same interface as the real thing """
+    def __init__(self):
+        self.config = load_config()
+        brownout = self._brownout()
+        if brownout is not None and random.random() < brownout.get('error_rate', 0):
+            self._sleep(self.config['connect_ms'])
+            raise RuntimeError('fake IAM is browned out')
+        self._sleep(self.config['connect_ms'])
+
+    def _brownout(self):
+        """ The brownout we're in, if any """
+        now = time.time()
+        for brownout in self.config['brownouts']:
+            if brownout['start'] <= now < brownout['end']:
+                return brownout
+        return None
+
+    def _sleep(self, mean_ms):
+        """ Take as long as IAM would """
+        brownout = self._brownout()
+        factor = 1.0 if brownout is None else brownout.get('latency_factor', 1.0)
+        jitter = self.config['jitter_ms']
+        delay_ms = max(0.0, mean_ms + random.uniform(-jitter, jitter)) * factor
+        time.sleep(delay_ms / 1000)
+
+    def user_allowed_to_vpn(self, user):
+        """ Most people are allowed """
+        self._sleep(self.config['latency_ms'])
+        return _user_random(user).random() >= self.config['deny_fraction']
+
+    def verify_sudo_user(self, username_is, username_as=None):
+        """ Nobody sudoes in a load test """
+        self._sleep(self.config['latency_ms'])
+        return username_is
+
+    def get_allowed_vpn_acls(self, user):
+        """ A stable, per-user slice of a made-up org's ACLs """
+        self._sleep(self.config['latency_ms'])
+        rand = _user_random(user)
+        acls = []
+        for _ in range(self.config['acls_per_user']):
+            group = rand.randrange(200)
+            acls.append(ParsedACL(f'vpn_group_{group}',
+                                  f'10.{group}.{rand.randrange(256)}.0/24', '', ''))
+        return acls
+
+    def get_allowed_vpn_ips(self, user):
+        """ The addresses of the user's ACLs """
+        return [acl.address for acl in self.get_allowed_vpn_acls(user)]
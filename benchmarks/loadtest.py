@@ -0,0 +1,278 @@
+"""
+    Load-test the client-connect script, to size VPN servers.
+
+    This makes up realistic client-connect environments (common_name,
+    username, trusted_ip from offices and from home, a mix of IV_VERs,
+    ifconfig_local) and runs openvpn_script.main_work on them concurrently,
+    against the fake IAM in benchmarks/fake_iam.  Two ways to run it:
+
+    subprocess: exec the script per connect, exactly as openvpn does.
+    inprocess: call main_work from a pool of threads in this process,
+        which shows how the code itself scales without exec costs.
+
+    Scenarios:
+
+    reboot-storm: a server restarts and every client reconnects within a
+        couple of seconds.
+    morning-ramp: arrivals grow steadily from a trickle to the peak rate.
+    iam-brownout: a steady rate, but in the middle third IAM gets slow
+        and flaky.
+
+    Arrivals are open-loop: a connect that arrives while all workers are
+    busy waits, and that wait counts in its latency (as it would for a
+    real client).  We report throughput and p50/p95/p99 of both latency
+    (arrival to done) and service time (start to done).
+"""
+import os
+import sys
+import json
+import time
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_IAM_DIR = os.path.join(REPO_DIR, 'benchmarks', 'fake_iam')
+DEFAULT_CONF = os.path.join(REPO_DIR, 'test_configs', 'udp_dynamic.conf')
+# The fake must win over any real iamvpnlibrary, in here and in children.
+sys.path.insert(0, FAKE_IAM_DIR)
+# pylint: disable=wrong-import-position
+import iamvpnlibrary  # noqa: E402
+from openvpn_client_connect import openvpn_script  # noqa: E402
+from openvpn_client_connect.client_connect import ClientConnect  # noqa: E402
+
+# (IV_VER, weight).  None means the client didn't send one.
+IV_VER_MIX = (('2.6.8', 55), ('2.6.3', 15), ('2.5.9', 20), ('2.4.12', 7),
+              ('2.3.18', 2), (None, 1))
+SERVER_IP = '10.48.0.1'
+
+
+def percentile_summary(values):
+    """
+        p50/p95/p99 of values, in milliseconds.
+    """
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    if len(values) == 1:
+        return {'p50': values[0], 'p95': values[0], 'p99': values[0]}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+class EnvironmentFactory:
+    """
+        Make up openvpn client-connect environments.
+    """
+    def __init__(self, conf_file, num_users, office_share, seed):
+        self.rand = random.Random(seed)
+        self.users = [f'user{num}@example.com' for num in range(num_users)]
+        office_ips = []
+        for site_ip in ClientConnect(conf_file).office_ip_mapping.values():
+            office_ips += site_ip if isinstance(site_ip, list) else [site_ip]
+        self.office_ips = office_ips
+        self.office_share = office_share if office_ips else 0.0
+        self.versions = [version for version, _ in IV_VER_MIX]
+        self.weights = [weight for _, weight in IV_VER_MIX]
+
+    def make(self):
+        """
+            One connecting client's environment.
+        """
+        user = self.rand.choice(self.users)
+        if self.rand.random() < self.office_share:
+            trusted_ip = self.rand.choice(self.office_ips)
+        else:
+            trusted_ip = (f'{self.rand.randrange(1, 224)}.{self.rand.randrange(256)}.'
+                          f'{self.rand.randrange(256)}.{self.rand.randrange(1, 255)}')
+        env = {'common_name': user, 'username': user, 'trusted_ip': trusted_ip,
+               'ifconfig_local': SERVER_IP}
+        version = self.rand.choices(self.versions, self.weights)[0]
+        if version is not None:
+            env['IV_VER'] = version
+        return env
+
+
+def reboot_storm(rand, clients, duration):
+    """
+        Everyone comes back within the window.
+    """
+    return sorted(rand.uniform(0, duration) for _ in range(clients))
+
+
+def morning_ramp(rand, clients, duration):
+    """
+        Arrival rate grows linearly from zero, so arrival times follow
+        sqrt of a uniform draw.
+    """
+    return sorted(duration * rand.random() ** 0.5 for _ in range(clients))
+
+
+def iam_brownout(rand, clients, duration):
+    """
+        Steady arrivals; the brownout itself is set up in SCENARIOS.
+    """
+    return sorted(rand.uniform(0, duration) for _ in range(clients))
+
+
+# name: (arrival schedule, default duration, brownout or None)
+SCENARIOS = {
+    'reboot-storm': (reboot_storm, 2.0, None),
+    'morning-ramp': (morning_ramp, 10.0, None),
+    'iam-brownout': (iam_brownout, 10.0, {'latency_factor': 10.0, 'error_rate': 0.2}),
+}
+
+
+class InProcessRunner:
+    """
+        Run main_work in this process, from threads.
+    """
+    def __init__(self, conf_file, workdir):
+        self.conf_file = conf_file
+        self.workdir = workdir
+
+    def run(self, number, env):
+        """ One connect; returns main_work's answer """
+        outfile = os.path.join(self.workdir, f'push.{number}')
+        return openvpn_script.main_work(['openvpn-client-connect', '--conf', self.conf_file,
+                                         outfile], environ=env)
+
+    def __enter__(self):
+        # main_work chats on stdout about broken clients; keep the report readable.
+        self._devnull = open(  # pylint: disable=consider-using-with
+            os.devnull, 'w', encoding='utf-8')
+        self._quiet = contextlib.redirect_stdout(self._devnull)
+        self._quiet.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._quiet.__exit__(*exc)
+        self._devnull.close()
+
+
+class SubprocessRunner:
+    """
+        Exec the script per connect, like openvpn does.
+    """
+    def __init__(self, conf_file, workdir):
+        self.conf_file = conf_file
+        self.workdir = workdir
+        base = {key: val for key, val in os.environ.items()
+                if key not in openvpn_script.SERVICE_ENV_VARS}
+        base['PYTHONPATH'] = os.pathsep.join([FAKE_IAM_DIR, REPO_DIR])
+        self.base_env = base
+
+    def run(self, number, env):
+        """ One connect; returns whether the script exited 0 """
+        outfile = os.path.join(self.workdir, f'push.{number}')
+        proc = subprocess.run([sys.executable, '-B', '-m', 'openvpn_client_connect.openvpn_script',
+                               '--conf', self.conf_file, outfile],
+                              env=dict(self.base_env, **env), cwd=REPO_DIR, check=False,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return proc.returncode == 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def run_scenario(runner, arrivals, envs, concurrency):
+    """
+        Fire connects at their arrival times, at most concurrency at once.
+        Returns (latencies ms, service times ms, successes, wall seconds).
+    """
+    results = []
+    lock = threading.Lock()
+
+    def _one(number, due):
+        started = time.perf_counter()
+        allowed = runner.run(number, envs[number])
+        done = time.perf_counter()
+        with lock:
+            results.append(((done - due) * 1000, (done - started) * 1000, allowed))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        zero = time.perf_counter()
+        for number, offset in enumerate(arrivals):
+            due = zero + offset
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(_one, number, due)
+    wall = time.perf_counter() - zero
+    return ([result[0] for result in results], [result[1] for result in results],
+            sum(1 for result in results if result[2]), wall)
+
+
+def main():
+    """ Run the chosen scenarios and print a report """
+    parser = ArgumentParser(description='Load-test openvpn_script.main_work')
+    parser.add_argument('--mode', choices=['inprocess', 'subprocess'], default='inprocess')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), nargs='+',
+                        default=sorted(SCENARIOS))
+    parser.add_argument('--conf', type=str, default=DEFAULT_CONF,
+                        help='client-connect config to test with')
+    parser.add_argument('--clients', type=int, default=500,
+                        help='Connects per scenario')
+    parser.add_argument('--users', type=int, default=2000,
+                        help='Size of the made-up user population')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='Seconds over which connects arrive (per-scenario default)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Connects handled at once')
+    parser.add_argument('--office-share', type=float, default=0.3,
+                        help='Fraction of connects from an office')
+    parser.add_argument('--iam-latency-ms', type=float, default=5.0)
+    parser.add_argument('--iam-connect-ms', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    report = []
+    runner_class = InProcessRunner if args.mode == 'inprocess' else SubprocessRunner
+    for name in args.scenario:
+        schedule, default_duration, brownout = SCENARIOS[name]
+        duration = args.duration if args.duration is not None else default_duration
+        rand = random.Random(args.seed)
+        arrivals = schedule(rand, args.clients, duration)
+        factory = EnvironmentFactory(args.conf, args.users, args.office_share, args.seed)
+        envs = [factory.make() for _ in arrivals]
+        iam_config = {'latency_ms': args.iam_latency_ms, 'connect_ms': args.iam_connect_ms,
+                      'brownouts': []}
+        if brownout is not None:
+            now = time.time()
+            iam_config['brownouts'].append(dict(brownout, start=now + duration / 3,
+                                                end=now + 2 * duration / 3))
+        os.environ[iamvpnlibrary.CONFIG_ENV] = json.dumps(iam_config)
+        with tempfile.TemporaryDirectory() as workdir, \
+                runner_class(args.conf, workdir) as runner:
+            latencies, service_times, successes, wall = run_scenario(
+                runner, arrivals, envs, args.concurrency)
+        report.append({'scenario': name, 'mode': args.mode, 'connects': len(latencies),
+                       'allowed': successes, 'wall_seconds': wall,
+                       'throughput': len(latencies) / wall if wall else None,
+                       'latency_ms': percentile_summary(latencies),
+                       'service_ms': percentile_summary(service_times)})
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f'{"scenario":>14} {"mode":>10} {"n":>6} {"ok":>6} {"conn/s":>8} '
+          f'{"lat p50":>8} {"p95":>8} {"p99":>8} {"svc p50":>8} {"p95":>8} {"p99":>8}')
+    for row in report:
+        lat, svc = row['latency_ms'], row['service_ms']
+        print(f'{row["scenario"]:>14} {row["mode"]:>10} {row["connects"]:>6} '
+              f'{row["allowed"]:>6} {row["throughput"]:>8.1f} '
+              f'{lat["p50"]:>8.1f} {lat["p95"]:>8.1f} {lat["p99"]:>8.1f} '
+              f'{svc["p50"]:>8.1f} {svc["p95"]:>8.1f} {svc["p99"]:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+    Build single-file, precompiled bundles of the exec-per-connect scripts.
+
+    openvpn runs client-connect (and client-disconnect) as a fresh python
+    for every client, so each connect pays to find and load our modules
+    and netaddr.  An RPM built by fpm may have no bytecode for them (and
+    our modules set sys.dont_write_bytecode, so none is written later),
+    in which case every connect compiles them from source again.
+
+    Each bundle here is one executable zip file (a zipapp) that holds:
+    - our package and the pure-python packages we depend on, as .pyc
+      files only, compiled ahead of time (optimized, without docstrings)
+    - the packages' data files, so importlib.resources still works
+    - a small __main__ that checks the interpreter matches the bytecode
+      and calls the entry point
+    The zip is the first thing on sys.path, so our imports are answered
+    from its index without searching directories.  The default
+    interpreter line passes -sE, which drops the user site directory and
+    PYTHON* environment variables.  Anything not bundled (python-ldap,
+    under iamvpnlibrary) is still loaded from the system site-packages.
+
+    The bytecode only suits the python version that built it, so build on
+    (or for) the version you deploy.  `make bundle` builds into dist/;
+    `make bench-bundle` compares bundle startup to an installed package.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import stat
+import zipfile
+import tempfile
+import py_compile
+import importlib.machinery
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = 'openvpn_client_connect'
+
+# Bundle name: the entry point it runs, as in setup.py's console_scripts.
+BUNDLES = {
+    'openvpn-client-connect': 'openvpn_client_connect.openvpn_script:main',
+    'openvpn-client-disconnect': 'openvpn_client_connect.disconnect_script:main',
+    'vpn-user-routes': 'openvpn_client_connect.vpn_user_routes:main',
+}
+# Installed packages to put in every bundle by default.
+DEFAULT_PACKAGES = ('netaddr', 'iamvpnlibrary')
+DEFAULT_INTERPRETER = '/usr/bin/python3 -sE'
+# Nobody imports these at runtime.
+_SKIP_DIRS = ('__pycache__', 'tests', 'test')
+# Fixed member timestamps, so the same tree builds the same bytes.
+_ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+_MAIN_TEMPLATE = '''\
+import sys
+if sys.implementation.cache_tag != {cache_tag!r}:
+    sys.exit('this bundle was built for {cache_tag}, not ' + str(sys.implementation.cache_tag))
+from {module} import {function}
+{function}()
+'''
+
+
+class BundleError(Exception):
+    """ We can't build the bundle that was asked for """
+
+
+def find_package(name, search_path=None):
+    """
+        The directory (or, for a single module, the file) that name would
+        be imported from, searching search_path (default sys.path).
+    """
+    if name == PACKAGE:
+        return os.path.join(REPO_DIR, PACKAGE)
+    spec = importlib.machinery.PathFinder.find_spec(name, search_path)
+    if spec is None or spec.origin is None:
+        # (No origin: just a directory of that name, a namespace package.)
+        raise BundleError(f'{name} is not installed')
+    if spec.submodule_search_locations:
+        return list(spec.submodule_search_locations)[0]
+    if not spec.origin.endswith('.py'):
+        raise BundleError(f'{name} is not a pure-python module')
+    return spec.origin
+
+
+def package_members(name, location):
+    """
+        Yield (name in the archive, path on disk) for everything under a
+        package (or the one module) that a bundle should carry.
+    """
+    if os.path.isfile(location):
+        yield f'{name}.py', location
+        return
+    for dirpath, dirnames, filenames in os.walk(location):
+        dirnames[:] = sorted(dirname for dirname in dirnames if dirname not in _SKIP_DIRS)
+        relative = os.path.relpath(dirpath, os.path.dirname(location))
+        for filename in sorted(filenames):
+            if filename.endswith(('.pyc', '.pyo')):
+                continue
+            if filename.endswith(tuple(importlib.machinery.EXTENSION_SUFFIXES)):
+                raise BundleError(f'{name} has compiled extensions, which cannot '
+                                  'be loaded from a zip')
+            yield (os.path.join(relative, filename).replace(os.sep, '/'),
+                   os.path.join(dirpath, filename))
+
+
+def _add_member(archive, arcname, data):
+    """
+        Add one file, uncompressed (loading is what we're optimizing).
+    """
+    info = zipfile.ZipInfo(arcname, date_time=_ZIP_DATE)
+    info.external_attr = 0o644 << 16
+    archive.writestr(info, data)
+
+
+def _compiled(path, arcname, optimize, workdir):
+    """
+        The .pyc bytes for one source file.  Unchecked hash-based, since
+        there is no source alongside to check against.
+    """
+    cfile = os.path.join(workdir, 'module.pyc')
+    py_compile.compile(path, cfile=cfile, dfile=arcname, doraise=True, optimize=optimize,
+                       invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    with open(cfile, 'rb') as filehandle:
+        return filehandle.read()
+
+
+def build_bundle(target, entry_point, packages=DEFAULT_PACKAGES,
+                 interpreter=DEFAULT_INTERPRETER, optimize=2, search_path=None):
+    """
+        Write one bundle to target, running entry_point ('module:function').
+        packages are added to our own; search_path is where to find them
+        (default sys.path).  Returns the number of modules bundled.
+    """
+    module, function = entry_point.split(':')
+    modules = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        staged = target + '.tmp'
+        with open(staged, 'wb') as filehandle:
+            if interpreter:
+                filehandle.write(b'#!' + interpreter.encode('utf-8') + b'\n')
+            with zipfile.ZipFile(filehandle, 'w', compression=zipfile.ZIP_STORED) as archive:
+                _add_member(archive, '__main__.py', _MAIN_TEMPLATE.format(
+                    cache_tag=sys.implementation.cache_tag, module=module, function=function))
+                for name in (PACKAGE,) + tuple(packages):
+                    for arcname, path in package_members(name, find_package(name, search_path)):
+                        if arcname.endswith('.py'):
+                            _add_member(archive, arcname + 'c',
+                                        _compiled(path, arcname, optimize, workdir))
+                            modules += 1
+                        else:
+                            with open(path, 'rb') as datafile:
+                                _add_member(archive, arcname, datafile.read())
+        os.chmod(staged, os.stat(staged).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        os.replace(staged, target)
+    return modules
+
+
+def main():
+    """ Build the bundles """
+    parser = ArgumentParser(description='Build precompiled zipapp bundles of the scripts')
+    parser.add_argument('--dist', type=str, default=os.path.join(REPO_DIR, 'dist'),
+                        help='Directory to write bundles into')
+    parser.add_argument('--bundles', choices=sorted(BUNDLES), nargs='+',
+                        default=list(BUNDLES))
+    parser.add_argument('--with', type=str, nargs='*', dest='packages',
+                        default=list(DEFAULT_PACKAGES),
+                        help='Installed pure-python packages to bundle')
+    parser.add_argument('--python', type=str, default=DEFAULT_INTERPRETER,
+                        help='The #! interpreter line')
+    parser.add_argument('--optimize', type=int, choices=(0, 1, 2), default=2,
+                        help='Bytecode optimization level, as python -O/-OO')
+    args = parser.parse_args()
+
+    os.makedirs(args.dist, exist_ok=True)
+    try:
+        for name in args.bundles:
+            target = os.path.join(args.dist, f'{name}.pyz')
+            modules = build_bundle(target, BUNDLES[name], args.packages, args.python,
+                                   args.optimize)
+            print(f'{target}: {modules} modules, {os.path.getsize(target)} bytes')
+    except BundleError as err:
+        print(f'cannot build bundle: {err}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+    A short-lived, per-user cache of IAM answers.
+
+    One host runs several openvpn instances (udp4, udp6, tcp4, tcp6), and
+    a client that falls back from one protocol to another shows up on two
+    of them a few seconds apart.  Those connects ask IAM the same things
+    about the same user.  Caching the answers briefly means the second
+    connect costs no IAM lookups.
+
+    Entries expire after ttl seconds, so a change in someone's ACLs takes
+    effect within ttl.  Only real answers are cached: a fail-closed answer
+    given because IAM was unreachable must never outlive the outage.
+
+    To not wait for the ttl after changing a group's ACLs, entries can be
+    dropped by user, by group (the rule of an ACL in get_allowed_vpn_acls
+    answers), or by CIDR (anyone whose cached ACLs overlap it).  For that
+    we keep a reverse index of each user's cached groups and CIDRs.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import sys
+import time
+from collections import OrderedDict
+from netaddr import IPNetwork
+sys.dont_write_bytecode = True
+
+__all__ = ['UserACLCache']
+
+
+class UserACLCache:
+    """
+        A TTL'ed, size-capped map from (IAM method, username) to answer.
+        When full, the least recently used entry goes first.
+    """
+    def __init__(self, ttl=30.0, max_entries=20000, clock=time.monotonic):
+        """
+            A ttl of 0 (or less) turns the cache off.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        # key: (groups, CIDR strings) found in that entry's answer
+        self._index = {}
+        # group: the users with a cached answer naming it
+        self._group_users = {}
+        # Bumped by every invalidation; see put().
+        self.epoch = 0
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+    @staticmethod
+    def _index_terms(value):
+        """
+            The groups and CIDRs an answer mentions: get_allowed_vpn_acls
+            gives ACL objects (rule, address), get_allowed_vpn_ips strings.
+        """
+        groups, cidrs = set(), set()
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, str):
+                    cidrs.add(item)
+                elif hasattr(item, 'rule') and hasattr(item, 'address'):
+                    groups.add(item.rule)
+                    cidrs.add(item.address)
+        return frozenset(groups), frozenset(cidrs)
+
+    def _remove(self, key):
+        """
+            Drop one entry and its part of the reverse index.
+        """
+        del self._entries[key]
+        groups, _cidrs = self._index.pop(key, ((), ()))
+        for group in groups:
+            users = self._group_users.get(group)
+            if users is not None:
+                users.discard(key[1])
+                if not users:
+                    del self._group_users[group]
+
+    def get(self, method_name, username):
+        """
+            Return (True, answer) if we have a fresh answer, else (False, None).
+        """
+        key = (method_name, username)
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self._clock():
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True, value
+            self._remove(key)
+            self.stats['expired'] += 1
+        self.stats['misses'] += 1
+        return False, None
+
+    def put(self, method_name, username, value, epoch=None):
+        """
+            Remember an answer.  Pass the epoch from before you asked IAM,
+            and an answer fetched across an invalidation isn't kept.
+        """
+        if self.ttl <= 0 or (epoch is not None and epoch != self.epoch):
+            return
+        key = (method_name, username)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (self._clock() + self.ttl, value)
+        groups, cidrs = self._index_terms(value)
+        if groups or cidrs:
+            self._index[key] = (groups, cidrs)
+        for group in groups:
+            self._group_users.setdefault(group, set()).add(username)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats['evicted'] += 1
+
+    def invalidate_user(self, username):
+        """
+            Forget everything about one user.  Returns how many entries went.
+        """
+        keys = [key for key in self._entries if key[1] == username]
+        for key in keys:
+            self._remove(key)
+        self.epoch += 1
+        return len(keys)
+
+    def users_in_group(self, group):
+        """
+            The users with a cached answer that names group.
+        """
+        return set(self._group_users.get(group, ()))
+
+    def users_overlapping(self, cidr):
+        """
+            The users with a cached ACL that overlaps cidr.
+            Raises netaddr's AddrFormatError if cidr isn't one.
+        """
+        network = IPNetwork(cidr)
+        users = set()
+        for key, (_groups, cidrs) in self._index.items():
+            if key[1] in users:
+                continue
+            for cached in cidrs:
+                try:
+                    other = IPNetwork(cached)
+                except (ValueError, TypeError):
+                    continue
+                if other.version == network.version and \
+                        other.first <= network.last and network.first <= other.last:
+                    users.add(key[1])
+                    break
+        return users
+
+    def invalidate(self, users=(), groups=(), cidrs=()):
+        """
+            Forget the named users, everyone cached as in any of groups,
+            and everyone with a cached ACL overlapping any of cidrs.
+            Returns (sorted users dropped, entries dropped).
+        """
+        targets = set(users)
+        for group in groups:
+            targets |= self.users_in_group(group)
+        for cidr in cidrs:
+            targets |= self.users_overlapping(cidr)
+        entries = sum(self.invalidate_user(user) for user in targets)
+        self.epoch += 1
+        return sorted(targets), entries
+
+    def clear(self):
+        """
+            Forget everything.
+        """
+        self._entries.clear()
+        self._index.clear()
+        self._group_users.clear()
+        self.epoch += 1
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,397 @@
+"""
+    A local SQLite replica of the VPN-relevant parts of IAM.
+
+    Every connect otherwise asks IAM, live, whether the user may VPN and
+    what their ACLs are.  With a replica, a sync job asks IAM on a steady
+    schedule instead, and connects read a local, indexed database.
+
+    The sync is incremental: each run refreshes the users whose rows are
+    oldest, a batch at a time, so IAM sees a steady trickle rather than a
+    spike per connect.  Users get into the replica by being listed in a
+    users file given to the sync job, or (with write-through) by
+    connecting once.
+
+    A row older than max-staleness is not trusted; that user's connect
+    goes to IAM live, as if there were no replica.
+
+    Configure it with an [acl-replica] section:
+
+        [acl-replica]
+        path = /var/lib/openvpn-client-connect/acls.sqlite
+        max-staleness = 3600
+        write-through = false
+
+    and run openvpn-client-connect-acl-sync --conf FILE from cron or a
+    systemd timer (or with --loop).
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import sys
+import time
+import sqlite3
+from argparse import ArgumentParser
+from openvpn_client_connect.per_user_configs import (
+    configure_iam, connect_iam_live, fail_closed_value, replica_settings)
+sys.dont_write_bytecode = True
+
+__all__ = ['ACLReplica', 'ReplicaSearcher', 'sync_users']
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS users ('
+    ' username TEXT PRIMARY KEY,'
+    ' allowed INTEGER NOT NULL DEFAULT 0,'
+    ' synced_at REAL NOT NULL DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS users_synced_at ON users (synced_at)',
+    'CREATE TABLE IF NOT EXISTS acls ('
+    ' username TEXT NOT NULL,'
+    ' rule TEXT, address TEXT, portstring TEXT, description TEXT)',
+    'CREATE INDEX IF NOT EXISTS acls_username ON acls (username)',
+    'CREATE TABLE IF NOT EXISTS ips ('
+    ' username TEXT NOT NULL,'
+    ' address TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ips_username ON ips (username)',
+)
+
+
+class ACLReplica:
+    """
+        The replica database.  Reads are single indexed lookups.
+    """
+    def __init__(self, path, max_staleness=3600.0, readonly=False, clock=time.time):
+        """
+            Open the replica at path.  A read-only replica never creates
+            or changes anything (that's the sync job's business).
+            Raises sqlite3.Error if the database can't be opened.
+        """
+        self.path = path
+        self.max_staleness = max_staleness
+        self._clock = clock
+        if readonly:
+            self._db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=1.0)
+        else:
+            self._db = sqlite3.connect(path, timeout=10.0)
+            # WAL lets connects read while the sync job writes.
+            self._db.execute('PRAGMA journal_mode=WAL')
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+
+    def _fresh_user(self, username):
+        """
+            The user's allowed flag if we have a fresh row for them,
+            else None.
+        """
+        row = self._db.execute('SELECT allowed, synced_at FROM users WHERE username = ?',
+                               (username,)).fetchone()
+        if row is None or row[1] < self._clock() - self.max_staleness:
+            return None
+        return bool(row[0])
+
+    def user_allowed(self, username):
+        """
+            (True, allowed) from a fresh row, or (False, None).
+        """
+        allowed = self._fresh_user(username)
+        if allowed is None:
+            return False, None
+        return True, allowed
+
+    def user_ips(self, username):
+        """
+            (True, [CIDR strings]) from a fresh row, or (False, None).
+        """
+        if self._fresh_user(username) is None:
+            return False, None
+        rows = self._db.execute('SELECT address FROM ips WHERE username = ? ORDER BY rowid',
+                                (username,)).fetchall()
+        return True, [row[0] for row in rows]
+
+    def user_acls(self, username):
+        """
+            (True, [(rule, address, portstring, description)]) from a
+            fresh row, or (False, None).
+        """
+        if self._fresh_user(username) is None:
+            return False, None
+        rows = self._db.execute('SELECT rule, address, portstring, description FROM acls '
+                                'WHERE username = ? ORDER BY rowid', (username,)).fetchall()
+        return True, rows
+
+    def store_user(self, username, allowed, ips, acls):
+        """
+            Replace everything we know about a user, in one transaction.
+            acls are objects with rule/address/portstring/description.
+        """
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO users (username, allowed, synced_at) '
+                             'VALUES (?, ?, ?)', (username, int(bool(allowed)), self._clock()))
+            self._db.execute('DELETE FROM ips WHERE username = ?', (username,))
+            self._db.execute('DELETE FROM acls WHERE username = ?', (username,))
+            self._db.executemany('INSERT INTO ips (username, address) VALUES (?, ?)',
+                                 [(username, address) for address in ips])
+            self._db.executemany('INSERT INTO acls (username, rule, address, portstring, '
+                                 'description) VALUES (?, ?, ?, ?, ?)',
+                                 [(username, acl.rule, acl.address, acl.portstring,
+                                   acl.description) for acl in acls])
+
+    def enroll_users(self, usernames):
+        """
+            Make sure these users are in the replica, so the sync job
+            will fetch them.  New users start out as never synced.
+        """
+        with self._db:
+            self._db.executemany('INSERT OR IGNORE INTO users (username) VALUES (?)',
+                                 [(username,) for username in usernames])
+
+    def mark_stale(self, usernames):
+        """
+            Treat what we hold for these users as too old to use, so that
+            their connects go to IAM and the sync job fetches them next.
+            Returns how many of them we held.
+        """
+        rows = [(username,) for username in usernames]
+        if not rows:
+            return 0
+        with self._db:
+            cursor = self._db.executemany('UPDATE users SET synced_at = 0 WHERE username = ?',
+                                          rows)
+        return cursor.rowcount
+
+    def stalest_users(self, limit):
+        """
+            The limit users who were synced longest ago.
+        """
+        rows = self._db.execute('SELECT username FROM users ORDER BY synced_at LIMIT ?',
+                                (limit,)).fetchall()
+        return [row[0] for row in rows]
+
+    def fresh_allowed_ips(self):
+        """
+            {username: [CIDR strings]} for every user with a fresh row
+            who is allowed to VPN.  For whole-organization jobs.
+        """
+        rows = self._db.execute('SELECT users.username, ips.address FROM users '
+                                'LEFT JOIN ips ON ips.username = users.username '
+                                'WHERE users.allowed AND users.synced_at >= ? '
+                                'ORDER BY users.username, ips.rowid',
+                                (self._clock() - self.max_staleness,)).fetchall()
+        result = {}
+        for username, address in rows:
+            addresses = result.setdefault(username, [])
+            if address is not None:
+                addresses.append(address)
+        return result
+
+    def counts(self):
+        """
+            How many users we hold, and how many are too stale to use.
+        """
+        total = self._db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        stale = self._db.execute('SELECT COUNT(*) FROM users WHERE synced_at < ?',
+                                 (self._clock() - self.max_staleness,)).fetchone()[0]
+        return {'users': total, 'stale': stale}
+
+    def close(self):
+        """
+            Close the database.
+        """
+        self._db.close()
+
+
+class ReplicaSearcher:
+    """
+        An IAMVPNLibrary stand-in that answers from the replica, and goes
+        to IAM (through connect(), called at most once) for anyone the
+        replica doesn't have fresh.  acl_factory rebuilds ACL objects
+        from replica rows.  With write_through, live answers for a user
+        are stored, so that the user is in the replica from then on.
+    """
+    def __init__(self, replica, connect, acl_factory, write_through=False):
+        self._replica = replica
+        self._connect = connect
+        self._acl_factory = acl_factory
+        self._write_through = write_through
+        self._searcher = None
+
+    def _live(self):
+        """ The real searcher, connecting the first time we need it. """
+        if self._searcher is None:
+            self._searcher = self._connect()
+        return self._searcher
+
+    def _live_call(self, method_name, *args):
+        """
+            Ask IAM; if we can't even connect, give the fail-closed answer.
+        """
+        try:
+            searcher = self._live()
+        except RuntimeError:
+            return fail_closed_value(method_name, *args)
+        return getattr(searcher, method_name)(*args)
+
+    def _replica_answer(self, lookup, username):
+        """
+            lookup(username) from the replica; a broken database counts as a miss.
+        """
+        try:
+            return lookup(username)
+        except sqlite3.Error:
+            return False, None
+
+    def user_allowed_to_vpn(self, username):
+        """ Check if a user is allowed to VPN in or not """
+        hit, allowed = self._replica_answer(self._replica.user_allowed, username)
+        if hit:
+            return allowed
+        failures_before = self._live_failures()
+        allowed = self._live_call('user_allowed_to_vpn', username)
+        if failures_before is not None and self._live_failures() == failures_before:
+            self._maybe_write_through(username, allowed)
+        return allowed
+
+    def verify_sudo_user(self, username_is, username_as=None):
+        """
+            Get the username that someone is effectively connecting as.
+            Nobody sudoing needs no lookup; a sudo always asks IAM.
+        """
+        if not username_as or username_as == username_is:
+            return username_is
+        return self._live_call('verify_sudo_user', username_is, username_as)
+
+    def get_allowed_vpn_ips(self, username):
+        """ Get the list of CIDR strings that a user has ACLs to """
+        hit, ips = self._replica_answer(self._replica.user_ips, username)
+        if hit:
+            return ips
+        return self._live_call('get_allowed_vpn_ips', username)
+
+    def get_allowed_vpn_acls(self, username):
+        """ Get the ACL objects for a user """
+        hit, rows = self._replica_answer(self._replica.user_acls, username)
+        if hit:
+            return [self._acl_factory(*row) for row in rows]
+        return self._live_call('get_allowed_vpn_acls', username)
+
+    def _live_failures(self):
+        """
+            How many made-up, fail-closed answers we've been given so far
+            (None if we couldn't connect at all).
+        """
+        try:
+            return getattr(self._live(), 'failed_calls', 0)
+        except RuntimeError:
+            return None
+
+    def _maybe_write_through(self, username, allowed):
+        """
+            Store a user we just looked up live, if we're writing through.
+            The replica being unwritable must not break the connect.
+        """
+        if not self._write_through:
+            return
+        searcher = self._live()
+        failures_before = getattr(searcher, 'failed_calls', 0)
+        ips, acls = [], []
+        if allowed:
+            ips = searcher.get_allowed_vpn_ips(username)
+            acls = searcher.get_allowed_vpn_acls(username)
+        if getattr(searcher, 'failed_calls', 0) != failures_before:
+            # Don't store made-up, fail-closed answers.
+            return
+        try:
+            self._replica.store_user(username, allowed, ips, acls)
+        except sqlite3.Error:
+            pass
+
+
+def sync_users(replica, searcher, usernames):
+    """
+        Fetch these users from IAM and store them.  A user whose lookup
+        fails keeps their old row (which will go stale if this persists).
+        Returns (synced, failed) counts.
+    """
+    synced = failed = 0
+    for username in usernames:
+        failures_before = getattr(searcher, 'failed_calls', 0)
+        try:
+            allowed = searcher.user_allowed_to_vpn(username)
+            ips, acls = [], []
+            if allowed:
+                ips = searcher.get_allowed_vpn_ips(username)
+                acls = searcher.get_allowed_vpn_acls(username)
+        except Exception:  # pylint: disable=broad-except
+            failed += 1
+            continue
+        if getattr(searcher, 'failed_calls', 0) != failures_before:
+            failed += 1
+            continue
+        replica.store_user(username, allowed, ips, acls)
+        synced += 1
+    return synced, failed
+
+
+def sync_work(argv):
+    """
+        One sync run (or a loop of them): enroll any listed users, then
+        refresh the stalest batch.  Returns True if IAM was reachable.
+    """
+    parser = ArgumentParser(description='Sync the local VPN ACL replica from IAM')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file (with an [acl-replica] section)',
+                        dest='conffile', default=None)
+    parser.add_argument('--users-file', type=str, required=False, default=None,
+                        help='File of usernames, one per line, to keep in the replica')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='How many users to refresh per run')
+    parser.add_argument('--loop', action='store_true',
+                        help='Keep syncing, every --interval seconds')
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help='Seconds between runs, with --loop')
+    args = parser.parse_args(argv[1:])
+
+    configure_iam(args.conffile)
+    settings = replica_settings(args.conffile)
+    if settings is None:
+        print(f'{args.conffile} has no [acl-replica] path')
+        return False
+    replica = ACLReplica(settings['path'], max_staleness=settings['max-staleness'])
+    try:
+        while True:
+            if args.users_file is not None:
+                with open(args.users_file, 'r', encoding='utf-8') as filehandle:
+                    replica.enroll_users(line.strip() for line in filehandle
+                                         if line.strip() and not line.startswith('#'))
+            try:
+                searcher = connect_iam_live()
+            except RuntimeError:
+                print('Could not connect to IAM')
+                synced, failed = 0, None
+            else:
+                synced, failed = sync_users(replica, searcher,
+                                            replica.stalest_users(args.batch))
+            counts = replica.counts()
+            print(f'synced {synced}, failed {failed}, '
+                  f'{counts["users"]} users, {counts["stale"]} stale')
+            if not args.loop:
+                return failed is not None
+            time.sleep(args.interval)
+    finally:
+        replica.close()
+
+
+def sync_main():
+    """ Interface to the outside """
+    if sync_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sync_main()
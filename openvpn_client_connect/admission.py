@@ -0,0 +1,133 @@
+"""
+    Admission control for the service mode.
+
+    When a VPN server restarts, every client comes back at once.  If we let
+    all of those connects hit IAM together, IAM falls over and everyone
+    times out.  Instead, we cap how many IAM-backed connects are in flight,
+    queue a bounded number of the rest, and turn away anyone whose deadline
+    we can already see we won't meet.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import sys
+import asyncio
+import contextlib
+sys.dont_write_bytecode = True
+
+__all__ = ['AdmissionController', 'AdmissionRejected']
+
+
+class AdmissionRejected(Exception):
+    """
+        Raised when a connect is turned away.  reason is one of
+        'queue_full', 'deadline' or 'timeout'.
+    """
+    def __init__(self, reason):
+        super().__init__(f'connect rejected: {reason}')
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+        A concurrency limiter with a bounded wait queue.
+        Use it as:
+            async with controller.admit(deadline):
+                ... do the IAM-backed work ...
+        where deadline is in event-loop time (loop.time()).
+    """
+    # How much weight a new service time gets in our running estimate.
+    _EWMA_WEIGHT = 0.2
+
+    def __init__(self, max_in_flight=32, max_queue=256, initial_service_seconds=0.0):
+        """
+            max_in_flight: how many admitted connects may run at once.
+            max_queue: how many more may wait for a slot.
+            initial_service_seconds: our guess at how long a connect takes,
+                until we've seen some real ones.
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.service_seconds = initial_service_seconds
+        self._semaphore = None
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.stats = {
+            'admitted': 0,
+            'rejected': {'queue_full': 0, 'deadline': 0, 'timeout': 0},
+            'queue_depth_peak': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def _reject(self, reason):
+        """
+            Count and raise a rejection.
+        """
+        self.stats['rejected'][reason] += 1
+        raise AdmissionRejected(reason)
+
+    def _record_service_time(self, elapsed):
+        """
+            Fold one connect's duration into our estimate.
+        """
+        self.service_seconds += self._EWMA_WEIGHT * (elapsed - self.service_seconds)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, deadline):
+        """
+            Wait for a slot, or raise AdmissionRejected.
+        """
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None:
+            # Made here, not in __init__, so that it's bound to the running loop.
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        arrived = loop.time()
+        if deadline - arrived < self.service_seconds:
+            # Even with a free slot right now, we wouldn't make it.
+            self._reject('deadline')
+        if self._semaphore.locked():
+            if self.queue_depth >= self.max_queue:
+                self._reject('queue_full')
+            self.queue_depth += 1
+            self.stats['queue_depth_peak'] = max(self.stats['queue_depth_peak'],
+                                                 self.queue_depth)
+            try:
+                # Stop waiting once there's no longer time to do the work.
+                patience = deadline - loop.time() - self.service_seconds
+                await asyncio.wait_for(self._semaphore.acquire(), max(0, patience))
+            except asyncio.TimeoutError:
+                self._reject('timeout')
+            finally:
+                self.queue_depth -= 1
+        else:
+            await self._semaphore.acquire()
+        started = loop.time()
+        waited = started - arrived
+        self.stats['admitted'] += 1
+        self.stats['wait_seconds_total'] += waited
+        self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
+        self.in_flight += 1
+        try:
+            yield waited
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            self._record_service_time(loop.time() - started)
+
+    def snapshot(self):
+        """
+            A point-in-time copy of our counters, for reporting.
+        """
+        snap = dict(self.stats)
+        snap['rejected'] = dict(self.stats['rejected'])
+        snap['in_flight'] = self.in_flight
+        snap['queue_depth'] = self.queue_depth
+        snap['service_seconds_estimate'] = self.service_seconds
+        return snap
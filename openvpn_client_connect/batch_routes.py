@@ -0,0 +1,307 @@
+"""
+    Route computation for a whole organization at once.
+
+    Audit and precompute jobs want everyone's routes, and doing that one
+    user at a time means a loop of netaddr calls per ACL.  This engine
+    turns every user's ACLs into NumPy arrays of integer start and end
+    addresses and does what GetUserRoutes.build_user_routes does --
+    drop the ACLs that FREE_ROUTES or COMPREHENSIVE_OFFICE_ROUTES cover,
+    then merge what's left with FREE_ROUTES -- across all users in a
+    handful of array operations.  The answers are the same as the
+    per-user path's, route for route.
+
+    IPv4 is vectorized.  IPv6 ACLs are rare, and 128-bit addresses don't
+    fit NumPy integers, so they go through netaddr per user.
+
+    NumPy is an optional dependency: pip install openvpn-client-connect[batch].
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import sys
+import json
+from argparse import ArgumentParser
+from netaddr import IPNetwork, cidr_merge
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+from openvpn_client_connect.per_user_configs import GetUserRoutes, replica_settings
+sys.dont_write_bytecode = True
+
+__all__ = ['BatchRouteEngine']
+
+# Sorting everyone's ranges in one go needs each user's addresses kept
+# apart from the next user's: user N's addresses are offset by N << 33.
+_USER_SHIFT = 33
+
+
+def _covered(first, last, routes):
+    """
+        Which of the ranges first[i]..last[i] lie inside one of routes
+        (IPv4 IPNetworks), as a boolean array.
+    """
+    if not routes:
+        return numpy.zeros(first.shape, dtype=bool)
+    route_first = numpy.array([route.first for route in routes], dtype=numpy.int64)
+    route_last = numpy.array([route.last for route in routes], dtype=numpy.int64)
+    inside = ((route_first[None, :] <= first[:, None]) &
+              (last[:, None] <= route_last[None, :]))
+    return inside.any(axis=1)
+
+
+def _floor_log2(values):
+    """
+        floor(log2(v)) for positive integers below 2**53, exactly.
+    """
+    return numpy.frexp(values.astype(numpy.float64))[1].astype(numpy.int64) - 1
+
+
+def _ranges_to_cidrs(group, start, end):
+    """
+        Split each inclusive range start[i]..end[i] into the fewest
+        IPv4 CIDR blocks, as netaddr does.
+        Returns (group, block start, prefix length) arrays, ordered by
+        group and then address.
+    """
+    out_group, out_start, out_prefix = [], [], []
+    while start.size:
+        length = end - start + 1
+        # The biggest block that both starts at 'start' and fits.
+        alignment = numpy.where(start == 0, 1 << 32, start & -start)
+        block = numpy.minimum(alignment, 1 << _floor_log2(length))
+        out_group.append(group)
+        out_start.append(start)
+        out_prefix.append(32 - _floor_log2(block))
+        start = start + block
+        more = start <= end
+        group, start, end = group[more], start[more], end[more]
+    if not out_group:
+        return (numpy.zeros(0, dtype=numpy.int64),) * 3
+    group = numpy.concatenate(out_group)
+    start = numpy.concatenate(out_start)
+    prefix = numpy.concatenate(out_prefix)
+    order = numpy.lexsort((start, group))
+    return group[order], start[order], prefix[order]
+
+
+class BatchRouteEngine:
+    """
+        Everyone's routes under one GetUserRoutes config.
+    """
+    def __init__(self, user_routes):
+        """
+            user_routes is the GetUserRoutes whose config we follow.
+        """
+        if numpy is None:  # pragma: no cover
+            raise RuntimeError('batch route computation needs numpy: '
+                               'pip install openvpn-client-connect[batch]')
+        self.user_routes = user_routes
+        config = user_routes.config
+        self._free = config['FREE_ROUTES']
+        self._office = config['COMPREHENSIVE_OFFICE_ROUTES']
+        self._free_v4 = [route for route in self._free if route.version == 4]
+        self._free_v6 = [route for route in self._free if route.version == 6]
+        self._office_v4 = [route for route in self._office if route.version == 4]
+        # The same handful of routes turn up for thousands of users.
+        self._networks = {}
+
+    def _network(self, start, prefix):
+        """ A (shared) IPNetwork for an IPv4 block """
+        key = (start, prefix)
+        network = self._networks.get(key)
+        if network is None:
+            network = self._networks[key] = IPNetwork((start, prefix), version=4)
+        return network
+
+    def nonoffice_routes(self, users_acls):
+        """
+            users_acls maps username to their ACL strings (as from
+            get_allowed_vpn_ips).  Returns a dict mapping each username
+            to what GetUserRoutes.build_nonoffice_routes would say,
+            except that users with no ACLs get [].
+        """
+        return self._routes(users_acls, [])
+
+    def build_routes(self, users_acls, from_office=None, client_ip=None, server_ip=None):
+        """
+            Everyone's full routes, as GetUserRoutes.build_routes_from_acls
+            gives them, for one connecting situation.
+        """
+        office_routes = self.user_routes.get_office_routes(from_office, client_ip, server_ip)
+        if all(route.version == 4 for route in office_routes):
+            return self._routes(users_acls, office_routes)
+        return {user: sorted(routes + office_routes) if routes else []
+                for user, routes in self.nonoffice_routes(users_acls).items()}
+
+    def _routes(self, users_acls, unmerged):
+        """
+            Everyone's non-office routes, plus (for everyone with ACLs)
+            the IPv4 routes in unmerged, which are sorted in but not merged.
+        """
+        usernames = [user for user, acls in users_acls.items() if acls]
+        # Parse each distinct ACL once; teams share most of theirs.
+        acl_index = {}
+        row_user, row_acl = [], []
+        for user_num, user in enumerate(usernames):
+            for aclstring in users_acls[user]:
+                row_user.append(user_num)
+                row_acl.append(acl_index.setdefault(aclstring, len(acl_index)))
+        networks = [IPNetwork(aclstring) for aclstring in acl_index]
+        is_v4 = numpy.array([network.version == 4 for network in networks], dtype=bool)
+        first = numpy.array([network.first if network.version == 4 else 0
+                             for network in networks], dtype=numpy.int64)
+        last = numpy.array([network.last if network.version == 4 else 0
+                            for network in networks], dtype=numpy.int64)
+        # The subtractions: an ACL that a free or office route covers goes.
+        keep = is_v4 & ~_covered(first, last, self._free_v4) & \
+            ~_covered(first, last, self._office_v4)
+        row_user = numpy.array(row_user, dtype=numpy.int64)
+        row_acl = numpy.array(row_acl, dtype=numpy.int64)
+        kept = keep[row_acl] if row_acl.size else numpy.zeros(0, dtype=bool)
+
+        # Everyone with ACLs also gets the free routes.
+        everyone = numpy.arange(len(usernames), dtype=numpy.int64)
+        free_first = numpy.array([route.first for route in self._free_v4], dtype=numpy.int64)
+        free_last = numpy.array([route.last for route in self._free_v4], dtype=numpy.int64)
+        user = numpy.concatenate([row_user[kept], numpy.repeat(everyone, len(self._free_v4))])
+        start = numpy.concatenate([first[row_acl[kept]], numpy.tile(free_first, len(usernames))])
+        end = numpy.concatenate([last[row_acl[kept]], numpy.tile(free_last, len(usernames))])
+        # Where each row came from, as an index into originals.
+        originals = networks + self._free_v4 + list(unmerged)
+        source = numpy.concatenate([row_acl[kept], numpy.tile(
+            len(networks) + numpy.arange(len(self._free_v4), dtype=numpy.int64),
+            len(usernames))])
+
+        # The merge: sort by user then address, and start a new range
+        # wherever an address isn't touching anything before it.
+        order = numpy.lexsort((start, user))
+        user = user[order]
+        offset = user << _USER_SHIFT
+        start = start[order] + offset
+        reach = numpy.maximum.accumulate(end[order] + offset)
+        new_range = numpy.ones(user.shape, dtype=bool)
+        new_range[1:] = start[1:] > reach[:-1] + 1
+        firsts = numpy.flatnonzero(new_range)
+        range_user = user[firsts]
+        range_start = start[firsts] - (range_user << _USER_SHIFT)
+        range_end = numpy.maximum.reduceat(reach, firsts) - (range_user << _USER_SHIFT) \
+            if firsts.size else range_start
+        # Like cidr_merge, a range made of just one route is that route,
+        # as given (host bits and all); only merged ranges are re-split.
+        single = numpy.diff(numpy.append(firsts, user.size)) == 1
+        block_user, block_start, block_prefix = _ranges_to_cidrs(
+            range_user[~single], range_start[~single], range_end[~single])
+        single_source = source[order[firsts[single]]]
+        extra_user = numpy.repeat(everyone, len(unmerged))
+        extra_source = numpy.tile(len(networks) + len(self._free_v4) +
+                                  numpy.arange(len(unmerged), dtype=numpy.int64),
+                                  len(usernames))
+
+        # Put everything in IPNetwork sort order: by address, then
+        # prefix length, then host bits.
+        v4_originals = [network if network.version == 4 else None for network in originals]
+        orig_first = numpy.array([network.first if network else 0
+                                  for network in v4_originals], dtype=numpy.int64)
+        orig_prefix = numpy.array([network.prefixlen if network else 0
+                                   for network in v4_originals], dtype=numpy.int64)
+        orig_host = numpy.array([network.value - network.first if network else 0
+                                 for network in v4_originals], dtype=numpy.int64)
+        out_source = numpy.concatenate([single_source, extra_source,
+                                        numpy.full(block_user.size, -1, dtype=numpy.int64)])
+        out_user = numpy.concatenate([range_user[single], extra_user, block_user])
+        out_start = numpy.concatenate([orig_first[single_source], orig_first[extra_source],
+                                       block_start])
+        out_prefix = numpy.concatenate([orig_prefix[single_source], orig_prefix[extra_source],
+                                        block_prefix])
+        out_host = numpy.concatenate([orig_host[single_source], orig_host[extra_source],
+                                      numpy.zeros(block_user.size, dtype=numpy.int64)])
+        out_order = numpy.lexsort((out_host, out_prefix, out_start, out_user))
+
+        results = {user: [] for user in users_acls}
+        for user_num, block, prefix, original in zip(out_user[out_order].tolist(),
+                                                     out_start[out_order].tolist(),
+                                                     out_prefix[out_order].tolist(),
+                                                     out_source[out_order].tolist()):
+            if original < 0:
+                network = self._network(block, prefix)
+            else:
+                network = originals[original]
+            results[usernames[user_num]].append(network)
+        self._add_v6_routes(results, usernames, users_acls, networks, acl_index)
+        return results
+
+    def _add_v6_routes(self, results, usernames, users_acls, networks, acl_index):
+        """
+            The IPv6 part of everyone's routes, done per user with netaddr.
+            IPv6 sorts after IPv4, so it goes on the end.
+        """
+        v6_acls = {acl_num for acl_num, network in enumerate(networks) if network.version == 6}
+        if not v6_acls and not self._free_v6:
+            return
+        route_subtraction = self.user_routes.route_subtraction
+        free_only = sorted(cidr_merge(self._free_v6))
+        for user in usernames:
+            user_v6 = [networks[acl_index[aclstring]] for aclstring in users_acls[user]
+                       if acl_index[aclstring] in v6_acls]
+            if not user_v6:
+                results[user] += free_only
+                continue
+            user_v6 = route_subtraction(user_v6, self._free)
+            user_v6 = route_subtraction(user_v6, self._office)
+            results[user] += sorted(cidr_merge(self._free_v6 + user_v6))
+
+
+def batch_work(argv):
+    """
+        Print everyone's routes as JSON.  Return True on success.
+    """
+    parser = ArgumentParser(description='Compute routes for many users at once')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file', dest='conffile', default=None)
+    parser.add_argument('--acls-file', type=str, required=False, default=None,
+                        help='JSON object of username to ACL strings '
+                             '(default: the fresh, allowed users in the ACL replica)')
+    parser.add_argument('--office', type=str, required=False, default=None,
+                        help='Compute routes as if connecting from this office')
+    args = parser.parse_args(argv[1:])
+
+    if args.acls_file is not None:
+        with open(args.acls_file, 'r', encoding='utf-8') as filehandle:
+            users_acls = json.load(filehandle)
+    else:
+        settings = replica_settings(args.conffile)
+        if settings is None:
+            print(f'{args.conffile} has no [acl-replica] path; use --acls-file', file=sys.stderr)
+            return False
+        # pylint: disable=import-outside-toplevel
+        from openvpn_client_connect.acl_replica import ACLReplica
+        replica = ACLReplica(settings['path'], max_staleness=settings['max-staleness'],
+                             readonly=True)
+        try:
+            users_acls = replica.fresh_allowed_ips()
+        finally:
+            replica.close()
+    engine = BatchRouteEngine(GetUserRoutes(args.conffile, connect=False))
+    routes = engine.build_routes(users_acls, from_office=args.office)
+    json.dump({user: [str(route) for route in user_routes]
+               for user, user_routes in routes.items()}, sys.stdout, indent=1, sort_keys=True)
+    print()
+    return True
+
+
+def batch_main():
+    """ Interface to the outside """
+    if batch_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    batch_main()
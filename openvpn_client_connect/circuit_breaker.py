@@ -0,0 +1,190 @@
+"""
+    A circuit breaker to put in front of IAM.
+
+    When IAM is having a bad day, every connecting client would otherwise
+    wait out the full connect/query timeout before failing.  After enough
+    failures (or slow calls) in a row, the breaker opens and we fail closed
+    immediately.  After a cool-off, one caller is let through as a probe;
+    if it succeeds, the breaker closes again.
+
+    The state can live in memory (shared by everything in one process) or
+    in a small state file, so that the many short-lived client-connect
+    scripts on one server can share it.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import json
+import time
+import fcntl
+import threading
+sys.dont_write_bytecode = True
+
+__all__ = ['CircuitBreaker', 'CircuitOpenError']
+
+
+class CircuitOpenError(RuntimeError):
+    """
+        Raised instead of calling IAM, when the breaker is open.
+        This is a RuntimeError because that is what IAMVPNLibrary raises
+        when it can't connect, and we want the same handling.
+    """
+
+
+class CircuitBreaker:
+    """
+        closed: calls go through, and we count consecutive failures.
+        open: calls are refused until reset_timeout has passed.
+        half-open: one probe call is allowed through to test the waters.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 slow_call_seconds=None, state_file=None):
+        """
+            failure_threshold: consecutive failures before we open.
+            reset_timeout: seconds to stay open before probing.
+            slow_call_seconds: a call that succeeds but takes longer than
+                this counts as a failure.  None disables that.
+            state_file: if set, share state through this file.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_seconds = slow_call_seconds
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._state = self._default_state()
+
+    @classmethod
+    def _default_state(cls):
+        """
+            What a never-used breaker looks like.
+        """
+        return {'state': cls.CLOSED, 'failures': 0, 'changed_at': 0.0}
+
+    def _read_state_file(self, filehandle):
+        """
+            Load the shared state.  An empty or mangled file is a closed
+            breaker: we'd rather try IAM than lock everyone out.
+        """
+        filehandle.seek(0)
+        try:
+            state = json.loads(filehandle.read())
+        except ValueError:
+            return self._default_state()
+        if not isinstance(state, dict) or state.get('state') not in (
+                self.CLOSED, self.OPEN, self.HALF_OPEN):
+            return self._default_state()
+        return state
+
+    def _update(self, mutator):
+        """
+            Apply mutator to our state under a lock, and return its result.
+            With a state file, that's a file lock and a read/write cycle.
+            If the state file can't be used, we keep the state in memory,
+            as if there were no state file: a broken breaker setup
+            shouldn't stop people connecting.
+        """
+        with self._lock:
+            if self.state_file is None:
+                return mutator(self._state)
+            try:
+                fdesc = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                return mutator(self._state)
+            with os.fdopen(fdesc, 'r+', encoding='utf-8') as filehandle:
+                try:
+                    fcntl.flock(filehandle, fcntl.LOCK_EX)
+                    state = self._read_state_file(filehandle)
+                except OSError:
+                    return mutator(self._state)
+                before = dict(state)
+                retval = mutator(state)
+                if state != before:
+                    try:
+                        filehandle.seek(0)
+                        filehandle.truncate()
+                        filehandle.write(json.dumps(state))
+                        filehandle.flush()
+                    except OSError:
+                        # The next reader sees a mangled file: a closed breaker.
+                        pass
+                self._state = state
+            return retval
+
+    @property
+    def state(self):
+        """
+            The current state name (closed/open/half-open).
+        """
+        return self._update(lambda state: state['state'])
+
+    def allow_request(self):
+        """
+            Ask if a call may go to IAM right now.
+            If this returns True from half-open, you are the probe, and you
+            must report back via record_success/record_failure.
+        """
+        def _allow(state):
+            now = time.time()
+            if state['state'] == self.CLOSED:
+                return True
+            if now - state['changed_at'] < self.reset_timeout:
+                # Either still cooling off, or someone else is probing.
+                return False
+            # Cool-off is over (or the last probe never reported back):
+            state['state'] = self.HALF_OPEN
+            state['changed_at'] = now
+            return True
+        return self._update(_allow)
+
+    def record_success(self, elapsed=0.0):
+        """
+            Report a call that worked.  A slow success is a failure.
+        """
+        if self.slow_call_seconds is not None and elapsed > self.slow_call_seconds:
+            self.record_failure()
+            return
+
+        def _success(state):
+            state['state'] = self.CLOSED
+            state['failures'] = 0
+        self._update(_success)
+
+    def record_failure(self):
+        """
+            Report a call that failed.
+        """
+        def _failure(state):
+            state['failures'] += 1
+            if (state['state'] == self.HALF_OPEN or
+                    state['failures'] >= self.failure_threshold):
+                state['state'] = self.OPEN
+                state['changed_at'] = time.time()
+        self._update(_failure)
+
+    def call(self, func, *args, **kwargs):
+        """
+            Run func through the breaker.  Raises CircuitOpenError if
+            we're refusing calls; otherwise returns/raises whatever func does.
+        """
+        if not self.allow_request():
+            raise CircuitOpenError('IAM circuit breaker is open')
+        started = time.monotonic()
+        try:
+            retval = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success(time.monotonic() - started)
+        return retval
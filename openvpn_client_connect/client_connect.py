@@ -74,6 +74,7 @@ class ClientConnect:
         """
         self.configfile = conf_file
         _config = self._ingest_config_from_file(conf_file)
+        openvpn_client_connect.per_user_configs.configure_iam(conf_file)
 
         self.dns_servers = []
         self.search_domains = []
@@ -143,6 +144,34 @@ class ClientConnect:
             if not isinstance(self.routes_6, list):
                 self.routes_6 = []
 
+        self._prerender_static_sections()
+
+    def _prerender_static_sections(self):
+        """
+            The DNS server, static route, and protocol lines depend only
+            on the config, so we format them once, here, rather than
+            on every connect.  The DNS lines go before the per-user lines
+            and the rest go after, so we also keep them as two text blocks
+            that a whole push file can be assembled from.
+        """
+        self._dns_server_lines = tuple(self._render_dns_server_lines())
+        self._static_route_lines = tuple(self._render_static_route_lines())
+        self._protocol_lines = tuple(self._render_protocol_lines())
+        self.push_block_head = ''.join(
+            f'{line}\n' for line in self._dns_server_lines)
+        self.push_block_tail = ''.join(
+            f'{line}\n' for line in self._static_route_lines + self._protocol_lines)
+
+    def render_push_block(self, user_lines):
+        """
+            Assemble the full text to hand to the client: the prerendered
+            config-only blocks around the per-user lines.  This is the
+            same text as joining build_lines' output, one line per line.
+        """
+        return ''.join((self.push_block_head,
+                        ''.join(f'{line}\n' for line in user_lines),
+                        self.push_block_tail))
+
     @staticmethod
     def _ingest_config_from_file(conf_file):
         """
@@ -247,6 +276,12 @@ class ClientConnect:
         """
             Return the push lines for a user to have DNS servers.
         """
+        return list(self._dns_server_lines)
+
+    def _render_dns_server_lines(self):
+        """
+            Format the DNS server push lines.
+        """
         return_lines = []
         for server in self.dns_servers:
             _line = f'push "dhcp-option DNS {server}"'
@@ -260,21 +295,21 @@ class ClientConnect:
             ... someday.
         """
         gusd = GetUserSearchDomains(self.configfile)
-        if gusd.iam_searcher:
-            effective_username = gusd.iam_searcher.verify_sudo_user(username_is, username_as)
-            domains = gusd.get_search_domains(effective_username)
-        else:
-            domains = []
-        return_lines = []
-        for server in domains:
-            _line = f'push "dhcp-option DOMAIN {server}"'
-            return_lines.append(_line)
-        return return_lines
+        if not gusd.iam_searcher:
+            return []
+        effective_username = gusd.iam_searcher.verify_sudo_user(username_is, username_as)
+        return gusd.get_search_domain_lines(gusd.get_user_groups(effective_username))
 
     def get_static_route_lines(self):
         """
             Return the push lines for all static-defined routes.
         """
+        return list(self._static_route_lines)
+
+    def _render_static_route_lines(self):
+        """
+            Format the static route push lines.
+        """
         return_lines = []
         for route_line in self.routes_4:
             _line = f'push "route {route_line}"'
@@ -284,45 +319,62 @@ class ClientConnect:
             return_lines.append(_line)
         return return_lines
 
-    def get_dynamic_route_lines(self, username_is, username_as=None, client_ip=None):
+    def get_dynamic_route_lines(self, username_is, username_as=None, client_ip=None,
+                                server_ip=None):
         """
             Return the push lines for dynamic/per-user routes.
         """
         return_lines = []
         if self.office_ip_mapping:
-            user_at_office = None
-            # Is this an office connection?
-            if client_ip is not None:
-                client_ip_cidr = netaddr.IPNetwork(client_ip)
-                for site, site_ip in self.office_ip_mapping.items():
-                    if isinstance(site_ip, list):
-                        # site_ip is a list of possible IPs for the office
-                        site_list = site_ip
-                    else:
-                        # site_ip is not a list, and thus is (assumed)
-                        # a string of the office IP
-                        site_list = [site_ip]
-                    for addr in site_list:
-                        cidr = netaddr.IPNetwork(addr)
-                        if client_ip_cidr in cidr:
-                            user_at_office = site
-                            break
+            user_at_office = self.get_client_office(client_ip)
 
             gur = GetUserRoutes(self.configfile)
             if gur.iam_searcher:
                 effective_username = gur.iam_searcher.verify_sudo_user(username_is, username_as)
                 user_routes = gur.build_user_routes(effective_username,
                                                     user_at_office,
-                                                    client_ip)
+                                                    client_ip, server_ip)
             else:
                 user_routes = []
 
-            for net_obj in user_routes:
-                # For one entry per line, remove the trailing comma
-                _base = 'push "route {network} {netmask}"'
-                _line = _base.format(network=net_obj.network,
-                                     netmask=net_obj.netmask)
-                return_lines.append(_line)
+            return_lines = self.format_route_lines(user_routes)
+        return return_lines
+
+    def get_client_office(self, client_ip):
+        """
+            Return the name of the office that client_ip is coming from,
+            or None if it's not an office connection.
+        """
+        user_at_office = None
+        if client_ip is not None:
+            client_ip_cidr = netaddr.IPNetwork(client_ip)
+            for site, site_ip in self.office_ip_mapping.items():
+                if isinstance(site_ip, list):
+                    # site_ip is a list of possible IPs for the office
+                    site_list = site_ip
+                else:
+                    # site_ip is not a list, and thus is (assumed)
+                    # a string of the office IP
+                    site_list = [site_ip]
+                for addr in site_list:
+                    cidr = netaddr.IPNetwork(addr)
+                    if client_ip_cidr in cidr:
+                        user_at_office = site
+                        break
+        return user_at_office
+
+    @staticmethod
+    def format_route_lines(user_routes):
+        """
+            Turn a list of IPNetwork objects into push lines.
+        """
+        return_lines = []
+        for net_obj in user_routes:
+            # For one entry per line, remove the trailing comma
+            _base = 'push "route {network} {netmask}"'
+            _line = _base.format(network=net_obj.network,
+                                 netmask=net_obj.netmask)
+            return_lines.append(_line)
         return return_lines
 
     def get_protocol_lines(self):
@@ -330,6 +382,12 @@ class ClientConnect:
             Return the push lines depending upon what openvpn protocol
             this instance is using.
         """
+        return list(self._protocol_lines)
+
+    def _render_protocol_lines(self):
+        """
+            Format the protocol-specific push lines.
+        """
         return_lines = []
         if self.proto == 'udp':
             # UDP does not send an explicit exit notification on
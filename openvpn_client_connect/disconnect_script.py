@@ -0,0 +1,45 @@
+"""
+    Script for openvpn's client-disconnect.
+    It closes the client's session in the session table, so that a quick
+    reconnect can reuse what client-connect pushed.  See session_table.
+"""
+import os
+import sys
+from argparse import ArgumentParser
+from openvpn_client_connect.session_table import session_table_from_config, session_key
+sys.dont_write_bytecode = True
+
+
+def main_work(argv):
+    """
+        Close the disconnecting client's session.
+        Return True on success (including when there's no session table:
+        then there's nothing to do), False upon failure.
+    """
+    parser = ArgumentParser(description='Args for client-disconnect')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    args = parser.parse_args(argv[1:])
+
+    if not os.environ.get('common_name') or not os.environ.get('trusted_ip'):
+        print('No common_name or trusted_ip environment variable provided.')
+        return False
+    sessions = session_table_from_config(args.conffile)
+    if sessions is None:
+        return True
+    sessions.close(session_key(args.conffile, os.environ))
+    # Disconnects are what tidy the table up.
+    sessions.prune()
+    return True
+
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
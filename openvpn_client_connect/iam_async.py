@@ -0,0 +1,221 @@
+"""
+    An asyncio-facing wrapper around the IAM calls we make.
+
+    iamvpnlibrary is a blocking library.  Anything long-lived that wants
+    to serve many connecting clients at once can't afford to have one slow
+    LDAP query stall everyone else, so here we push the blocking calls off
+    onto a bounded thread pool and put a deadline on each of them.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+#
+# Requires:
+# iamvpnlibrary
+
+import sys
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import iamvpnlibrary
+from openvpn_client_connect.per_user_configs import IAM_QUERY_METHODS, fail_closed_value
+from openvpn_client_connect.circuit_breaker import CircuitOpenError
+from openvpn_client_connect.tracing import current_trace
+sys.dont_write_bytecode = True
+
+__all__ = ['AsyncIAMAdapter']
+
+
+class AsyncIAMAdapter:
+    """
+        Run IAMVPNLibrary calls on a bounded executor, with a per-call
+        deadline.  The named query methods fail closed: a timeout, a
+        failure to reach IAM, or any other error gives the least-privilege
+        answer rather than an exception.  If you need to know that a call failed, use call().
+    """
+    def __init__(self, max_workers=8, timeout=5.0, searcher_factory=None,
+                 circuit_breaker=None):
+        """
+            max_workers bounds how many blocking IAM calls can be in
+            flight at once.  timeout is the default per-call deadline,
+            in seconds (None means wait forever).  circuit_breaker, if
+            given, is consulted before and told about every call.
+        """
+        self.timeout = timeout
+        self.circuit_breaker = circuit_breaker
+        self._searcher_factory = searcher_factory
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='iam')
+        self._searcher = None
+        self._searcher_lock = None
+        self._call_seconds = None
+        self._call_errors = None
+
+    def register_metrics(self, registry):
+        """
+            Record per-method call latency and errors into registry
+            (a MetricsRegistry).  Only the first registry sticks, so a
+            shared adapter isn't counted twice.
+        """
+        if self._call_seconds is not None:
+            return
+        self._call_seconds = registry.histogram(
+            'iam_call_seconds', 'Latency of completed IAM calls', ['method'])
+        self._call_errors = registry.counter(
+            'iam_call_errors_total', 'IAM calls that failed, by why', ['method', 'kind'])
+
+    def _record_error(self, method_name, kind):
+        """
+            Count one failed call, if we're keeping metrics.
+        """
+        if self._call_errors is not None:
+            self._call_errors.inc(method=method_name, kind=kind)
+
+    async def _run_blocking(self, func, timeout):
+        """
+            Run func on our executor, and wait no longer than timeout.
+            Note that a timed-out call keeps its worker thread until the
+            underlying library gives up; we just stop waiting for it.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, func)
+        return await asyncio.wait_for(future, timeout)
+
+    async def _get_searcher(self, timeout):
+        """
+            Build the IAMVPNLibrary object the first time we need it.
+            Construction connects to IAM, so it's blocking work too.
+        """
+        if self._searcher is not None:
+            return self._searcher
+        if self._searcher_lock is None:
+            self._searcher_lock = asyncio.Lock()
+        async with self._searcher_lock:
+            if self._searcher is None:
+                # IAMVPNLibrary is looked up at call time, so that it can be mocked.
+                factory = self._searcher_factory or iamvpnlibrary.IAMVPNLibrary
+                self._searcher = await self._run_blocking(factory, timeout)
+        return self._searcher
+
+    async def _ask_breaker(self, func, *args):
+        """
+            Run one of our circuit breaker's methods.  A breaker that shares
+            its state through a file locks and reads/writes that file, so
+            that's done on the loop's default executor: not on the loop,
+            where it would stall every other connect, and not on ours,
+            where it would queue behind the very IAM calls it's guarding.
+        """
+        if self.circuit_breaker.state_file is None:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args))
+
+    def _drop_searcher(self, searcher):
+        """
+            Forget a searcher that's let us down, so the next call builds
+            (and so reconnects) a fresh one.  A slow call alone doesn't
+            count, unless it's what tripped the breaker.  If someone has
+            already replaced it, leave theirs alone.
+        """
+        if self._searcher is searcher:
+            self._searcher = None
+
+    async def call(self, method_name, *args, timeout=None):
+        """
+            Make one IAM query.  This raises asyncio.TimeoutError if the
+            deadline passes, RuntimeError if IAM can't be reached (or the
+            circuit breaker is open), whatever the library raised if the
+            query failed, and CancelledError if our caller is cancelled.
+        """
+        if method_name not in IAM_QUERY_METHODS:
+            raise ValueError(f'{method_name} is not an IAM query we make')
+        if timeout is None:
+            timeout = self.timeout
+        breaker = self.circuit_breaker
+        if breaker is not None and not await self._ask_breaker(breaker.allow_request):
+            self._record_error(method_name, 'circuit_open')
+            raise CircuitOpenError('IAM circuit breaker is open')
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        trace = current_trace()
+        trace_started = time.perf_counter()
+        searcher = None
+        try:
+            searcher = await self._get_searcher(timeout)
+            remaining = timeout
+            if timeout is not None:
+                # The deadline covers the whole call, connecting included.
+                remaining = max(0, timeout - (loop.time() - started))
+            method = getattr(searcher, method_name)
+            retval = await self._run_blocking(functools.partial(method, *args), remaining)
+        except Exception as err:
+            # (A CancelledError isn't an Exception: our caller giving up
+            # says nothing about IAM's health.)
+            kind = 'timeout' if isinstance(err, asyncio.TimeoutError) else 'error'
+            self._record_error(method_name, kind)
+            trace.add_span(method_name, trace_started, time.perf_counter() - trace_started,
+                           kind)
+            tripped = False
+            if breaker is not None:
+                await self._ask_breaker(breaker.record_failure)
+                tripped = await self._ask_breaker(lambda: breaker.state) == breaker.OPEN
+            if searcher is not None and (kind == 'error' or tripped):
+                self._drop_searcher(searcher)
+            raise
+        elapsed = loop.time() - started
+        trace.add_span(method_name, trace_started, time.perf_counter() - trace_started)
+        if breaker is not None:
+            await self._ask_breaker(breaker.record_success, elapsed)
+        if self._call_seconds is not None:
+            self._call_seconds.observe(elapsed, method=method_name)
+        return retval
+
+    async def _call_fail_closed(self, method_name, *args, timeout=None):
+        """
+            call(), but turning a failure into the least-privilege answer.
+        """
+        try:
+            return await self.call(method_name, *args, timeout=timeout)
+        except Exception:  # pylint: disable=broad-except
+            # Whatever went wrong, nobody gets more than we know they should.
+            return fail_closed_value(method_name, *args)
+
+    async def user_allowed_to_vpn(self, userid, timeout=None):
+        """
+            Check if a user is allowed to VPN in or not
+        """
+        return await self._call_fail_closed('user_allowed_to_vpn', userid,
+                                            timeout=timeout)
+
+    async def verify_sudo_user(self, username_is, username_as=None, timeout=None):
+        """
+            Get the username that someone is effectively connecting as.
+        """
+        return await self._call_fail_closed('verify_sudo_user', username_is, username_as,
+                                            timeout=timeout)
+
+    async def get_allowed_vpn_ips(self, user_string, timeout=None):
+        """
+            Get the list of CIDR strings that a user has ACLs to.
+        """
+        return await self._call_fail_closed('get_allowed_vpn_ips', user_string,
+                                            timeout=timeout)
+
+    async def get_allowed_vpn_acls(self, user_string, timeout=None):
+        """
+            Get the ACL objects for a user.
+        """
+        return await self._call_fail_closed('get_allowed_vpn_acls', user_string,
+                                            timeout=timeout)
+
+    def close(self):
+        """
+            Stop the executor.  Calls that are still queued are dropped.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,228 @@
+"""
+    A client for openvpn's management interface.
+
+    openvpn (with --management) listens on a unix socket or a localhost
+    TCP port and speaks a line-based protocol: we send a command, and it
+    answers 'SUCCESS: ...', 'ERROR: ...', or for some commands a block of
+    lines ending in 'END'.  Lines starting with '>' are notifications
+    that can arrive at any time, in between the answers.  openvpn only
+    lets one management client in at a time, so don't hold a connection
+    open longer than the work needs.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import re
+import sys
+import socket
+from collections import namedtuple, deque
+sys.dont_write_bytecode = True
+
+__all__ = ['ManagementClient', 'ManagementError', 'ManagedClient', 'client_ip_of',
+           'tcp_address']
+
+# One connected client, from 'status 3'.
+ManagedClient = namedtuple('ManagedClient', ['cid', 'common_name', 'username',
+                                             'real_address', 'client_ip'])
+# How many unread notifications we keep.
+_NOTIFICATION_BACKLOG = 1000
+# What can come before the address in a 'Real Address'.
+_PROTOCOL_PREFIX = re.compile(r'^(udp|tcp)[46]?(-server|-client)?:')
+
+
+class ManagementError(Exception):
+    """ The management interface said no, or went away """
+
+
+def tcp_address(address):
+    """
+        (host, port) if a management address is host:port, or None if
+        it's a unix socket path.
+    """
+    match = re.match(r'^([^/]+):(\d+)$', address)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def client_ip_of(real_address):
+    """
+        The address part of a 'Real Address' from 'status 3', which can
+        look like 1.2.3.4:5555, udp4:1.2.3.4:5555 or [2001:db8::1]:5555.
+    """
+    address = _PROTOCOL_PREFIX.sub('', real_address)
+    if address.startswith('['):
+        return address[1:address.find(']')]
+    if ':' in address:
+        return address.rsplit(':', 1)[0]
+    return address
+
+
+class ManagementClient:
+    """
+        One connection to one openvpn's management interface.
+    """
+    def __init__(self, address, password=None, timeout=10.0):
+        """
+            address is a unix socket path, or host:port.
+        """
+        self.address = address
+        self.password = password
+        self.timeout = timeout
+        self.notifications = deque(maxlen=_NOTIFICATION_BACKLOG)
+        self._sock = None
+        self._buffer = b''
+
+    def connect(self):
+        """
+            Connect, and log in if there's a password.
+            Raises ManagementError if we can't.
+        """
+        host_port = tcp_address(self.address)
+        try:
+            if host_port is not None:
+                self._sock = socket.create_connection(host_port, timeout=self.timeout)
+            else:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.settimeout(self.timeout)
+                self._sock.connect(self.address)
+        except OSError as err:
+            self.close()
+            raise ManagementError(f'cannot connect to {self.address}: {err}') from err
+        if self.password is not None:
+            # The prompt has no newline after it.
+            while b'ENTER PASSWORD:' not in self._buffer:
+                self._fill()
+            self._buffer = self._buffer.split(b'ENTER PASSWORD:', 1)[1]
+            self.send(self.password)
+            line = self._reply_line()
+            if not line.startswith('SUCCESS:'):
+                self.close()
+                raise ManagementError('management password was not accepted')
+        return self
+
+    def close(self):
+        """
+            Hang up.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _fill(self):
+        """
+            Read what there is into our buffer.
+        """
+        try:
+            data = self._sock.recv(65536)
+        except OSError as err:
+            raise ManagementError(f'lost the management interface: {err}') from err
+        if not data:
+            raise ManagementError('the management interface hung up')
+        self._buffer += data
+
+    def send(self, line):
+        """
+            Send one line.
+        """
+        try:
+            self._sock.sendall(line.encode('utf-8') + b'\n')
+        except OSError as err:
+            raise ManagementError(f'lost the management interface: {err}') from err
+
+    def read_line(self):
+        """
+            The next line from openvpn, whatever it is.
+        """
+        while b'\n' not in self._buffer:
+            self._fill()
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode('utf-8', 'replace').rstrip('\r')
+
+    def _reply_line(self):
+        """
+            The next line that isn't a notification.  Notifications are
+            kept in self.notifications for whoever wants them.
+        """
+        while True:
+            line = self.read_line()
+            if line.startswith('>'):
+                self.notifications.append(line)
+                continue
+            return line
+
+    def command(self, command):
+        """
+            Run a command with a one-line answer, and return what came
+            after 'SUCCESS:'.  Raises ManagementError on 'ERROR:'.
+        """
+        self.send(command)
+        line = self._reply_line()
+        if line.startswith('SUCCESS:'):
+            return line[len('SUCCESS:'):].strip()
+        if line.startswith('ERROR:'):
+            raise ManagementError(line[len('ERROR:'):].strip())
+        raise ManagementError(f'unexpected answer to {command.split()[0]}: {line!r}')
+
+    def command_lines(self, command):
+        """
+            Run a command that answers with lines up to 'END', and
+            return those lines.
+        """
+        self.send(command)
+        lines = []
+        while True:
+            line = self._reply_line()
+            if line == 'END':
+                return lines
+            if not lines and line.startswith('ERROR:'):
+                raise ManagementError(line[len('ERROR:'):].strip())
+            lines.append(line)
+
+    def clients(self):
+        """
+            The connected clients, as ManagedClient tuples.
+        """
+        header = None
+        clients = []
+        for line in self.command_lines('status 3'):
+            fields = line.split('\t')
+            if fields[:2] == ['HEADER', 'CLIENT_LIST']:
+                header = fields[2:]
+            elif fields[0] == 'CLIENT_LIST' and header is not None:
+                row = dict(zip(header, fields[1:]))
+                username = row.get('Username') or None
+                clients.append(ManagedClient(
+                    cid=row.get('Client ID'),
+                    common_name=row.get('Common Name'),
+                    username=None if username == 'UNDEF' else username,
+                    real_address=row.get('Real Address', ''),
+                    client_ip=client_ip_of(row.get('Real Address', ''))))
+        return clients
+
+    @staticmethod
+    def quote(text):
+        """
+            Quote one argument for a management command.
+        """
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def push_update(self, cid, options):
+        """
+            Send options to one connected client, as a PUSH_UPDATE
+            (openvpn 2.7's push-update-cid).  An option starting with '-'
+            takes that option away.
+        """
+        return self.command(f'push-update-cid {cid} {self.quote(", ".join(options))}')
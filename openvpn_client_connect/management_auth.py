@@ -0,0 +1,284 @@
+"""
+    Answer client-connects over openvpn's management interface.
+
+    With 'management-client-auth' in its config, openvpn hands each
+    connecting client to its management client, as
+
+        >CLIENT:CONNECT,{CID},{KID}
+        >CLIENT:ENV,common_name=...
+        ...
+        >CLIENT:ENV,END
+
+    and waits to be told 'client-auth CID KID', then the client's config
+    lines, then 'END' (or 'client-deny CID KID "reason"').  This keeps a
+    connection open to the management interface of one or more openvpn
+    instances, and answers from a ConnectService: the same lines the
+    client-connect script would write, with no process started and no
+    file written per connect, and with many connects worked on at once.
+
+    Renegotiations (>CLIENT:REAUTH) are let through as they are, with
+    'client-auth-nt', since a client-connect script only runs when a
+    client first connects.  If the management connection drops, we
+    connect again.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import sys
+import signal
+import asyncio
+from collections import deque
+from argparse import ArgumentParser
+from openvpn_client_connect.service import ConnectService, load_service_settings
+from openvpn_client_connect.management import ManagementClient, ManagementError, tcp_address
+sys.dont_write_bytecode = True
+
+__all__ = ['ManagementAuthenticator']
+
+# The notifications that are followed by a block of >CLIENT:ENV lines.
+_ENV_EVENTS = ('CONNECT', 'REAUTH', 'ESTABLISHED', 'DISCONNECT')
+
+
+class ManagementAuthenticator:
+    """
+        Answers one openvpn instance's client-connects over its
+        management interface.
+    """
+    def __init__(self, service, address, conf_file=None, password=None,
+                 hold_release=False, retry_interval=5.0):
+        """
+            service is the ConnectService that decides, address the
+            management interface (a unix socket path, or host:port), and
+            conf_file the instance's config, for the service to pick the
+            instance by.  With hold_release, we release a held openvpn
+            (--management-hold) once we're connected.
+        """
+        self.service = service
+        self.address = address
+        self.conf_file = conf_file
+        self.password = password
+        self.hold_release = hold_release
+        self.retry_interval = retry_interval
+        self.stats = {'connects': 0, 'allowed': 0, 'denied': 0, 'reauths': 0,
+                      'errors': 0}
+        # The commands on the current connection that openvpn hasn't
+        # answered yet.  It answers in order.
+        self._unanswered = deque()
+        self._writer = None
+        self._tasks = set()
+
+    async def _open(self):
+        """
+            Connect, and log in if there's a password.
+        """
+        host_port = tcp_address(self.address)
+        try:
+            if host_port is None:
+                reader, writer = await asyncio.open_unix_connection(self.address)
+            else:
+                reader, writer = await asyncio.open_connection(*host_port)
+        except OSError as err:
+            raise ManagementError(f'cannot connect to {self.address}: {err}') from err
+        if self.password is not None:
+            # The prompt has no newline after it.
+            await reader.readuntil(b'ENTER PASSWORD:')
+            writer.write(self.password.encode('utf-8') + b'\n')
+            while True:
+                line = (await reader.readline()).decode('utf-8', 'replace')
+                if not line.startswith('>'):
+                    break
+            if not line.startswith('SUCCESS:'):
+                writer.close()
+                raise ManagementError('management password was not accepted')
+        return reader, writer
+
+    async def _send(self, writer, command, lines=()):
+        """
+            Send a command (and the lines that go with it) in one write,
+            so that concurrent answers can't interleave.
+        """
+        if writer is not self._writer or writer.is_closing():
+            # That connection is gone; openvpn has given up on the client.
+            return
+        self._unanswered.append(command.split()[0])
+        writer.write(''.join(f'{line}\n' for line in (command, *lines)).encode('utf-8'))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _authorize(self, writer, cid, kid, env):
+        """
+            Decide on one connecting client, and tell openvpn.
+        """
+        try:
+            allowed, result = await self.service.handle_connect(env, self.conf_file)
+        except Exception:  # pylint: disable=broad-except
+            # A bug in here shouldn't leave openvpn waiting for an answer.
+            allowed, result = False, 'error'
+        if allowed:
+            self.stats['allowed'] += 1
+            await self._send(writer, f'client-auth {cid} {kid}', result + ['END'])
+        else:
+            self.stats['denied'] += 1
+            await self._send(writer,
+                             f'client-deny {cid} {kid} {ManagementClient.quote(result)}')
+
+    def _spawn(self, coroutine):
+        """
+            Run a coroutine in the background, holding on to it until done.
+        """
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _dispatch(self, writer, kind, args, env):
+        """
+            Act on one client notification, once we have its environment.
+        """
+        if kind == 'CONNECT' and len(args) >= 2:
+            self.stats['connects'] += 1
+            self._spawn(self._authorize(writer, args[0], args[1], env))
+        elif kind == 'REAUTH' and len(args) >= 2:
+            self.stats['reauths'] += 1
+            self._spawn(self._send(writer, f'client-auth-nt {args[0]} {args[1]}'))
+
+    def _answered(self, line):
+        """
+            openvpn answered the oldest command we sent.
+        """
+        command = self._unanswered.popleft() if self._unanswered else 'unknown'
+        if line.startswith('ERROR:'):
+            self.stats['errors'] += 1
+            print(f'openvpn refused {command}: {line[len("ERROR:"):].strip()}')
+
+    async def serve_once(self):
+        """
+            Answer client notifications on one management connection,
+            until it goes away (with a ManagementError).
+        """
+        reader, writer = await self._open()
+        self._writer = writer
+        self._unanswered.clear()
+        try:
+            if self.hold_release:
+                await self._send(writer, 'hold release')
+            event = None
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    raise ManagementError('the management interface hung up')
+                line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+                if line.startswith('>CLIENT:ENV,'):
+                    if event is None:
+                        continue
+                    item = line[len('>CLIENT:ENV,'):]
+                    if item == 'END':
+                        self._dispatch(writer, *event)
+                        event = None
+                    else:
+                        name, _, value = item.partition('=')
+                        event[2][name] = value
+                elif line.startswith('>CLIENT:'):
+                    kind, _, args = line[len('>CLIENT:'):].partition(',')
+                    event = (kind, args.split(','), {}) if kind in _ENV_EVENTS else None
+                elif line.startswith(('SUCCESS:', 'ERROR:')):
+                    self._answered(line)
+        finally:
+            self._writer = None
+            writer.close()
+
+    async def serve_forever(self):
+        """
+            serve_once, and again whenever the connection is lost.
+        """
+        while True:
+            try:
+                await self.serve_once()
+            except (OSError, ManagementError, asyncio.IncompleteReadError) as err:
+                print(f'management interface {self.address}: {err}')
+            await asyncio.sleep(self.retry_interval)
+
+
+async def _serve(service, authenticators, socket_path):
+    """
+        Run the authenticators, and the service's socket and metrics if
+        they're asked for, until we're killed.
+    """
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, service.reload)
+    servers = []
+    tasks = [asyncio.create_task(authenticator.serve_forever())
+             for authenticator in authenticators]
+    if socket_path is not None:
+        servers.append(await service.start(socket_path))
+    if service.settings['metrics-port']:
+        servers.append(await service.start_metrics_http())
+    if service.settings['metrics-file']:
+        tasks.append(asyncio.create_task(service.write_metrics_periodically()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for server in servers:
+            server.close()
+
+
+def management_work(argv):
+    """
+        Parse arguments and answer client-connects until killed.
+    """
+    parser = ArgumentParser(description='Answer client-connects over the management interface')
+    parser.add_argument('--conf', type=str, required=True, action='append',
+                        help='Config file of an openvpn instance; repeat for several '
+                             'instances (the first one sets the service options)',
+                        dest='conffiles', default=None)
+    parser.add_argument('--management', type=str, required=True, action='append',
+                        help='That instance\'s management interface: a unix socket path, '
+                             'or host:port; one per --conf, in the same order',
+                        dest='addresses', default=None)
+    parser.add_argument('--password-file', type=str, required=False, default=None,
+                        help='File holding the management password')
+    parser.add_argument('--hold-release', action='store_true',
+                        help='Release openvpn from --management-hold once connected')
+    parser.add_argument('--socket', type=str, required=False, default=None,
+                        help='Also listen here for the service\'s stats, metrics and '
+                             'invalidate commands')
+    args = parser.parse_args(argv[1:])
+    if len(args.conffiles) != len(args.addresses):
+        print('Give one --management for each --conf')
+        return False
+
+    password = None
+    if args.password_file is not None:
+        with open(args.password_file, 'r', encoding='utf-8') as filehandle:
+            password = filehandle.readline().rstrip('\r\n')
+    service = ConnectService(args.conffiles, settings=load_service_settings(args.conffiles[0]))
+    authenticators = [ManagementAuthenticator(service, address, conf_file=conf_file,
+                                              password=password,
+                                              hold_release=args.hold_release)
+                      for conf_file, address in zip(args.conffiles, args.addresses)]
+    try:
+        asyncio.run(_serve(service, authenticators, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return True
+
+
+def management_main():
+    """ Interface to the outside """
+    if management_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    management_main()
@@ -0,0 +1,292 @@
+"""
+    Metrics for the long-running modes, in Prometheus text format.
+
+    We don't depend on a Prometheus client library: the handful of metric
+    types we need are simple, and the text format is simpler still.
+    Metrics can be exposed either as a file for node_exporter's textfile
+    collector, or over HTTP on localhost.
+
+    Counters and histograms are recorded as we go.  Numbers that other
+    objects already keep (memo hits and misses, for example) are read at
+    render time through callbacks, so nothing is counted twice.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import bisect
+import threading
+sys.dont_write_bytecode = True
+
+__all__ = ['MetricsRegistry', 'LATENCY_BUCKETS', 'COUNT_BUCKETS', 'SIZE_BUCKETS']
+
+# Seconds.  A connect that takes more than 10s has already failed for the user.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# Route counts per push.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Bytes per push.
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+
+def _escape(value):
+    """
+        Escape a label value for the text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    """
+        Render {a="1",b="2"}, or nothing if there are no labels.
+    """
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    """
+        Render a number the way Prometheus likes it.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """
+        What all our metric types share: a name, help text, label names,
+        and a lock (IAM timings can arrive from more than one thread).
+    """
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        """
+            Turn a labels dict into our storage key.
+        """
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, not {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        """
+            The HELP and TYPE lines.
+        """
+        return [f'# HELP {self.name} {self.documentation}',
+                f'# TYPE {self.name} {self.metric_type}']
+
+    def render(self):
+        """
+            Return our lines of the text format.
+        """
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+        A number that only goes up.
+    """
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """
+            Add amount to the counter for these labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """
+            The current count for these labels.
+        """
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} '
+                         f'{_format_value(value)}')
+        return lines
+
+
+class Histogram(_Metric):
+    """
+        A distribution of observations, in cumulative buckets.
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts (the last one is +Inf), sum, count]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """
+            Record one observation.
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0, 0]
+                self._values[key] = entry
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        """
+            How many observations there have been for these labels.
+        """
+        entry = self._values.get(self._key(labels))
+        return 0 if entry is None else entry[2]
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted((key, (list(entry[0]), entry[1], entry[2]))
+                           for key, entry in self._values.items())
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class _Callback(_Metric):
+    """
+        A metric whose values are read from elsewhere at render time.
+        The callback returns {tuple of label values: number}.
+    """
+    def __init__(self, name, documentation, labelnames, callback, metric_type):
+        super().__init__(name, documentation, labelnames)
+        self._callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self._callback().items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} '
+                         f'{_format_value(value)}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+        A named collection of metrics that renders as one exposition.
+    """
+    def __init__(self, prefix='openvpn_client_connect', const_labels=None):
+        """
+            const_labels ({name: value}) go on every sample we render;
+            they tell apart processes that export the same metrics.
+        """
+        self.prefix = prefix
+        self._metrics = {}
+        self._const_labels = _format_labels(*zip(*sorted((const_labels or {}).items()))) \
+            if const_labels else ''
+
+    def _register(self, metric):
+        """
+            Add a metric, refusing duplicates.
+        """
+        if metric.name in self._metrics:
+            raise ValueError(f'{metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def _full_name(self, name):
+        """
+            Put our prefix on a metric name.
+        """
+        return f'{self.prefix}_{name}' if self.prefix else name
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+            Create and register a Counter.
+        """
+        return self._register(Counter(self._full_name(name), documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+            Create and register a Histogram.
+        """
+        return self._register(Histogram(self._full_name(name), documentation,
+                                        labelnames, buckets))
+
+    def callback(self, name, documentation, labelnames, callback, metric_type='gauge'):
+        """
+            Register a metric read through callback() at render time.
+        """
+        return self._register(_Callback(self._full_name(name), documentation,
+                                        labelnames, callback, metric_type))
+
+    def get(self, name):
+        """
+            Look up a metric by its unprefixed name.
+        """
+        return self._metrics[self._full_name(name)]
+
+    def render(self):
+        """
+            The whole registry in Prometheus text format.
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            lines += self._metrics[name].render()
+        if self._const_labels:
+            lines = [self._add_const_labels(line) for line in lines]
+        return '\n'.join(lines) + '\n'
+
+    def _add_const_labels(self, line):
+        """
+            Put our constant labels on one sample line.
+        """
+        if line.startswith('#'):
+            return line
+        name, rest = line.rsplit(' ', 1)
+        if name.endswith('}'):
+            return f'{name[:-1]},{self._const_labels[1:]} {rest}'
+        return f'{name}{self._const_labels} {rest}'
+
+    def write_textfile(self, path):
+        """
+            Write the exposition to path, atomically, for node_exporter's
+            textfile collector (which must never see half a file).
+        """
+        tmpname = f'{path}.{os.getpid()}.tmp'
+        with open(tmpname, 'w', encoding='utf-8') as filehandle:
+            filehandle.write(self.render())
+        os.rename(tmpname, path)
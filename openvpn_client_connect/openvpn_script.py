@@ -6,8 +6,16 @@ import os
 import sys
 from argparse import ArgumentParser
 import openvpn_client_connect.client_connect
+from openvpn_client_connect.service_client import service_request
+from openvpn_client_connect.profiling import profiled
+from openvpn_client_connect import tracing
+from openvpn_client_connect.session_table import (
+    session_table_from_config, session_key, config_snapshot)
 sys.dont_write_bytecode = True
 
+# The parts of openvpn's environment that the service needs to see.
+SERVICE_ENV_VARS = ('common_name', 'username', 'trusted_ip', 'IV_VER', 'ifconfig_local')
+
 
 def client_version_allowed(config_object, client_version):
     """
@@ -24,28 +32,64 @@ def userid_allowed(config_object, userid):
     """
     return config_object.userid_allowed(userid)
 
-def build_lines(config_object, username_is, username_as, client_ip):
+def build_user_lines(config_object, username_is, username_as, client_ip, server_ip=None):
     """
-        Create the contents of the lines that should be returned
-        to the connecting client.
+        The lines that depend on who is connecting, and from where:
+        the part that goes between the config's push_block_head and
+        push_block_tail.  server_ip is our own address (ifconfig_local).
     """
     output_array = []
-    output_array += config_object.get_dns_server_lines()
     output_array += config_object.get_search_domains_lines(username_is=username_is,
                                                            username_as=username_as)
     output_array += config_object.get_dynamic_route_lines(username_is=username_is,
                                                           username_as=username_as,
-                                                          client_ip=client_ip)
+                                                          client_ip=client_ip,
+                                                          server_ip=server_ip)
+    return output_array
+
+
+def build_lines(config_object, username_is, username_as, client_ip, server_ip=None):
+    """
+        Create the contents of the lines that should be returned
+        to the connecting client.
+    """
+    output_array = []
+    output_array += config_object.get_dns_server_lines()
+    output_array += build_user_lines(config_object, username_is, username_as, client_ip,
+                                     server_ip)
     output_array += config_object.get_static_route_lines()
     output_array += config_object.get_protocol_lines()
     return output_array
 
 
-def main_work(argv):
+@profiled('openvpn-client-connect')
+def main_work(argv, environ=None):
     """
         Print the config that should go to each client into a file.
         Return True on success, False upon failure.
         Side effect is that we write to the output_filename.
+        If tracing is on, we also append a trace record about the connect.
+        environ is the client's environment from openvpn; by default,
+        our own (os.environ).
+    """
+    if environ is None:
+        environ = os.environ
+    trace, trace_path = tracing.trace_from_env('script')
+    if not trace:
+        return _main_work(argv, trace, environ)
+    token = tracing.activate(trace)
+    try:
+        retval = _main_work(argv, trace, environ)
+    finally:
+        tracing.deactivate(token)
+    tracing.append_record(trace_path, trace.record(retval, trace.fields.get('lines')),
+                          detach=True)
+    return retval
+
+
+def _main_work(argv, trace, environ):
+    """
+        The work of main_work, telling trace what we learn along the way.
     """
     # We will push routes/configs to the configuration filename
     # we're given as the LAST argument in reality there's usually
@@ -54,6 +98,9 @@ def main_work(argv):
     parser.add_argument('--conf', type=str, required=True,
                         help='Config file',
                         dest='conffile', default=None)
+    parser.add_argument('--service-socket', type=str, required=False,
+                        help='Ask the client-connect service on this socket',
+                        dest='service_socket', default=None)
     parser.add_argument('output_filename', type=str,
                         help='Filename to push config to')
     args = parser.parse_args(argv[1:])
@@ -63,50 +110,104 @@ def main_work(argv):
     # A 2.3 server, if sent IV_VER, does not send it to the script.
     # 2.4 clients and servers are all well-behaved.
     # Basically: "this can be blank"... (but see later)
-    client_version_string = os.environ.get('IV_VER')
+    client_version_string = environ.get('IV_VER')
 
     # common_name is an environmental variable passed in:
     # "The X509 common name of an authenticated client."
     # https://openvpn.net/index.php/open-source/documentation/manuals/65-openvpn-20x-manpage.html
-    usercn = os.environ.get('common_name')
-    trusted_ip = os.environ.get('trusted_ip')
-    unsafe_username = os.environ.get('username')
+    usercn = environ.get('common_name')
+    trusted_ip = environ.get('trusted_ip')
+    unsafe_username = environ.get('username')
+    trace.set(username=usercn, iv_ver=client_version_string)
 
     # Super failure in openvpn, or hacking, or an improper test from a human.
     if not usercn:
         print('No common_name or username environment variable provided.')
+        trace.set(reason='missing_common_name')
         return False
     if not trusted_ip:
         print('No trusted_ip environment variable provided.')
+        trace.set(reason='missing_trusted_ip')
         return False
     # We're now at the point where anything NOT sending IV_VER is too broken to tolerate.
     if not client_version_string:
         print('No IV_VER environment variable provided.')
+        trace.set(reason='missing_iv_ver')
         return False
 
-    config_object = openvpn_client_connect.client_connect.ClientConnect(args.conffile)
-
-    if not client_version_allowed(config_object, client_version_string):
-        return False
-
-    if not userid_allowed(config_object, usercn):
-        return False
-
-    output_array = build_lines(
-        config_object=config_object,
-        username_is=usercn,
-        username_as=unsafe_username,
-        client_ip=trusted_ip,
-    )
-    output_lines = '\n'.join(output_array) + '\n'
+    output_array = None
+    output_text = None
+    config_object = None
+    sessions = session_table_from_config(args.conffile)
+    if sessions is not None:
+        # A client coming straight back gets what we pushed last time.
+        session = session_key(args.conffile, environ)
+        snapshot = config_snapshot(args.conffile)
+        output_array = sessions.reuse(session, snapshot)
+    reused = output_array is not None
+
+    if reused or args.service_socket is None:
+        # A reused session is checked again: a user who has been turned
+        # off mustn't get back in with what we pushed them last time.
+        # Anything the service works out, it checks itself.
+        config_object = openvpn_client_connect.client_connect.ClientConnect(args.conffile)
+
+        version_allowed = client_version_allowed(config_object, client_version_string)
+        trace.set(iv_ver_allowed=version_allowed)
+        reason = None
+        if not version_allowed:
+            reason = 'version'
+        elif not userid_allowed(config_object, usercn):
+            reason = 'not_allowed'
+        if reason is not None:
+            trace.set(reason=reason)
+            if reused:
+                # Keep it for when they're allowed back.
+                sessions.release(session)
+            return False
+
+    if reused:
+        trace.set(session='reused')
+    elif args.service_socket is not None:
+        # A long-running service does the work; we just relay.
+        request = {'command': 'connect',
+                   'conf': os.path.abspath(args.conffile),
+                   'env': {var: environ[var] for var in SERVICE_ENV_VARS
+                           if var in environ}}
+        response = service_request(args.service_socket, request)
+        if response is None or response.get('status') != 'ok':
+            trace.set(reason='service_' + (response or {}).get('reason', 'unavailable'))
+            return False
+        output_array = response.get('lines', [])
+    else:
+        if trace:
+            trace.set(office=config_object.get_client_office(trusted_ip))
+
+        # Only the per-user lines are built; the rest was rendered
+        # when the config was loaded.
+        output_text = config_object.render_push_block(build_user_lines(
+            config_object=config_object,
+            username_is=usercn,
+            username_as=unsafe_username,
+            client_ip=trusted_ip,
+            server_ip=environ.get('ifconfig_local'),
+        ))
+    if output_text is None:
+        output_text = '\n'.join(output_array) + '\n'
 
     try:
         with open(args.output_filename, 'w', encoding='utf-8') as filehandle:
-            filehandle.write(output_lines)
+            filehandle.write(output_text)
     except IOError:
         # I couldn't write to the file, so we can't tell openvpn what
         # happened.  There's nothing to do but error out.
+        trace.set(reason='write_failed')
         return False
+    if output_array is None and ((sessions is not None and not reused) or trace):
+        output_array = output_text.splitlines()
+    if sessions is not None and not reused:
+        sessions.remember(session, snapshot, output_array, env=environ)
+    trace.set(lines=output_array)
     return True
 
 def main():
@@ -22,19 +22,343 @@
 import os
 import sys
 import ast
+import copy
+import hashlib
 import configparser
+from collections import namedtuple
 from netaddr import IPNetwork, cidr_merge, cidr_exclude
 import iamvpnlibrary
+from openvpn_client_connect.circuit_breaker import CircuitBreaker
+from openvpn_client_connect.tracing import TracedSearcher, current_trace
+from openvpn_client_connect.shared_cache import open_shared_cache
 sys.dont_write_bytecode = True
 
-__all__ = ['GetUserRoutes', 'GetUserSearchDomains', 'user_may_vpn']
+__all__ = ['GetUserRoutes', 'GetUserSearchDomains', 'user_may_vpn',
+           'IAM_QUERY_METHODS', 'fail_closed_value', 'configure_iam',
+           'reset_iam', 'forget_iam_answers', 'connect_iam_live', 'replica_settings',
+           'set_fingerprint']
+
+# These are the calls we make against an IAMVPNLibrary object.
+IAM_QUERY_METHODS = ('user_allowed_to_vpn', 'verify_sudo_user',
+                     'get_allowed_vpn_ips', 'get_allowed_vpn_acls')
+
+
+def fail_closed_value(method_name, *args):
+    '''
+        The answer to give when an IAM query could not be completed.
+        Every answer here is the least-privilege one: not allowed,
+        no sudo, no ACLs.
+    '''
+    if method_name == 'user_allowed_to_vpn':
+        return False
+    if method_name == 'verify_sudo_user':
+        # Without IAM we can't confirm a sudo, so you are who you said.
+        return args[0] if args else None
+    if method_name in ('get_allowed_vpn_ips', 'get_allowed_vpn_acls'):
+        return []
+    raise ValueError(f'{method_name} is not an IAM query we make')
+
+
+# Process-wide IAM settings.  configure_iam() fills these in from
+# the config file; the defaults are "talk straight to IAM".
+_IAM_CONFIGURED_FROM = None
+_IAM_CIRCUIT_BREAKER = None
+_SHARED_CACHE = None
+# (ACLReplica, write-through?) or None
+_ACL_REPLICA = None
+
+# The IAM queries whose answers may be shared through _SHARED_CACHE.
+# user_allowed_to_vpn is not one: every connect asks IAM that afresh.
+SHARED_CACHE_METHODS = ('verify_sudo_user', 'get_allowed_vpn_ips', 'get_allowed_vpn_acls')
+# What an ACL looks like when it comes back out of the shared cache.
+CachedACL = namedtuple('CachedACL', ['rule', 'address', 'portstring', 'description'])
+
+
+def configure_iam(conf_file):
+    '''
+        Set up how this process talks to IAM, based on a config file:
+        the optional [iam-circuit-breaker], [shared-cache] and
+        [acl-replica] sections.
+        Asking again for the same file keeps the existing setup, so that
+        everything in a process shares one breaker.
+        Returns the circuit breaker (or None).
+    '''
+    global _IAM_CONFIGURED_FROM, _IAM_CIRCUIT_BREAKER  # pylint: disable=global-statement
+    global _SHARED_CACHE, _ACL_REPLICA  # pylint: disable=global-statement
+    if conf_file == _IAM_CONFIGURED_FROM:
+        return _IAM_CIRCUIT_BREAKER
+    _config = GetUserRoutes._ingest_config_from_file(conf_file)  # pylint: disable=protected-access
+    reset_iam()
+    _IAM_CONFIGURED_FROM = conf_file
+    _SHARED_CACHE = _shared_cache_from(_config)
+    settings = _replica_settings_from(_config)
+    if settings is not None:
+        # sqlite3 only gets imported by those who use a replica.
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        # pylint: disable=import-outside-toplevel
+        from openvpn_client_connect.acl_replica import ACLReplica
+        try:
+            # Connects only write if they write through; else it's the sync job's file.
+            _ACL_REPLICA = (ACLReplica(settings['path'],
+                                       max_staleness=settings['max-staleness'],
+                                       readonly=not settings['write-through']),
+                            settings['write-through'])
+        except sqlite3.Error:
+            # No replica yet (or a broken one): go to IAM live.
+            _ACL_REPLICA = None
+    if _config.has_section('iam-circuit-breaker'):
+        section = 'iam-circuit-breaker'
+        try:
+            _IAM_CIRCUIT_BREAKER = CircuitBreaker(
+                failure_threshold=_config.getint(section, 'failure-threshold', fallback=5),
+                reset_timeout=_config.getfloat(section, 'reset-seconds', fallback=30.0),
+                slow_call_seconds=_config.getfloat(section, 'slow-call-seconds',
+                                                   fallback=None),
+                state_file=_config.get(section, 'state-file', fallback=None),
+            )
+        except ValueError:
+            # A mangled breaker config shouldn't stop people connecting.
+            _IAM_CIRCUIT_BREAKER = None
+    return _IAM_CIRCUIT_BREAKER
+
+
+def _shared_cache_from(_config):
+    '''
+        The SharedCache that a parsed config's [shared-cache] section
+        describes, or None.
+    '''
+    if not _config.has_section('shared-cache'):
+        return None
+    section = 'shared-cache'
+    try:
+        return open_shared_cache(
+            _config.get(section, 'path'),
+            slots=_config.getint(section, 'slots', fallback=4096),
+            slot_bytes=_config.getint(section, 'slot-bytes', fallback=4096),
+            default_ttl=_config.getfloat(section, 'ttl', fallback=30.0))
+    except (ValueError, configparser.NoOptionError):
+        # No path, or mangled numbers: run without sharing.
+        return None
+
+
+def forget_iam_answers(conf_file, usernames):
+    '''
+        Make the host-wide stores that a config file sets up (the
+        [shared-cache] and the [acl-replica]) forget these users' ACLs,
+        so that their next connects ask IAM.  Sudo answers in the shared
+        cache are keyed by who was asked for too, so they are left to
+        expire.
+        Returns (shared cache entries dropped, replica users marked
+        stale), with None for a store the config doesn't have.
+        Raises RuntimeError if the replica can't be changed.
+    '''
+    _config = GetUserRoutes._ingest_config_from_file(conf_file)  # pylint: disable=protected-access
+    usernames = list(usernames)
+    dropped = None
+    # Never make a cache file that nobody is using.
+    if os.path.exists(_config.get('shared-cache', 'path', fallback='')):
+        cache = _shared_cache_from(_config)
+        if cache is not None:
+            try:
+                dropped = sum(cache.discard('iam:' + _cache_key(name, username))
+                              for username in usernames
+                              for name in ('get_allowed_vpn_ips', 'get_allowed_vpn_acls'))
+            finally:
+                cache.close()
+    marked = None
+    settings = _replica_settings_from(_config)
+    if settings is not None and os.path.exists(settings['path']):
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        # pylint: disable=import-outside-toplevel
+        from openvpn_client_connect.acl_replica import ACLReplica
+        try:
+            replica = ACLReplica(settings['path'], max_staleness=settings['max-staleness'])
+            try:
+                marked = replica.mark_stale(usernames)
+            finally:
+                replica.close()
+        except sqlite3.Error as err:
+            raise RuntimeError(f'cannot update the replica {settings["path"]}: {err}') from err
+    return dropped, marked
+
+
+def reset_iam():
+    '''
+        Close what configure_iam opened (the shared cache and the
+        replica) and go back to talking straight to IAM, so that the
+        next configure_iam starts afresh.  A process that is about to
+        fork workers calls this, so each worker opens its own.
+    '''
+    global _IAM_CONFIGURED_FROM, _IAM_CIRCUIT_BREAKER  # pylint: disable=global-statement
+    global _SHARED_CACHE, _ACL_REPLICA  # pylint: disable=global-statement
+    if _SHARED_CACHE is not None:
+        _SHARED_CACHE.close()
+    if _ACL_REPLICA is not None:
+        _ACL_REPLICA[0].close()
+    _IAM_CONFIGURED_FROM = None
+    _IAM_CIRCUIT_BREAKER = None
+    _SHARED_CACHE = None
+    _ACL_REPLICA = None
+
+
+def _replica_settings_from(_config):
+    '''
+        The [acl-replica] settings from a parsed config, or None.
+    '''
+    section = 'acl-replica'
+    if not _config.has_option(section, 'path'):
+        return None
+    try:
+        return {'path': _config.get(section, 'path'),
+                'max-staleness': _config.getfloat(section, 'max-staleness', fallback=3600.0),
+                'write-through': _config.getboolean(section, 'write-through', fallback=False)}
+    except ValueError:
+        return None
+
+
+def replica_settings(conf_file):
+    '''
+        The [acl-replica] settings from a config file: a dict of
+        path, max-staleness and write-through, or None if there's no replica.
+    '''
+    return _replica_settings_from(
+        GetUserRoutes._ingest_config_from_file(conf_file))  # pylint: disable=protected-access
+
+
+class _GuardedSearcher:
+    '''
+        An IAMVPNLibrary stand-in that routes each query through the
+        circuit breaker, and fails closed rather than raising.
+    '''
+    def __init__(self, searcher, breaker):
+        self._searcher = searcher
+        self._breaker = breaker
+        # How many answers we've made up, rather than had from IAM.
+        self.failed_calls = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._searcher, name)
+        if name not in IAM_QUERY_METHODS:
+            return method
+
+        def _guarded(*args):
+            try:
+                return self._breaker.call(method, *args)
+            except Exception:  # pylint: disable=broad-except
+                self.failed_calls += 1
+                return fail_closed_value(name, *args)
+        return _guarded
+
+
+class _SharedCacheSearcher:
+    '''
+        An IAMVPNLibrary stand-in that answers what it can from the
+        host's shared cache, and only connects to IAM when it can't.
+        Having connected lazily, a failure to connect turns into the
+        fail-closed answer (which is never cached).
+    '''
+    def __init__(self, connect, cache):
+        self._connect = connect
+        self._cache = cache
+        self._searcher = None
+
+    def _get_searcher(self):
+        ''' Connect to IAM the first time we need to. '''
+        if self._searcher is None:
+            self._searcher = self._connect()
+        return self._searcher
+
+    def __getattr__(self, name):
+        if name not in IAM_QUERY_METHODS:
+            return getattr(self._get_searcher(), name)
+
+        def _cached(*args):
+            cache_key = None
+            if name in SHARED_CACHE_METHODS:
+                cache_key = 'iam:' + _cache_key(name, *args)
+                hit, value = self._cache.get(cache_key)
+                if hit:
+                    if name == 'get_allowed_vpn_acls':
+                        return [CachedACL(*fields) for fields in value]
+                    return value
+            try:
+                searcher = self._get_searcher()
+            except RuntimeError:
+                return fail_closed_value(name, *args)
+            failures_before = getattr(searcher, 'failed_calls', 0)
+            answer = getattr(searcher, name)(*args)
+            if cache_key is None or getattr(searcher, 'failed_calls', 0) != failures_before:
+                # A fail-closed answer must not outlive the failure.
+                return answer
+            if name == 'get_allowed_vpn_acls':
+                self._cache.put(cache_key, [[getattr(acl, field) for field in CachedACL._fields]
+                                            for acl in answer])
+            else:
+                self._cache.put(cache_key, answer)
+            return answer
+        return _cached
+
+
+def _cache_key(*parts):
+    '''
+        A shared-cache key made of some strings (or Nones).
+    '''
+    return '\x1f'.join('' if part is None else str(part) for part in parts)
+
+
+def _connect_iam():
+    '''
+        Get an object to query IAM with.
+        Raises RuntimeError if we can't (including if the breaker is open).
+        With a shared cache or a replica, connecting waits until a query
+        misses them.
+    '''
+    if _SHARED_CACHE is not None:
+        def connect():
+            return _SharedCacheSearcher(connect_iam_live, _SHARED_CACHE)
+    else:
+        connect = connect_iam_live
+    if _ACL_REPLICA is not None:
+        # pylint: disable=import-outside-toplevel
+        from openvpn_client_connect.acl_replica import ReplicaSearcher
+        replica, write_through = _ACL_REPLICA
+        return ReplicaSearcher(replica, connect, CachedACL, write_through=write_through)
+    return connect()
+
+
+def connect_iam_live():
+    '''
+        Connect to IAM, with the breaker and tracing that are set up,
+        bypassing any cache or replica.
+        Raises RuntimeError if we can't (including if the breaker is open).
+    '''
+    breaker = _IAM_CIRCUIT_BREAKER
+    trace = current_trace()
+    with trace.span('connect'):
+        if breaker is None:
+            searcher = iamvpnlibrary.IAMVPNLibrary()
+        else:
+            searcher = _GuardedSearcher(breaker.call(iamvpnlibrary.IAMVPNLibrary), breaker)
+    if trace:
+        return TracedSearcher(searcher, trace, IAM_QUERY_METHODS)
+    return searcher
+
+
+def set_fingerprint(strings):
+    '''
+        A stable name for a set of strings: the same strings, in any
+        order and with any repeats, give the same fingerprint in any process.
+    '''
+    joined = '\n'.join(sorted(set(strings)))
+    return hashlib.sha256(joined.encode('utf-8')).hexdigest()
+
 
 def user_may_vpn(userid):
     '''
         Check if a user is allowed to VPN in or not
     '''
     try:
-        iam_searcher = iamvpnlibrary.IAMVPNLibrary()
+        iam_searcher = _connect_iam()
     except RuntimeError:
         # Couldn't connect to the IAM service:
         return False
@@ -47,9 +371,11 @@ class GetUserRoutes:
         this class acts as a utility that you query for information about a
         user.  In that sense, it's pretty close to a straightforward script.
     """
-    def __init__(self, conf_file):
+    def __init__(self, conf_file, connect=True):
         """
-            ingest the config file so other methods can use it
+            ingest the config file so other methods can use it.
+            With connect=False, we don't connect to IAM (iam_searcher
+            is None), for when only the config is wanted.
         """
         self.configfile = conf_file
         _config = self._ingest_config_from_file(conf_file)
@@ -88,11 +414,19 @@ class GetUserRoutes:
                                        for office, routestr in
                                        _perofficeroutes.items()}
         self.config = config
-        try:
-            self.iam_searcher = iamvpnlibrary.IAMVPNLibrary()
-        except RuntimeError:
-            # Couldn't connect to the IAM service:
-            self.iam_searcher = None
+        # Non-office routes, keyed by set_fingerprint() of the ACLs.
+        # This assumes self.config doesn't change under us.
+        self._routes_memo = {}
+        self.memo_stats = {'hits': 0, 'misses': 0}
+        # Names this route config in the host's shared cache; see _shared_routes_key.
+        self._config_fingerprint = None
+        self.iam_searcher = None
+        if connect:
+            try:
+                self.iam_searcher = _connect_iam()
+            except RuntimeError:
+                # Couldn't connect to the IAM service:
+                self.iam_searcher = None
 
     @staticmethod
     def _ingest_config_from_file(conf_file):
@@ -154,10 +488,12 @@ class GetUserRoutes:
             myroutes = newroutelist
         return sorted(list(set(myroutes)))
 
-    def get_office_routes(self, from_office, client_ip):
+    def get_office_routes(self, from_office, client_ip, server_ip=None):
         """
             This should provide the routes that someone would have,
             based on if they're in/out of an office.
+            server_ip is the VPN server's own address (ifconfig_local),
+            which we pull from the environment if not told.
         """
         if isinstance(from_office, str):
             if from_office in self.config['PER_OFFICE_ROUTES']:
@@ -188,7 +524,8 @@ class GetUserRoutes:
                 # within the office route, meaning that if we DO push you the office route,
                 # we have said "the best route to the office is via a route across the VPN".
                 # THAT will cause a routing failure.
-                server_ip = os.environ.get('ifconfig_local')
+                if server_ip is None:
+                    server_ip = os.environ.get('ifconfig_local')
                 if server_ip is not None:
                     server_ipnetwork_obj = IPNetwork(server_ip)
                     user_office_routes = self.route_exclusion(
@@ -196,7 +533,7 @@ class GetUserRoutes:
                         server_ipnetwork_obj)
         return user_office_routes
 
-    def build_user_routes(self, user_string, from_office, client_ip):
+    def build_user_routes(self, user_string, from_office, client_ip, server_ip=None):
         """
             This is the main function of the class, and builds out the
             routes we want to have available for a user, situationally
@@ -209,12 +546,84 @@ class GetUserRoutes:
             return []
         # Get the user's ACLs:
         user_acl_strings = self.iam_searcher.get_allowed_vpn_ips(user_string)
+        return self.build_routes_from_acls(user_acl_strings, from_office, client_ip,
+                                           server_ip)
+
+    def build_routes_from_acls(self, user_acl_strings, from_office, client_ip,
+                               server_ip=None):
+        """
+            The work of build_user_routes, once we have the user's ACLs
+            (as returned by get_allowed_vpn_ips) in hand.
+
+            returns a list of IPNetwork objects.
+        """
         if not user_acl_strings:
             # If the user has NO acls, get out now.  We're probably in
             # a bad case where someone doesn't exist, or we've had an
             # upstream failure.  In any case, don't give any routes,
             # so as to provide the least privilege.
             return []
+        user_nonoffice_routes = self.build_nonoffice_routes(user_acl_strings)
+        return self.add_office_routes(user_nonoffice_routes, from_office,
+                                      client_ip, server_ip)
+
+    # Users on the same team tend to have identical ACLs, so there are
+    # relatively few distinct sets, but let's not grow without limit.
+    MAX_MEMO_ENTRIES = 4096
+
+    def build_nonoffice_routes(self, user_acl_strings):
+        """
+            The part of a user's routes that depends only on their ACLs
+            (and our config), and not on where they're connecting from.
+            That's the free routes plus their personal routes.
+            The answer depends only on the set of ACLs, so it's memoized
+            by the fingerprint of that set.
+
+            returns a sorted list of IPNetwork objects.
+        """
+        fingerprint = set_fingerprint(user_acl_strings)
+        routes = self._routes_memo.get(fingerprint)
+        if routes is not None:
+            self.memo_stats['hits'] += 1
+            return list(routes)
+        self.memo_stats['misses'] += 1
+        routes = self._shared_nonoffice_routes(fingerprint, user_acl_strings)
+        if len(self._routes_memo) >= self.MAX_MEMO_ENTRIES:
+            self._routes_memo.clear()
+        self._routes_memo[fingerprint] = routes
+        return list(routes)
+
+    def _shared_routes_key(self, fingerprint):
+        """
+            The shared-cache key for a set of ACLs under this route config.
+            Other openvpn instances may have other route configs, so the
+            config is part of the key.
+        """
+        if self._config_fingerprint is None:
+            self._config_fingerprint = set_fingerprint([repr(sorted(self.config.items()))])
+        return 'routes:' + _cache_key(self._config_fingerprint, fingerprint)
+
+    def _shared_nonoffice_routes(self, fingerprint, user_acl_strings):
+        """
+            Non-office routes from the host's shared cache, if there is
+            one and it has them; otherwise computed (and shared).
+            returns a tuple of IPNetwork objects.
+        """
+        cache = _SHARED_CACHE
+        if cache is None:
+            return tuple(self._compute_nonoffice_routes(user_acl_strings))
+        shared_key = self._shared_routes_key(fingerprint)
+        hit, value = cache.get(shared_key)
+        if hit:
+            return tuple(IPNetwork(route) for route in value)
+        routes = tuple(self._compute_nonoffice_routes(user_acl_strings))
+        cache.put(shared_key, [str(route) for route in routes])
+        return routes
+
+    def _compute_nonoffice_routes(self, user_acl_strings):
+        """
+            The un-memoized work of build_nonoffice_routes.
+        """
         #
         # user_acls is ['10.0.0.0/8', '192.168.50.0/24', ...]
         # a list of CIDR strings.  Since we're going to do a lot
@@ -251,8 +660,19 @@ class GetUserRoutes:
         # routes everyone gets, plus your personal routes...
         user_nonoffice_routes = sorted(
             cidr_merge(self.config['FREE_ROUTES'] + user_specific_routes))
+        return user_nonoffice_routes
+
+    def add_office_routes(self, user_nonoffice_routes, from_office, client_ip,
+                          server_ip=None):
+        """
+            Finish off a user's routes (from build_nonoffice_routes) with
+            the office routes for where they're connecting from.
+
+            returns a list of IPNetwork objects.
+        """
+        # Your non-office routes...
         # ... plus your office routes, as calculated ...
-        user_office_routes = self.get_office_routes(from_office, client_ip)
+        user_office_routes = self.get_office_routes(from_office, client_ip, server_ip)
         # ... equals ...
         all_routes = sorted(user_nonoffice_routes + user_office_routes)
         # Notice here, we do NOT cidr_merge at this final point.
@@ -276,12 +696,17 @@ class GetUserSearchDomains:
         this class acts as a utility that you query for information about a
         user.  In that sense, it's pretty close to a straightforward script.
     """
-    def __init__(self, conf_file):
+    def __init__(self, conf_file, connect=True):
         """
-            ingest the config file so other methods can use it
+            ingest the config file so other methods can use it.
+            With connect=False, we don't connect to IAM (iam_searcher
+            is None), for when only the config is wanted.
         """
         self.configfile = conf_file
         _config = self._ingest_config_from_file(conf_file)
+        # Rendered push lines, keyed by groups_fingerprint().
+        self._lines_memo = {}
+        self.memo_stats = {'hits': 0, 'misses': 0}
 
         try:
             _search_domains = ast.literal_eval(
@@ -299,12 +724,15 @@ class GetUserSearchDomains:
             _dynamic_dict = {}
         if not isinstance(_dynamic_dict, dict):  # pragma: no cover
             _dynamic_dict = {}
+        # This also builds the lookup index, see the setter.
         self.dynamic_dict = _dynamic_dict
-        try:
-            self.iam_searcher = iamvpnlibrary.IAMVPNLibrary()
-        except RuntimeError:
-            # Couldn't connect to the IAM service:
-            self.iam_searcher = None
+        self.iam_searcher = None
+        if connect:
+            try:
+                self.iam_searcher = _connect_iam()
+            except RuntimeError:
+                # Couldn't connect to the IAM service:
+                self.iam_searcher = None
 
     @staticmethod
     def _ingest_config_from_file(conf_file):
@@ -325,46 +753,145 @@ class GetUserSearchDomains:
         # The init will assume default values where there's no config.
         return config
 
+    # Many users share the same relevant groups, but there's no point in
+    # letting the memo grow without limit.
+    MAX_MEMO_ENTRIES = 4096
+
+    @property
+    def search_domains(self):
+        """
+            The search domains everyone gets.  This is a copy: changing
+            it changes nothing, so assign to this to make a change.
+        """
+        return list(self._search_domains)
+
+    @search_domains.setter
+    def search_domains(self, value):
+        """
+            Store the global search domains.  This invalidates the memo.
+        """
+        self._search_domains = tuple(value)
+        self._lines_memo.clear()
+
+    @property
+    def dynamic_dict(self):
+        """
+            The group -> domain(s) map, as it came from the config file.
+            This is a copy: changing it changes nothing, so assign to
+            this to make a change.
+        """
+        return copy.deepcopy(self._dynamic_dict)
+
+    @dynamic_dict.setter
+    def dynamic_dict(self, value):
+        """
+            Store the group -> domain(s) map, and index it.
+            This invalidates the memo.
+        """
+        self._dynamic_dict = copy.deepcopy(value)
+        self._domain_index = self._build_domain_index(self._dynamic_dict)
+        self._lines_memo.clear()
+
+    @staticmethod
+    def _build_domain_index(dynamic_dict):
+        """
+            Normalize the config's group -> domain(s) map into
+            group -> tuple of valid domains, so we only check it once.
+            Groups that wouldn't add anything are left out entirely.
+        """
+        index = {}
+        for group, value in dynamic_dict.items():
+            if not isinstance(value, list):
+                value = [value]
+            # Skip nonstrings, and blank strings in case someone left one:
+            domains = [domain for domain in value
+                       if isinstance(domain, str) and domain]
+            if domains:
+                index[group] = tuple(dict.fromkeys(domains))
+        return index
+
+    def relevant_groups(self, user_groups):
+        """
+            Reduce a user's groups to the ones that have anything special
+            associated with them.  Walk whichever side is smaller, where we can.
+        """
+        index = self._domain_index
+        if isinstance(user_groups, (set, frozenset)) and len(index) < len(user_groups):
+            return frozenset(group for group in index if group in user_groups)
+        return frozenset(group for group in user_groups if group in index)
+
+    @staticmethod
+    def groups_fingerprint(groups):
+        """
+            A stable name for a set of groups: the same groups, in any
+            order, give the same fingerprint, in any process.
+        """
+        return set_fingerprint(groups)
+
+    @staticmethod
+    def format_search_domain_lines(domains):
+        """
+            Turn a list of search domains into push lines.
+        """
+        return_lines = []
+        for server in domains:
+            _line = f'push "dhcp-option DOMAIN {server}"'
+            return_lines.append(_line)
+        return return_lines
+
+    def get_search_domain_lines(self, user_groups):
+        """
+            The push lines for someone with a certain set of groups.
+            Everyone whose relevant groups are the same gets the same
+            lines, so these are memoized by the fingerprint of those.
+        """
+        relevant = self.relevant_groups(user_groups)
+        fingerprint = self.groups_fingerprint(relevant)
+        lines = self._lines_memo.get(fingerprint)
+        if lines is not None:
+            self.memo_stats['hits'] += 1
+            return list(lines)
+        self.memo_stats['misses'] += 1
+        lines = tuple(self.format_search_domain_lines(self.build_search_domains(relevant)))
+        if len(self._lines_memo) >= self.MAX_MEMO_ENTRIES:
+            self._lines_memo.clear()
+        self._lines_memo[fingerprint] = lines
+        return list(lines)
+
     def build_search_domains(self, user_groups):
         """
             Build the set of search domains that should exist for someone
             who has a certain set of groups.
         """
         # The global domains form the base list:
-        return_list = list(self.search_domains)
-        #return_list = self.search_domains.copy()
-        # Now, loop through the user's groups list
-        for user_group in sorted(user_groups):
-            # If their group has anything special associated with it,
-            # We should do something.
-            if user_group in self.dynamic_dict:
-                # Find what we should add:
-                value = self.dynamic_dict[user_group]
-                if not isinstance(value, list):
-                    value = [value]
-                for candidate_domain in value:
-                    if not isinstance(candidate_domain, str):
-                        continue
-                    if not candidate_domain:
-                        # In case someone left a blank string:
-                        continue
-                    if candidate_domain in return_list:
-                        continue
+        return_list = list(self._search_domains)
+        # return_list plus seen act as an ordered set:
+        seen = {domain for domain in return_list if isinstance(domain, str)}
+        index = self._domain_index
+        for user_group in sorted(self.relevant_groups(user_groups)):
+            for candidate_domain in index[user_group]:
+                if candidate_domain not in seen:
+                    seen.add(candidate_domain)
                     return_list.append(candidate_domain)
         return return_list
 
-    def get_search_domains(self, user_string):
+    def get_user_groups(self, user_string):
         """
-            This is the main function of the class, and builds out the
-            search domains we want to have available for a user
-
-            returns a list of strings.
+            The groups a user is in, as far as their VPN ACLs say.
         """
         user_groups = []
         if user_string:
             if self.iam_searcher:
                 # Get the user's ACLs:
                 user_acls = self.iam_searcher.get_allowed_vpn_acls(user_string)
-                #user_groups = list(set([x.rule for x in user_acls]))
-                user_groups = list({x.rule for x in user_acls})
-        return self.build_search_domains(user_groups)
+                user_groups = {x.rule for x in user_acls}
+        return user_groups
+
+    def get_search_domains(self, user_string):
+        """
+            This is the main function of the class, and builds out the
+            search domains we want to have available for a user
+
+            returns a list of strings.
+        """
+        return self.build_search_domains(self.get_user_groups(user_string))
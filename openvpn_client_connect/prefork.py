@@ -0,0 +1,438 @@
+"""
+    Serve client-connects from several processes.
+
+    One service process is one core.  This loads the configs once, in a
+    parent, then forks workers that each run a ConnectService on the same
+    listening socket; the kernel hands each incoming connection to
+    whichever worker accepts it first.
+
+    Before forking, the parent collects and then gc.freeze()s everything it
+    has loaded, so the collector in a worker never walks (and so never
+    writes to, and never copies) the pages the configs live on.  Only the
+    configs are shared that way: the shared cache, the ACL replica and
+    IAM connections are let go of before the fork, and each worker opens
+    its own.
+
+    The parent then only looks after the workers:
+    - each worker writes a heartbeat to a pipe every health-interval; one
+      that is silent for health-timeout is stuck, and is killed.
+    - a worker that dies is replaced in the same slot (after a pause, if it
+      died right after starting, so a broken worker can't spin).
+    - with max-requests set, a worker retires after that many connects (plus
+      up to max-requests-jitter more, so they don't all retire at once),
+      finishing what it has in hand first.
+    - SIGHUP reloads the configs in the parent and retires every worker, so
+      they are replaced by workers forked from the new configs.
+    - SIGTERM or SIGINT stops the workers and then the parent.
+
+    Each worker has its own counters.  They come out with a worker="N"
+    label, and metrics-file is written per worker (service.prom becomes
+    service.worker0.prom, ...); metrics-port isn't served from workers,
+    as they can't all listen on it.  Each worker also has a socket of its
+    own (the service socket plus .workerN), for requests that have to
+    reach every worker, like invalidating cached IAM answers.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+#
+# Requires:
+# iamvpnlibrary
+# netaddr
+
+import os
+import sys
+import gc
+import time
+import random
+import signal
+import socket
+import asyncio
+import selectors
+import traceback
+from openvpn_client_connect.per_user_configs import reset_iam
+from openvpn_client_connect.service import (
+    ConnectService, load_service_settings, load_instances)
+from openvpn_client_connect.service_client import worker_socket_path
+sys.dont_write_bytecode = True
+
+__all__ = ['PreforkServer', 'worker_metrics_path']
+
+# A worker that dies sooner than this after starting is crashing rather
+# than retiring; wait this long before starting its replacement.
+_RESPAWN_BACKOFF = 1.0
+# After telling workers to stop, how long past request-timeout we wait
+# before killing them.
+_STOP_GRACE = 5.0
+
+
+def worker_metrics_path(path, slot):
+    """
+        Where one worker writes its metrics textfile.
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}.worker{slot}{ext}'
+
+
+class _WorkerService(ConnectService):
+    """
+        A ConnectService that retires after max_requests connects.
+    """
+    def __init__(self, conf_file, slot, max_requests=0, **kwargs):
+        super().__init__(conf_file, **kwargs)
+        self.slot = slot
+        self.max_requests = max_requests
+        self.served = 0
+        self.retire = None
+
+    async def handle_request(self, request):
+        """
+            Dispatch as usual, counting connects towards retirement.
+        """
+        response = await super().handle_request(request)
+        if isinstance(request, dict) and request.get('command') == 'connect':
+            self.served += 1
+            if self.max_requests and self.served >= self.max_requests and \
+                    self.retire is not None:
+                self.retire.set()
+        return response
+
+    def stats(self):
+        """
+            The usual stats, plus which worker gave them.
+        """
+        stats = super().stats()
+        stats['worker'] = {'slot': self.slot, 'pid': os.getpid(), 'served': self.served}
+        return stats
+
+
+async def _heartbeat(beat_fd, interval, stop):
+    """
+        Tell the parent we're alive, every interval seconds.
+        If the parent has gone away, so do we.
+    """
+    while True:
+        try:
+            os.write(beat_fd, b'.')
+        except BlockingIOError:
+            # The parent isn't reading; it'll catch up.
+            pass
+        except OSError:
+            stop.set()
+            return
+        await asyncio.sleep(interval)
+
+
+async def _serve_worker(service, sock, control_path, beat_fd):
+    """
+        Serve from one worker until we're told to stop or retire, then
+        stop taking connections and finish the ones we have.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    service.retire = stop
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    server = await service.start(sock=sock)
+    control = await service.start(control_path)
+    tasks = [asyncio.create_task(_heartbeat(beat_fd, service.settings['health-interval'],
+                                            stop))]
+    if service.settings['metrics-file']:
+        tasks.append(asyncio.create_task(service.write_metrics_periodically()))
+    await stop.wait()
+    server.close()
+    control.close()
+    _unlink(control_path)
+    deadline = loop.time() + service.request_timeout
+    while service.open_connections and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    for task in tasks:
+        task.cancel()
+
+
+def _unlink(path):
+    """
+        Remove a file that may already be gone.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class _Worker:  # pylint: disable=too-few-public-methods
+    """
+        What the parent knows about one worker.
+    """
+    def __init__(self, slot, pid, beat_fd):
+        self.slot = slot
+        self.pid = pid
+        self.beat_fd = beat_fd
+        self.started = time.monotonic()
+        self.last_beat = self.started
+        self.killed = False
+
+
+class PreforkServer:
+    """
+        A parent process that preloads the configs and keeps a pool of
+        forked ConnectService workers going.
+    """
+    def __init__(self, conf_files, settings=None, socket_path=None):
+        """
+            conf_files and settings as ConnectService takes them.
+            socket_path overrides the [service] socket.
+        """
+        if isinstance(conf_files, str):
+            conf_files = [conf_files]
+        self.conf_files = list(conf_files)
+        if settings is None:
+            settings = load_service_settings(self.conf_files[0])
+        self.settings = settings
+        self.socket_path = socket_path or settings['socket']
+        self.instances = None
+        self.sock = None
+        self.selector = None
+        self._wake_r = self._wake_w = None
+        self._workers = {}
+        self._respawn = {}
+        self._stopping = False
+        self._reload_wanted = False
+
+    def preload(self):
+        """
+            Load everything workers share, and freeze it out of the
+            collector's view so that forked workers keep sharing its pages.
+        """
+        gc.disable()
+        if self.instances is not None:
+            # Let go of the old configs so they can be collected.
+            self.instances = None
+            gc.unfreeze()
+        self.instances = load_instances(self.conf_files)
+        # Loading the configs set up IAM access for this process; file
+        # handles and connections mustn't be shared across the fork.
+        reset_iam()
+        gc.collect()
+        gc.freeze()
+
+    def _listen(self):
+        """
+            The socket every worker accepts from.
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o660)
+        sock.listen(socket.SOMAXCONN)
+        return sock
+
+    def _spawn(self, slot):
+        """
+            Fork a worker into slot.
+        """
+        beat_r, beat_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover  (runs in the child)
+            code = 1
+            try:
+                os.close(beat_r)
+                code = self._worker_main(slot, beat_w)
+            except BaseException:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                os._exit(code)  # pylint: disable=protected-access
+        os.close(beat_w)
+        os.set_blocking(beat_r, False)
+        worker = _Worker(slot, pid, beat_r)
+        self._workers[pid] = worker
+        self.selector.register(beat_r, selectors.EVENT_READ, worker)
+
+    def _worker_main(self, slot, beat_fd):  # pragma: no cover  (runs in the child)
+        """
+            Everything a worker does, from just after the fork.
+        """
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_IGN)
+        for signum in (signal.SIGTERM, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        self.selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        for worker in self._workers.values():
+            os.close(worker.beat_fd)
+        gc.enable()
+
+        settings = dict(self.settings, **{'metrics-port': 0})
+        if settings['metrics-file']:
+            settings['metrics-file'] = worker_metrics_path(settings['metrics-file'], slot)
+        max_requests = settings['max-requests']
+        if max_requests and settings['max-requests-jitter']:
+            max_requests += random.Random().randint(0, settings['max-requests-jitter'])
+        service = _WorkerService(self.conf_files, slot, max_requests=max_requests,
+                                 settings=settings, instances=self.instances,
+                                 metrics_labels={'worker': str(slot)})
+        try:
+            asyncio.run(_serve_worker(service, self.sock,
+                                      worker_socket_path(self.socket_path, slot), beat_fd))
+        finally:
+            service.close()
+        return 0
+
+    def _on_signal(self, signum, _frame):
+        """
+            Note what we were asked to do; the main loop does it.
+        """
+        if signum == signal.SIGHUP:
+            self._reload_wanted = True
+        elif signum in (signal.SIGTERM, signal.SIGINT):
+            self._stopping = True
+
+    def _read_beats(self, timeout):
+        """
+            Wait up to timeout for heartbeats (or a signal), and note them.
+        """
+        for key, _events in self.selector.select(timeout):
+            try:
+                data = os.read(key.fd, 4096)
+            except BlockingIOError:
+                continue
+            if key.fd == self._wake_r:
+                continue
+            worker = key.data
+            if data:
+                worker.last_beat = time.monotonic()
+            else:
+                # The worker closed its end: it's exiting.
+                self.selector.unregister(key.fd)
+
+    def _forget(self, worker):
+        """
+            Stop watching a worker that has exited.
+        """
+        if worker.beat_fd in self.selector.get_map():
+            self.selector.unregister(worker.beat_fd)
+        os.close(worker.beat_fd)
+        # A worker that was killed didn't get to remove its socket.
+        _unlink(worker_socket_path(self.socket_path, worker.slot))
+
+    def _reap(self):
+        """
+            Collect exited workers, and schedule their replacements.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self._workers.pop(pid, None)
+            if worker is None:
+                continue
+            self._forget(worker)
+            now = time.monotonic()
+            crashed = not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0
+            if crashed:
+                print(f'worker {worker.slot} (pid {pid}) died with status {status}',
+                      file=sys.stderr)
+            if self._stopping:
+                continue
+            backoff = crashed and now - worker.started < _RESPAWN_BACKOFF
+            self._respawn[worker.slot] = now + (_RESPAWN_BACKOFF if backoff else 0)
+
+    def _check_health(self):
+        """
+            Kill any worker that has stopped sending heartbeats.
+        """
+        now = time.monotonic()
+        for worker in self._workers.values():
+            if not worker.killed and now - worker.last_beat > self.settings['health-timeout']:
+                print(f'worker {worker.slot} (pid {worker.pid}) is not responding; killing it',
+                      file=sys.stderr)
+                worker.killed = True
+                os.kill(worker.pid, signal.SIGKILL)
+
+    def _respawn_due(self):
+        """
+            Start the replacement workers whose time has come.
+        """
+        now = time.monotonic()
+        for slot, when in list(self._respawn.items()):
+            if when <= now:
+                del self._respawn[slot]
+                self._spawn(slot)
+
+    def _reload(self):
+        """
+            Load the configs again, and roll the workers onto them.
+        """
+        self._reload_wanted = False
+        try:
+            self.preload()
+        except Exception as err:  # pylint: disable=broad-except
+            print(f'reload failed, keeping the old workers: {err}', file=sys.stderr)
+            return
+        for worker in self._workers.values():
+            os.kill(worker.pid, signal.SIGTERM)
+
+    def _shutdown(self):
+        """
+            Stop every worker, waiting a while for them to finish up.
+        """
+        for worker in self._workers.values():
+            os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.settings['request-timeout'] + _STOP_GRACE
+        while self._workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        for worker in list(self._workers.values()):
+            os.kill(worker.pid, signal.SIGKILL)
+            os.waitpid(worker.pid, 0)
+            self._forget(worker)
+        self._workers = {}
+
+    def run(self):
+        """
+            Start the workers and look after them until we're told to stop.
+        """
+        self.preload()
+        self.sock = self._listen()
+        self.selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ)
+        old_wakeup = signal.set_wakeup_fd(self._wake_w)
+        old_handlers = {signum: signal.signal(signum, self._on_signal)
+                        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)}
+        # Only here so that a dying worker wakes us through the wakeup fd.
+        old_handlers[signal.SIGCHLD] = signal.signal(signal.SIGCHLD, lambda *_: None)
+        try:
+            for slot in range(self.settings['workers']):
+                self._spawn(slot)
+            while not self._stopping:
+                self._read_beats(min(1.0, self.settings['health-interval']))
+                self._reap()
+                if self._reload_wanted:
+                    self._reload()
+                self._check_health()
+                self._respawn_due()
+        finally:
+            self._shutdown()
+            signal.set_wakeup_fd(old_wakeup)
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+            self.selector.close()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self.sock.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        return True
@@ -0,0 +1,145 @@
+"""
+    Opt-in profiling of real connects.
+
+    Set OPENVPN_CLIENT_CONNECT_PROFILE_DIR to a directory, and each run of
+    a profiled entry point writes a cProfile dump there.  Set
+    OPENVPN_CLIENT_CONNECT_PROFILE_RATE to a number between 0 and 1 to only
+    profile that fraction of runs (the default is every run).
+
+    The report tool merges a pile of dumps into one ranked list:
+        openvpn-client-connect-profile-report /path/to/spool
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import time
+import functools
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+__all__ = ['profiled', 'PROFILE_DIR_ENV', 'PROFILE_RATE_ENV']
+
+PROFILE_DIR_ENV = 'OPENVPN_CLIENT_CONNECT_PROFILE_DIR'
+PROFILE_RATE_ENV = 'OPENVPN_CLIENT_CONNECT_PROFILE_RATE'
+DUMP_SUFFIX = '.prof'
+
+
+def _should_profile():
+    """
+        Return the spool directory if this run should be profiled, else None.
+    """
+    spool_dir = os.environ.get(PROFILE_DIR_ENV)
+    if not spool_dir:
+        return None
+    try:
+        rate = float(os.environ.get(PROFILE_RATE_ENV, '1'))
+    except ValueError:
+        # A garbage rate is a typo, not a request for profiling.
+        return None
+    if rate >= 1:
+        return spool_dir
+    # Only pay for importing random when we're sampling.
+    import random  # pylint: disable=import-outside-toplevel
+    if random.random() < rate:
+        return spool_dir
+    return None
+
+
+def _write_dump(profiler, spool_dir, name):
+    """
+        Save a profile into the spool.  We write to a temporary name and
+        rename, so that the report tool never sees half a file.
+        Profiling must never break a connect, so errors are swallowed.
+    """
+    basename = f'{name}.{time.time_ns()}.{os.getpid()}'
+    tmpname = os.path.join(spool_dir, f'.{basename}.tmp')
+    try:
+        profiler.dump_stats(tmpname)
+        os.rename(tmpname, os.path.join(spool_dir, basename + DUMP_SUFFIX))
+    except OSError:
+        pass
+
+
+def profiled(name):
+    """
+        Decorator: profile the wrapped function into the spool directory,
+        when (and as often as) the environment asks for it.
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            spool_dir = _should_profile()
+            if spool_dir is None:
+                return func(*args, **kwargs)
+            import cProfile  # pylint: disable=import-outside-toplevel
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                _write_dump(profiler, spool_dir, name)
+        return _wrapper
+    return _decorator
+
+
+def report_work(argv, output=None):
+    """
+        Merge the dumps in a spool directory and print the hottest functions.
+        Returns True if there was anything to report.
+    """
+    import pstats  # pylint: disable=import-outside-toplevel
+    parser = ArgumentParser(description='Merge client-connect profile dumps')
+    parser.add_argument('--sort', type=str, default='cumulative',
+                        choices=['cumulative', 'tottime', 'ncalls'],
+                        help='How to rank functions')
+    parser.add_argument('--limit', type=int, default=40,
+                        help='How many functions to show')
+    parser.add_argument('--name', type=str, default=None,
+                        help='Only merge dumps from this entry point')
+    parser.add_argument('spool_dir', type=str,
+                        help='Directory the dumps were written to')
+    args = parser.parse_args(argv[1:])
+    if output is None:
+        output = sys.stdout
+
+    stats = None
+    merged = 0
+    for filename in sorted(os.listdir(args.spool_dir)):
+        if not filename.endswith(DUMP_SUFFIX) or filename.startswith('.'):
+            continue
+        if args.name is not None and not filename.startswith(args.name + '.'):
+            continue
+        path = os.path.join(args.spool_dir, filename)
+        try:
+            if stats is None:
+                stats = pstats.Stats(path, stream=output)
+            else:
+                stats.add(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            # Skip anything truncated or not a profile.
+            continue
+        merged += 1
+    if stats is None:
+        print(f'No profile dumps found in {args.spool_dir}', file=output)
+        return False
+    print(f'Merged {merged} profile dumps from {args.spool_dir}', file=output)
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.limit)
+    return True
+
+
+def report_main():
+    """ Interface to the outside """
+    if report_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    report_main()
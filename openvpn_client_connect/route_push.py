@@ -0,0 +1,337 @@
+"""
+    Push route changes to clients that are already connected.
+
+    Routes are worked out at connect time, so a user whose ACLs change
+    keeps their old routes until they reconnect.  This asks openvpn's
+    management interface who is connected, works out each of those
+    users' routes again, and sends each session only the difference:
+    new routes as 'route NET MASK', and routes they should lose as
+    '-route NET MASK', with openvpn 2.7's push-update-cid.
+
+    We only know what a session has from what was pushed to it, so what
+    we last sent each session is kept in a state file.  A session we
+    haven't seen before starts from what client-connect pushed it, if
+    the config has a [session-cache] (see session_table), and its routes
+    are worked out with the same client details client-connect had.
+    Without a record of its connect, a session is taken to have the
+    routes it would get if it connected now, and is sent nothing that
+    run; then, run this often enough (or with --loop) that every session
+    is seen before its user's ACLs change.
+
+    If IAM can't answer for a user, their session is left alone rather
+    than having its routes taken away.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import json
+import time
+from argparse import ArgumentParser
+from openvpn_client_connect.client_connect import ClientConnect
+from openvpn_client_connect.per_user_configs import GetUserRoutes, configure_iam
+from openvpn_client_connect.management import ManagementClient, ManagementError
+from openvpn_client_connect.session_table import session_table_from_config
+sys.dont_write_bytecode = True
+
+__all__ = ['RoutePusher', 'route_options', 'chunk_options']
+
+# How long the options of one push-update-cid may get.  openvpn's
+# control channel messages are limited, so big changes go in pieces.
+MAX_OPTIONS_LENGTH = 900
+
+
+def route_options(push_lines):
+    """
+        'push "route N M"' lines, as the options inside the quotes.
+    """
+    return [line[len('push "'):-1] for line in push_lines]
+
+
+def chunk_options(options, limit=MAX_OPTIONS_LENGTH):
+    """
+        Split options into lists that each join up to at most limit
+        characters (an option longer than that goes on its own).
+    """
+    chunks = []
+    chunk, length = [], 0
+    for option in options:
+        added = len(option) + (2 if chunk else 0)
+        if chunk and length + added > limit:
+            chunks.append(chunk)
+            chunk, length = [], 0
+            added = len(option)
+        chunk.append(option)
+        length += added
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _failed_calls(searcher):
+    """
+        How many made-up answers the searcher has given so far.
+    """
+    try:
+        return getattr(searcher, 'failed_calls', 0)
+    except RuntimeError:
+        return None
+
+
+class RoutePusher:
+    """
+        Keeps the connected clients of one openvpn instance's routes in
+        line with their users' ACLs.
+    """
+    def __init__(self, conf_file, management, password=None, state_file=None,
+                 max_options_length=MAX_OPTIONS_LENGTH):
+        """
+            conf_file is the instance's config, management the address
+            of its management interface.  Without a state_file, what we
+            pushed is only remembered for as long as we run.
+        """
+        self.conf_file = conf_file
+        self.management = management
+        self.password = password
+        self.state_file = state_file
+        self.max_options_length = max_options_length
+        self.sessions = self._load_state()
+
+    @staticmethod
+    def session_name(client):
+        """
+            What we know a session by.  Client IDs are reused after an
+            openvpn restart, so the name and address go in too.
+        """
+        return f'{client.cid}|{client.common_name}|{client.real_address}'
+
+    def _load_state(self):
+        """
+            What we last sent each session, from the state file.
+        """
+        if self.state_file is None:
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as filehandle:
+                state = json.load(filehandle)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            # Start over; every session is new to us again.
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def save_state(self):
+        """
+            Write the state file, atomically.
+        """
+        if self.state_file is None:
+            return
+        temp_file = f'{self.state_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as filehandle:
+            json.dump(self.sessions, filehandle, sort_keys=True)
+        os.replace(temp_file, self.state_file)
+
+    @staticmethod
+    def _routes_for(config_object, user_routes, client, env):
+        """
+            The route options the client's session should have, or None
+            if IAM couldn't tell us.  env is what we know of the client's
+            environment at connect time, which wins over what the
+            management interface says.
+        """
+        if not config_object.office_ip_mapping:
+            return set()
+        client_ip = env.get('trusted_ip', client.client_ip)
+        searcher = user_routes.iam_searcher
+        failures_before = _failed_calls(searcher)
+        effective_username = searcher.verify_sudo_user(env.get('common_name', client.common_name),
+                                                       env.get('username', client.username))
+        routes = user_routes.build_user_routes(
+            effective_username, config_object.get_client_office(client_ip), client_ip,
+            env.get('ifconfig_local'))
+        failures_after = _failed_calls(searcher)
+        if failures_before is None or failures_after != failures_before:
+            return None
+        return set(route_options(config_object.format_route_lines(routes)))
+
+    @staticmethod
+    def _pushed_routes(config_object, lines):
+        """
+            The per-user route options among the lines client-connect
+            pushed (static routes are the config's business, not ours).
+        """
+        static = set(route_options(config_object.get_static_route_lines()))
+        return set(route_options([line for line in lines
+                                  if line.startswith('push "route ')])) - static
+
+    def _connect_records(self):
+        """
+            What client-connect pushed to each connected client, by
+            (common_name, trusted_ip), from the session table if there is one.
+        """
+        sessions = session_table_from_config(self.conf_file)
+        if sessions is None:
+            return {}
+        records = {}
+        # Newest first, so that the newest of any duplicates wins.
+        for record in sessions.connected():
+            records.setdefault((record['env'].get('common_name'),
+                                record['env'].get('trusted_ip')), record)
+        return records
+
+    def _push(self, management, client, added, removed, stats, dry_run):
+        """
+            Send the changes to one session, and return the routes we now
+            know it to have.  We stop at the first refused chunk.
+        """
+        routes = set(self.sessions[self.session_name(client)]['routes'])
+        for options, adding in ([(chunk, True) for chunk in
+                                 chunk_options(added, self.max_options_length)] +
+                                [(chunk, False) for chunk in
+                                 chunk_options(['-' + option for option in removed],
+                                               self.max_options_length)]):
+            if dry_run:
+                print(f'would push to {client.common_name} ({client.cid}): '
+                      f'{", ".join(options)}')
+                continue
+            try:
+                management.push_update(client.cid, options)
+            except ManagementError as err:
+                if 'unknown command' in str(err).lower():
+                    raise ManagementError('push-update-cid needs openvpn 2.7 or later') from err
+                print(f'push to {client.common_name} ({client.cid}) failed: {err}')
+                stats['failed'] += 1
+                break
+            if adding:
+                routes.update(options)
+                stats['added'] += len(options)
+            else:
+                routes.difference_update(option[1:] for option in options)
+                stats['removed'] += len(options)
+        return routes
+
+    def run(self, users=None, dry_run=False):
+        """
+            One pass over the connected clients.  users, if given, limits
+            which already-known sessions are worked out again.  Returns a
+            dict of counts.  Raises ManagementError if we can't talk to
+            the management interface.
+        """
+        stats = {'clients': 0, 'new': 0, 'gone': 0, 'updated': 0, 'added': 0,
+                 'removed': 0, 'skipped': 0, 'failed': 0}
+        with ManagementClient(self.management, self.password) as management:
+            clients = {self.session_name(client): client for client in management.clients()}
+            stats['clients'] = len(clients)
+            for name in [name for name in self.sessions if name not in clients]:
+                del self.sessions[name]
+                stats['gone'] += 1
+
+            # Fresh each run, so that config changes are picked up.
+            config_object = ClientConnect(self.conf_file)
+            user_routes = GetUserRoutes(self.conf_file)
+            if not user_routes.iam_searcher:
+                print('Could not connect to IAM')
+                stats['skipped'] = len(clients)
+                return stats
+            records = self._connect_records()
+            for name, client in sorted(clients.items()):
+                known = self.sessions.get(name)
+                if (users and known is not None and
+                        client.common_name not in users and client.username not in users):
+                    continue
+                record = None
+                if known is None:
+                    record = records.get((client.common_name, client.client_ip))
+                    env = {} if record is None else record['env']
+                else:
+                    env = known.get('env', {})
+                routes = self._routes_for(config_object, user_routes, client, env)
+                if routes is None:
+                    stats['skipped'] += 1
+                    continue
+                if known is None:
+                    stats['new'] += 1
+                    if record is None:
+                        # We can only take it to be up to date.
+                        self.sessions[name] = {'user': client.common_name,
+                                               'routes': sorted(routes), 'env': env}
+                        continue
+                    self.sessions[name] = {
+                        'user': client.common_name, 'env': env,
+                        'routes': sorted(self._pushed_routes(config_object, record['lines']))}
+                old_routes = set(self.sessions[name]['routes'])
+                added = sorted(routes - old_routes)
+                removed = sorted(old_routes - routes)
+                if not added and not removed:
+                    continue
+                stats['updated'] += 1
+                pushed = self._push(management, client, added, removed, stats, dry_run)
+                if not dry_run:
+                    self.sessions[name]['routes'] = sorted(pushed)
+        if not dry_run:
+            self.save_state()
+        return stats
+
+
+def push_work(argv):
+    """
+        One pass (or a loop of them) over the connected clients.
+        Returns True if the management interface and IAM were reachable.
+    """
+    parser = ArgumentParser(description='Push route changes to connected VPN clients')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file', dest='conffile', default=None)
+    parser.add_argument('--management', type=str, required=True,
+                        help='Management interface: a unix socket path, or host:port')
+    parser.add_argument('--password-file', type=str, required=False, default=None,
+                        help='File holding the management password')
+    parser.add_argument('--state', type=str, required=False, default=None,
+                        help='File to remember what each session was sent')
+    parser.add_argument('--user', type=str, action='append', default=[],
+                        help='Only update this user (repeatable)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print what would be pushed, and push nothing')
+    parser.add_argument('--loop', action='store_true',
+                        help='Keep going, every --interval seconds')
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help='Seconds between runs, with --loop')
+    args = parser.parse_args(argv[1:])
+
+    password = None
+    if args.password_file is not None:
+        with open(args.password_file, 'r', encoding='utf-8') as filehandle:
+            password = filehandle.readline().rstrip('\r\n')
+    configure_iam(args.conffile)
+    pusher = RoutePusher(args.conffile, args.management, password=password,
+                         state_file=args.state)
+    while True:
+        try:
+            stats = pusher.run(users=set(args.user), dry_run=args.dry_run)
+        except ManagementError as err:
+            print(f'management interface: {err}')
+            success = False
+        else:
+            print(', '.join(f'{key} {value}' for key, value in stats.items()))
+            success = stats['skipped'] < stats['clients'] or not stats['clients']
+        if not args.loop:
+            return success
+        time.sleep(args.interval)
+
+
+def push_main():
+    """ Interface to the outside """
+    if push_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    push_main()
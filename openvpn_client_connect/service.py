@@ -0,0 +1,696 @@
+"""
+    A long-running client-connect service.
+
+    Rather than starting a fresh python (and a fresh IAM connection) for
+    every connecting client, this keeps one process around that holds the
+    parsed config and talks to IAM asynchronously.  One service can serve
+    several openvpn instances (each with its own config file); they share
+    the IAM connection pool and a short-lived per-user ACL cache, so a user
+    who shows up on two protocols costs one set of IAM lookups.
+    Clients of the service speak newline-delimited JSON over a unix socket:
+
+        {"command": "connect", "conf": "/path/to/instance.conf",
+         "env": {"common_name": ..., ...}}
+        -> {"status": "ok", "lines": [...]}
+        -> {"status": "deny", "reason": "..."}
+        ("conf" picks the instance; without it, the first config is used.)
+
+        {"command": "stats"}
+        -> {"status": "ok", "stats": {...}}
+
+        {"command": "metrics"}
+        -> {"status": "ok", "metrics": "<Prometheus text format>"}
+
+        {"command": "invalidate", "users": [...], "groups": [...], "cidrs": [...]}
+        -> {"status": "ok", "users": [...], "entries": N}
+        (drops cached IAM answers for those users, for users cached as
+        members of those groups, and for users with ACLs overlapping those
+        CIDRs; any of the three lists may be left out.)
+
+    The same metrics can be written to a file for node_exporter's textfile
+    collector (metrics-file), or served over HTTP on localhost (metrics-port).
+    If trace-file is set, each connect also appends a JSON trace record
+    there, from a background writer (see tracing.py).
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+#
+# Requires:
+# iamvpnlibrary
+# netaddr
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+from argparse import ArgumentParser
+from netaddr import AddrFormatError
+from openvpn_client_connect.client_connect import ClientConnect
+from openvpn_client_connect.per_user_configs import (
+    GetUserRoutes, GetUserSearchDomains, configure_iam, fail_closed_value)
+from openvpn_client_connect.iam_async import AsyncIAMAdapter
+from openvpn_client_connect.admission import AdmissionController, AdmissionRejected
+from openvpn_client_connect.singleflight import SingleFlight
+from openvpn_client_connect.acl_cache import UserACLCache
+from openvpn_client_connect.metrics import MetricsRegistry, COUNT_BUCKETS, SIZE_BUCKETS
+from openvpn_client_connect import tracing
+sys.dont_write_bytecode = True
+
+__all__ = ['ConnectService', 'ServiceInstance', 'load_service_settings', 'load_instances']
+
+# What the [service] config section can hold, and the defaults.
+_SERVICE_DEFAULTS = {
+    'socket': '/run/openvpn-client-connect/service.sock',
+    'max-in-flight': 32,
+    'max-queue': 256,
+    'request-timeout': 10.0,
+    'iam-workers': 16,
+    'iam-timeout': 5.0,
+    'metrics-file': '',
+    'metrics-port': 0,
+    'metrics-interval': 15.0,
+    'trace-file': '',
+    'trace-salt': '',
+    'acl-cache-seconds': 30.0,
+    'acl-cache-entries': 20000,
+    'workers': 0,
+    'max-requests': 0,
+    'max-requests-jitter': 0,
+    'health-interval': 5.0,
+    'health-timeout': 30.0,
+}
+
+
+def load_service_settings(conf_file):
+    """
+        Pull the [service] section out of a config file, with defaults
+        for anything missing or unparseable.
+    """
+    _config = ClientConnect._ingest_config_from_file(conf_file)  # pylint: disable=protected-access
+    settings = dict(_SERVICE_DEFAULTS)
+    if not _config.has_section('service'):
+        return settings
+    for key, default in _SERVICE_DEFAULTS.items():
+        if not _config.has_option('service', key):
+            continue
+        value = _config.get('service', key)
+        try:
+            settings[key] = type(default)(value)
+        except ValueError:
+            # Keep the default rather than refusing to start.
+            pass
+    return settings
+
+
+class ServiceInstance:
+    """
+        One openvpn instance's config, and what we build from it.
+    """
+    def __init__(self, conf_file):
+        self.conf_file = conf_file
+        self.config_object = ClientConnect(conf_file)
+        # We ask IAM through our own adapter, so these only hold config.
+        self.user_routes = GetUserRoutes(conf_file, connect=False)
+        self.user_search_domains = GetUserSearchDomains(conf_file, connect=False)
+
+
+def instance_key(conf_file):
+    """
+        How we name an instance: the real path of its config file, so that
+        the same file reached two ways is one instance.
+    """
+    return os.path.realpath(conf_file)
+
+
+def load_instances(conf_files):
+    """
+        A ServiceInstance per config file, keyed by instance_key.
+    """
+    return {instance_key(conf_file): ServiceInstance(conf_file) for conf_file in conf_files}
+
+
+class ConnectService:
+    """
+        The client-connect logic of openvpn_script, as a long-lived object.
+        The results must match what openvpn_script's build_lines produces.
+    """
+    def __init__(self, conf_file, iam=None, admission=None, settings=None, instances=None,
+                 metrics_labels=None):
+        """
+            Load the config(s) once, and set up IAM access and admission
+            control (built from the config unless you hand them in).
+            conf_file is a path, or a list of paths to serve several
+            openvpn instances; the first one's [service] settings and
+            IAM settings are the ones we use.
+            instances, from load_instances, saves loading the configs
+            again; metrics_labels are put on every metric we export.
+        """
+        if isinstance(conf_file, str):
+            conf_file = [conf_file]
+        self.conf_files = list(conf_file)
+        if not self.conf_files:
+            raise ValueError('ConnectService needs at least one config file')
+        if settings is None:
+            settings = load_service_settings(self.conf_files[0])
+        self.settings = settings
+        if instances is None:
+            self.reload()
+        else:
+            self._use_instances(instances)
+        if iam is None:
+            iam = AsyncIAMAdapter(max_workers=settings['iam-workers'],
+                                  timeout=settings['iam-timeout'],
+                                  circuit_breaker=configure_iam(self.conf_files[0]))
+        self.iam = iam
+        if admission is None:
+            admission = AdmissionController(max_in_flight=settings['max-in-flight'],
+                                            max_queue=settings['max-queue'])
+        self.admission = admission
+        self.request_timeout = settings['request-timeout']
+        # Concurrent connects for the same user share one set of IAM calls,
+        # and connects close together (on any instance) share the answers.
+        self.flights = SingleFlight()
+        self.acl_cache = UserACLCache(ttl=settings['acl-cache-seconds'],
+                                      max_entries=settings['acl-cache-entries'])
+        self.open_connections = 0
+        self.metrics = MetricsRegistry(const_labels=metrics_labels)
+        self._setup_metrics()
+        self.trace_writer = None
+        if settings['trace-file']:
+            self.trace_writer = tracing.TraceWriter(settings['trace-file'])
+
+    def _setup_metrics(self):
+        """
+            Create what we record per connect, and hook up the numbers
+            that other objects already keep.
+        """
+        metrics = self.metrics
+        self._phase_seconds = metrics.histogram(
+            'connect_phase_seconds', 'Time spent in each phase of a connect', ['phase'])
+        self._connects = metrics.counter(
+            'connects_total', 'Connects decided, by outcome', ['result'])
+        self._rejections = metrics.counter(
+            'connect_rejections_total', 'Connects refused, by reason', ['reason'])
+        self._route_count = metrics.histogram(
+            'push_routes', 'Routes pushed per connect', buckets=COUNT_BUCKETS)
+        self._push_bytes = metrics.histogram(
+            'push_bytes', 'Size of the pushed config per connect', buckets=SIZE_BUCKETS)
+        metrics.callback('cache_requests_total',
+                         'Cache and coalescing lookups, by whether they were answered '
+                         'without doing the work', ['cache', 'result'],
+                         self._cache_counts, metric_type='counter')
+        metrics.callback('admission', 'Admission control gauges', ['gauge'],
+                         self._admission_gauges)
+        if hasattr(self.iam, 'register_metrics'):
+            self.iam.register_metrics(metrics)
+
+    def _memo_totals(self, attribute):
+        """
+            One kind of memo_stats, added up across our instances.
+        """
+        totals = {'hits': 0, 'misses': 0}
+        for instance in self.instances.values():
+            memo_stats = getattr(instance, attribute).memo_stats
+            for key in totals:
+                totals[key] += memo_stats[key]
+        return totals
+
+    def _cache_counts(self):
+        """
+            Hit/miss counts for the metrics callback.  The instances are
+            replaced on reload, so they're looked up each time.
+        """
+        search_domains = self._memo_totals('user_search_domains')
+        routes = self._memo_totals('user_routes')
+        return {
+            ('search_domains', 'hit'): search_domains['hits'],
+            ('search_domains', 'miss'): search_domains['misses'],
+            ('routes', 'hit'): routes['hits'],
+            ('routes', 'miss'): routes['misses'],
+            ('user_acls', 'hit'): self.acl_cache.stats['hits'],
+            ('user_acls', 'miss'): self.acl_cache.stats['misses'],
+            ('iam_singleflight', 'hit'): self.flights.stats['shared'],
+            ('iam_singleflight', 'miss'): self.flights.stats['executed'],
+        }
+
+    def _admission_gauges(self):
+        """
+            Admission control's current state, for the metrics callback.
+        """
+        snap = self.admission.snapshot()
+        return {(key,): snap[key] for key in ('in_flight', 'queue_depth',
+                                              'service_seconds_estimate')}
+
+    def reload(self):
+        """
+            (Re)read the config files.  Anything memoized from the old
+            configs goes away with the old objects.  Cached IAM answers
+            don't depend on the config, so they stay.
+        """
+        self._use_instances(load_instances(self.conf_files))
+
+    def _use_instances(self, instances):
+        """
+            Serve these instances from now on.
+        """
+        self.instances = instances
+        self.default_instance = instances[instance_key(self.conf_files[0])]
+
+    def get_instance(self, conf_file=None):
+        """
+            The instance for a config path (None means the first one),
+            or None if we don't serve that config.
+        """
+        if conf_file is None:
+            return self.default_instance
+        return self.instances.get(instance_key(conf_file))
+
+    @property
+    def conf_file(self):
+        """ The first (default) instance's config file """
+        return self.default_instance.conf_file
+
+    @property
+    def config_object(self):
+        """ The default instance's ClientConnect """
+        return self.default_instance.config_object
+
+    @property
+    def user_routes(self):
+        """ The default instance's GetUserRoutes """
+        return self.default_instance.user_routes
+
+    @property
+    def user_search_domains(self):
+        """ The default instance's GetUserSearchDomains """
+        return self.default_instance.user_search_domains
+
+    async def _user_allowed(self, userid):
+        """
+            user_allowed_to_vpn, shared among concurrent connects.
+        """
+        return await self.flights.do(('user_allowed_to_vpn', userid),
+                                     lambda: self.iam.user_allowed_to_vpn(userid))
+
+    async def _effective_username(self, username_is, username_as):
+        """
+            verify_sudo_user, shared among concurrent connects.
+        """
+        return await self.flights.do(('verify_sudo_user', username_is, username_as),
+                                     lambda: self.iam.verify_sudo_user(username_is,
+                                                                       username_as))
+
+    async def _user_query(self, method_name, username):
+        """
+            A per-user IAM query, answered from the ACL cache if we can,
+            and shared among concurrent connects if we can't.
+            A failure gets the fail-closed answer, which isn't cached.
+        """
+        hit, value = self.acl_cache.get(method_name, username)
+        if hit:
+            return value
+
+        async def _fetch():
+            epoch = self.acl_cache.epoch
+            try:
+                answer = await self.iam.call(method_name, username)
+            except Exception:  # pylint: disable=broad-except
+                # Whatever IAM did, it didn't tell us what this user may have.
+                return fail_closed_value(method_name, username)
+            self.acl_cache.put(method_name, username, answer, epoch=epoch)
+            return answer
+        return await self.flights.do((method_name, username), _fetch)
+
+    async def _build_user_profile(self, instance, effective_username):
+        """
+            Everything about a connect to this instance that depends on who
+            the user is, but not on where they're connecting from.
+        """
+        config_object = instance.config_object
+        fetches = [self._user_query('get_allowed_vpn_acls', effective_username)]
+        if config_object.office_ip_mapping:
+            fetches.append(self._user_query('get_allowed_vpn_ips', effective_username))
+        results = await asyncio.gather(*fetches)
+
+        user_groups = {x.rule for x in results[0]}
+        profile = {
+            'search_domain_lines': instance.user_search_domains.get_search_domain_lines(
+                user_groups),
+            # None means "no dynamic routes at all", as opposed to
+            # "only the office routes".
+            'nonoffice_routes': None,
+        }
+        if config_object.office_ip_mapping and results[1]:
+            profile['nonoffice_routes'] = instance.user_routes.build_nonoffice_routes(
+                results[1])
+        return profile
+
+    async def _user_profile(self, instance, effective_username):
+        """
+            _build_user_profile, shared among concurrent connects.
+        """
+        return await self.flights.do(
+            ('profile', instance_key(instance.conf_file), effective_username),
+            lambda: self._build_user_profile(instance, effective_username))
+
+    async def build_lines(self, username_is, username_as, client_ip, server_ip=None,
+                          instance=None):
+        """
+            Create the contents of the lines that should be returned
+            to the connecting client.  This is openvpn_script.build_lines,
+            with the IAM calls made asynchronously and only once each,
+            and with the per-user work shared among concurrent connects.
+            instance is the ServiceInstance to build for (default: the first).
+        """
+        if instance is None:
+            instance = self.default_instance
+        config_object = instance.config_object
+        started = time.perf_counter()
+        effective_username = await self._effective_username(username_is, username_as)
+        profile = await self._user_profile(instance, effective_username)
+        profiled = time.perf_counter()
+        self._phase_seconds.observe(profiled - started, phase='profile')
+
+        output_array = []
+        output_array += config_object.get_dns_server_lines()
+        output_array += profile['search_domain_lines']
+        if profile['nonoffice_routes'] is not None:
+            # Only the office part is specific to this connection:
+            user_at_office = config_object.get_client_office(client_ip)
+            tracing.current_trace().set(office=user_at_office)
+            user_routes = instance.user_routes.add_office_routes(
+                profile['nonoffice_routes'], user_at_office, client_ip, server_ip)
+            output_array += config_object.format_route_lines(user_routes)
+        output_array += config_object.get_static_route_lines()
+        output_array += config_object.get_protocol_lines()
+        self._phase_seconds.observe(time.perf_counter() - profiled, phase='render')
+        return output_array
+
+    async def handle_connect(self, env, conf_file=None):
+        """
+            Decide on one connecting client, given its openvpn environment
+            and the config of the openvpn instance it's connecting to.
+            Returns (True, lines) or (False, reason).
+        """
+        started = time.perf_counter()
+        trace = tracing.NULL_TRACE
+        if self.trace_writer is not None:
+            trace = tracing.ConnectTrace('service', salt=self.settings['trace-salt'])
+        token = tracing.activate(trace)
+        try:
+            allowed, result = await self._decide(env, conf_file)
+        finally:
+            tracing.deactivate(token)
+        self._phase_seconds.observe(time.perf_counter() - started, phase='total')
+        if trace:
+            if allowed:
+                self.trace_writer.submit(trace.record(True, result))
+            else:
+                trace.set(reason=result)
+                self.trace_writer.submit(trace.record(False))
+        if allowed:
+            self._connects.inc(result='allowed')
+            self._route_count.observe(sum(1 for line in result
+                                          if line.startswith('push "route')))
+            self._push_bytes.observe(sum(len(line) + 1 for line in result))
+        else:
+            self._connects.inc(result='rejected')
+            self._rejections.inc(reason=result)
+        return allowed, result
+
+    async def _decide(self, env, conf_file):
+        """
+            The body of handle_connect.
+        """
+        instance = self.get_instance(conf_file)
+        if instance is None:
+            return False, 'unknown_conf'
+        usercn = env.get('common_name')
+        trusted_ip = env.get('trusted_ip')
+        client_version_string = env.get('IV_VER')
+        trace = tracing.current_trace()
+        trace.set(username=usercn, iv_ver=client_version_string)
+        if not usercn:
+            return False, 'missing_common_name'
+        if not trusted_ip:
+            return False, 'missing_trusted_ip'
+        if not client_version_string:
+            return False, 'missing_iv_ver'
+        version_allowed = instance.config_object.client_version_allowed(client_version_string)
+        trace.set(iv_ver_allowed=version_allowed)
+        if not version_allowed:
+            return False, 'version'
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.request_timeout
+        try:
+            async with self.admission.admit(deadline) as waited:
+                self._phase_seconds.observe(waited, phase='queue')
+                authorize_started = time.perf_counter()
+                user_allowed = await self._user_allowed(usercn)
+                self._phase_seconds.observe(time.perf_counter() - authorize_started,
+                                            phase='authorize')
+                if not user_allowed:
+                    return False, 'not_allowed'
+                lines = await asyncio.wait_for(
+                    self.build_lines(usercn, env.get('username'), trusted_ip,
+                                     env.get('ifconfig_local'), instance),
+                    max(0, deadline - loop.time()))
+        except AdmissionRejected as err:
+            return False, f'overloaded_{err.reason}'
+        except asyncio.TimeoutError:
+            return False, 'timeout'
+        except Exception:  # pylint: disable=broad-except
+            # Anything we didn't see coming is still a 'no', and still
+            # gets counted and answered, rather than dropping the client.
+            return False, 'error'
+        return True, lines
+
+    def stats(self):
+        """
+            What we can tell an operator about how we're doing.
+        """
+        return {'admission': self.admission.snapshot(),
+                'singleflight': dict(self.flights.stats),
+                'acl_cache': dict(self.acl_cache.stats, entries=len(self.acl_cache)),
+                'search_domain_memo': self._memo_totals('user_search_domains'),
+                'route_memo': self._memo_totals('user_routes'),
+                'instances': sorted(self.instances)}
+
+    async def handle_request(self, request):
+        """
+            Dispatch one decoded request, returning the response to send.
+        """
+        if not isinstance(request, dict):
+            return {'status': 'error', 'reason': 'bad_request'}
+        command = request.get('command')
+        if command == 'connect':
+            env = request.get('env')
+            conf_file = request.get('conf')
+            if not isinstance(env, dict) or not isinstance(conf_file, (str, type(None))):
+                return {'status': 'error', 'reason': 'bad_request'}
+            allowed, result = await self.handle_connect(env, conf_file)
+            if allowed:
+                return {'status': 'ok', 'lines': result}
+            return {'status': 'deny', 'reason': result}
+        if command == 'stats':
+            return {'status': 'ok', 'stats': self.stats()}
+        if command == 'metrics':
+            return {'status': 'ok', 'metrics': self.metrics.render()}
+        if command == 'invalidate':
+            return self.handle_invalidate(request)
+        return {'status': 'error', 'reason': 'unknown_command'}
+
+    def handle_invalidate(self, request):
+        """
+            Handle an invalidate request: drop cached IAM answers so that
+            the next connects ask IAM again.  The route and search domain
+            memos are keyed by what the answers were, so they can't be
+            stale, and are left alone.
+        """
+        targets = {}
+        for field in ('users', 'groups', 'cidrs'):
+            values = request.get(field, [])
+            if not isinstance(values, list) or \
+                    not all(isinstance(value, str) for value in values):
+                return {'status': 'error', 'reason': 'bad_request'}
+            targets[field] = values
+        if not any(targets.values()):
+            return {'status': 'error', 'reason': 'bad_request'}
+        try:
+            users, entries = self.acl_cache.invalidate(**targets)
+        except AddrFormatError:
+            return {'status': 'error', 'reason': 'bad_cidr'}
+        return {'status': 'ok', 'users': users, 'entries': entries}
+
+    async def _serve_connection(self, reader, writer):
+        """
+            Handle requests from one socket client until it hangs up.
+        """
+        self.open_connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {'status': 'error', 'reason': 'bad_json'}
+                else:
+                    response = await self.handle_request(request)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.open_connections -= 1
+            writer.close()
+
+    async def start(self, socket_path=None, sock=None):
+        """
+            Start listening, either on a path or an existing socket.
+            Returns the asyncio server.
+        """
+        if sock is not None:
+            return await asyncio.start_unix_server(self._serve_connection, sock=sock)
+        if socket_path is None:
+            socket_path = self.settings['socket']
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self._serve_connection, path=socket_path)
+        os.chmod(socket_path, 0o660)
+        return server
+
+    async def _serve_metrics_http(self, reader, writer):
+        """
+            Answer one HTTP request: GET /metrics gets the exposition,
+            anything else a 404.  This is for a local scraper, not the world.
+        """
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1] == b'/metrics':
+                status, body = '200 OK', self.metrics.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.0 {status}\r\n'
+                         'Content-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start_metrics_http(self, port=None):
+        """
+            Serve metrics over HTTP.  We only ever listen on localhost.
+            Returns the asyncio server.
+        """
+        if port is None:
+            port = self.settings['metrics-port']
+        return await asyncio.start_server(self._serve_metrics_http, host='127.0.0.1',
+                                          port=port)
+
+    async def write_metrics_periodically(self, path=None, interval=None):
+        """
+            Rewrite the metrics textfile every interval seconds, forever.
+        """
+        if path is None:
+            path = self.settings['metrics-file']
+        if interval is None:
+            interval = self.settings['metrics-interval']
+        while True:
+            try:
+                self.metrics.write_textfile(path)
+            except OSError:
+                # A full disk shouldn't take connects down with it.
+                pass
+            await asyncio.sleep(interval)
+
+    async def serve_forever(self, socket_path=None):
+        """
+            Run the service until we're killed.
+        """
+        server = await self.start(socket_path)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+        metrics_server = None
+        metrics_writer = None
+        if self.settings['metrics-port']:
+            metrics_server = await self.start_metrics_http()
+        if self.settings['metrics-file']:
+            metrics_writer = asyncio.create_task(self.write_metrics_periodically())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if metrics_writer is not None:
+                metrics_writer.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+
+    def close(self):
+        """
+            Release the resources we hold.
+        """
+        self.iam.close()
+        if self.trace_writer is not None:
+            self.trace_writer.close()
+
+
+def main_work(argv):
+    """
+        Parse arguments and run the service.
+    """
+    parser = ArgumentParser(description='Args for the client-connect service')
+    parser.add_argument('--conf', type=str, required=True, action='append',
+                        help='Config file of an openvpn instance to serve; repeat for '
+                             'several instances (the first one sets the service options)',
+                        dest='conffiles', default=None)
+    parser.add_argument('--socket', type=str, required=False,
+                        help='Unix socket to listen on (overrides the config)',
+                        dest='socket', default=None)
+    parser.add_argument('--workers', type=int, required=False,
+                        help='Worker processes to fork (overrides the config; '
+                             '0 serves from this process)',
+                        dest='workers', default=None)
+    args = parser.parse_args(argv[1:])
+
+    settings = load_service_settings(args.conffiles[0])
+    if args.workers is not None:
+        settings['workers'] = args.workers
+    if settings['workers'] > 0:
+        # pylint: disable=import-outside-toplevel
+        from openvpn_client_connect.prefork import PreforkServer
+        return PreforkServer(args.conffiles, settings=settings, socket_path=args.socket).run()
+
+    service = ConnectService(args.conffiles, settings=settings)
+    try:
+        asyncio.run(service.serve_forever(args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return True
+
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
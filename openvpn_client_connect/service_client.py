@@ -0,0 +1,152 @@
+"""
+    The client half of the client-connect service.
+
+    This is deliberately tiny (no asyncio, no IAM) so that a client-connect
+    script which hands its work to the service starts up quickly.
+
+    It's also home to openvpn-client-connect-invalidate, which tells a
+    running service to forget cached IAM answers after an ACL change,
+    along with the shared cache, ACL replica and session table that the
+    config sets up for the host.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import sys
+import glob
+import json
+import socket
+from argparse import ArgumentParser
+sys.dont_write_bytecode = True
+
+__all__ = ['service_request', 'worker_socket_path', 'service_sockets']
+
+
+def worker_socket_path(socket_path, slot):
+    """
+        The socket that only one prefork worker listens on.
+    """
+    return f'{socket_path}.worker{slot}'
+
+
+def service_sockets(socket_path):
+    """
+        Every socket a request must go to to reach the whole service:
+        each worker's own socket if the service runs workers (they each
+        have their own caches), or else the service socket.
+    """
+    workers = sorted(glob.glob(glob.escape(socket_path) + '.worker*'))
+    return workers or [socket_path]
+
+
+def service_request(socket_path, request, timeout=30.0):
+    """
+        Send one request to the service and return its decoded response.
+        Returns None if we couldn't get an answer.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as filehandle:
+                line = filehandle.readline()
+    except OSError:
+        return None
+    try:
+        response = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(response, dict):
+        return None
+    return response
+
+
+def _forget_on_host(conffile, users):
+    """
+        Make the host-wide stores a config sets up forget users.
+        Return True if nothing went wrong.
+    """
+    # pylint: disable=import-outside-toplevel
+    from openvpn_client_connect.per_user_configs import forget_iam_answers
+    from openvpn_client_connect.session_table import session_table_from_config
+    success = True
+    try:
+        dropped, marked = forget_iam_answers(conffile, users)
+    except RuntimeError as err:
+        print(err, file=sys.stderr)
+        dropped, marked, success = None, None, False
+    if dropped is not None:
+        print(f'shared cache: dropped {dropped} entries')
+    if marked is not None:
+        print(f'acl replica: marked {marked} users stale')
+    sessions = session_table_from_config(conffile)
+    if sessions is not None:
+        print(f'session table: removed {sessions.forget(users)} sessions')
+    return success
+
+
+def invalidate_work(argv):
+    """
+        Ask a running service to drop cached IAM answers, and with
+        --conf, have the host-wide stores drop them too.
+        Return True if everything did.
+    """
+    parser = ArgumentParser(description='Make the client-connect service forget cached '
+                                        'IAM answers, after an ACL change')
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--socket', type=str, help='The service\'s unix socket (only the '
+                                                  'service\'s own caches are cleared)',
+                       dest='socket', default=None)
+    where.add_argument('--conf', type=str, help='Config file with the [service] socket; '
+                                                'its shared cache, ACL replica and session '
+                                                'table are cleared too',
+                       dest='conffile', default=None)
+    parser.add_argument('--user', type=str, action='append', default=[], dest='users',
+                        help='Forget this user (repeatable)')
+    parser.add_argument('--group', type=str, action='append', default=[], dest='groups',
+                        help='Forget everyone with an ACL from this group (repeatable)')
+    parser.add_argument('--cidr', type=str, action='append', default=[], dest='cidrs',
+                        help='Forget everyone with an ACL overlapping this (repeatable)')
+    args = parser.parse_args(argv[1:])
+    if not (args.users or args.groups or args.cidrs):
+        parser.error('give at least one --user, --group or --cidr')
+
+    socket_path = args.socket
+    if socket_path is None:
+        # pylint: disable=import-outside-toplevel
+        from openvpn_client_connect.service import load_service_settings
+        socket_path = load_service_settings(args.conffile)['socket']
+    request = {'command': 'invalidate', 'users': args.users, 'groups': args.groups,
+               'cidrs': args.cidrs}
+    success = True
+    # Only the services know who is in a group or has a CIDR.
+    users = set(args.users)
+    for path in service_sockets(socket_path):
+        response = service_request(path, request)
+        if response is None:
+            print(f'{path}: no answer', file=sys.stderr)
+            success = False
+        elif response.get('status') != 'ok':
+            print(f'{path}: {response.get("reason")}', file=sys.stderr)
+            success = False
+        else:
+            users.update(response['users'])
+            print(f'{path}: dropped {response["entries"]} entries for '
+                  f'{len(response["users"])} users: {", ".join(response["users"])}')
+    if args.conffile is not None and users:
+        success = _forget_on_host(args.conffile, sorted(users)) and success
+    return success
+
+
+def invalidate_main():
+    """ Interface to the outside """
+    if invalidate_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
@@ -0,0 +1,264 @@
+"""
+    A small table of recent client sessions, for fast reconnects.
+
+    Clients often come straight back after a UDP timeout or a network
+    switch, with the same common_name, trusted_ip and IV_VER.  Their push
+    output would be the same as last time, so the client-connect script
+    remembers what it pushed, and the client-disconnect script marks the
+    session as closed.  A reconnect within window seconds of the
+    disconnect, against an unchanged config file, gets the remembered
+    output without looking up ACLs or working out routes again.  (The
+    version and user checks still come first.)
+
+    The table is a directory with a file per session: KEY.open while the
+    client is connected, renamed to KEY.closed on disconnect (its mtime
+    is then the disconnect time).  A reconnect renames KEY.closed back to
+    KEY.open, which is atomic, so only one connect can reuse a session.
+
+    Output is never reused once it's more than max_age seconds old, so a
+    change in someone's ACLs reaches them within max_age plus window even
+    if they keep reconnecting.  The directory must only be writable by
+    the user openvpn runs scripts as: what's in it gets pushed to clients.
+
+        [session-cache]
+        directory = /var/run/openvpn-client-connect/sessions
+        window = 60
+        max-age = 3600
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import json
+import time
+import hashlib
+import configparser
+sys.dont_write_bytecode = True
+
+__all__ = ['SessionTable', 'session_key', 'config_snapshot', 'session_table_from_config']
+
+# The parts of openvpn's environment that the push output depends on.
+SESSION_ENV_VARS = ('common_name', 'username', 'trusted_ip', 'IV_VER')
+# What we keep of the environment with a session, to find it by later.
+_KEPT_ENV_VARS = SESSION_ENV_VARS + ('ifconfig_local',)
+
+
+def session_key(conf_file, env):
+    """
+        A name for a session: the config it's served under, and who
+        connected from where with what client.
+    """
+    parts = [os.path.abspath(conf_file)] + [env.get(var) or '' for var in SESSION_ENV_VARS]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def config_snapshot(conf_file):
+    """
+        Something that changes whenever the config file does, or None if
+        we can't tell.
+    """
+    try:
+        stat = os.stat(conf_file)
+    except OSError:
+        return None
+    return f'{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class SessionTable:
+    """
+        Remembered push output, by session key.
+        Nothing here raises on a filesystem problem: the worst a broken
+        table can do is send a connect down the slow path.
+    """
+    def __init__(self, directory, window=60.0, max_age=3600.0, clock=time.time):
+        self.directory = directory
+        self.window = window
+        self.max_age = max_age
+        self._clock = clock
+
+    def _path(self, key, state):
+        """ Where a session's file is in a state ('open' or 'closed') """
+        return os.path.join(self.directory, f'{key}.{state}')
+
+    def remember(self, key, snapshot, lines, env=None):
+        """
+            A client connected and we pushed lines to it.  env is the
+            client's environment, some of which is kept with the lines.
+        """
+        if snapshot is None:
+            return
+        kept_env = {var: env[var] for var in _KEPT_ENV_VARS if env and var in env}
+        data = json.dumps({'snapshot': snapshot, 'rendered_at': self._clock(),
+                           'env': kept_env, 'lines': lines}, separators=(',', ':'))
+        final = self._path(key, 'open')
+        temp = f'{final}.{os.getpid()}'
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.write(fd, data.encode('utf-8'))
+            finally:
+                os.close(fd)
+            os.replace(temp, final)
+            # Any older closed session is superseded by this one.
+            os.unlink(self._path(key, 'closed'))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+
+    def close(self, key):
+        """
+            A client disconnected: start its reconnect window.
+            Returns True if we knew the session.
+        """
+        closed = self._path(key, 'closed')
+        try:
+            os.rename(self._path(key, 'open'), closed)
+            now = self._clock()
+            os.utime(closed, (now, now))
+        except OSError:
+            return False
+        return True
+
+    def reuse(self, key, snapshot):
+        """
+            The lines to push to a reconnecting client, or None if this
+            connect must be worked out afresh.  A reused session is open
+            again, ready for its next disconnect.
+        """
+        if snapshot is None:
+            return None
+        closed = self._path(key, 'closed')
+        try:
+            if os.stat(closed).st_mtime < self._clock() - self.window:
+                return None
+            opened = self._path(key, 'open')
+            # Claim it.  If someone else got there first, this fails.
+            os.rename(closed, opened)
+            with open(opened, 'r', encoding='utf-8') as filehandle:
+                entry = json.load(filehandle)
+        except (OSError, ValueError):
+            return None
+        if (not isinstance(entry, dict) or entry.get('snapshot') != snapshot or
+                entry.get('rendered_at', 0) < self._clock() - self.max_age or
+                not isinstance(entry.get('lines'), list)):
+            return None
+        return entry['lines']
+
+    def release(self, key):
+        """
+            Hand back a session that reuse() claimed, for a connect that
+            then didn't go ahead.  Its reconnect window carries on as if
+            it had never been claimed.  Returns True if we knew the session.
+        """
+        try:
+            os.rename(self._path(key, 'open'), self._path(key, 'closed'))
+        except OSError:
+            return False
+        return True
+
+    def _entries(self, states=('open', 'closed')):
+        """
+            (path, entry) for every session file in one of states that
+            we can read.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(tuple(f'.{state}' for state in states)):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as filehandle:
+                    entry = json.load(filehandle)
+            except (OSError, ValueError):
+                continue
+            if isinstance(entry, dict):
+                yield path, entry
+
+    def connected(self):
+        """
+            What we pushed to each client that is connected now, as
+            dicts of the env we kept and the lines, newest first.
+        """
+        entries = [entry for _, entry in self._entries(states=('open',))
+                   if isinstance(entry.get('lines'), list)]
+        entries.sort(key=lambda entry: entry.get('rendered_at', 0), reverse=True)
+        return [{'env': entry.get('env') or {}, 'lines': entry['lines']} for entry in entries]
+
+    def forget(self, usernames):
+        """
+            Remove the sessions, open or closed, of these users (by
+            common_name or username), so that their next connects are
+            worked out afresh.  Returns how many went.
+        """
+        usernames = set(usernames)
+        removed = 0
+        for path, entry in self._entries():
+            env = entry.get('env') or {}
+            if env.get('common_name') in usernames or env.get('username') in usernames:
+                try:
+                    os.unlink(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def prune(self):
+        """
+            Remove closed sessions past their window, and open sessions
+            too old to reuse (their disconnect never ran).
+            Returns how many went.
+        """
+        now = self._clock()
+        removed = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        for name in names:
+            if name.endswith('.closed'):
+                cutoff = now - self.window
+            elif name.endswith('.open'):
+                cutoff = now - self.max_age
+            else:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+def session_table_from_config(conf_file):
+    """
+        The SessionTable that a config file's [session-cache] section
+        describes, or None.
+    """
+    config = configparser.ConfigParser()
+    try:
+        config.read(conf_file)
+        if not config.has_option('session-cache', 'directory'):
+            return None
+        return SessionTable(config.get('session-cache', 'directory'),
+                            window=config.getfloat('session-cache', 'window', fallback=60.0),
+                            max_age=config.getfloat('session-cache', 'max-age',
+                                                    fallback=3600.0))
+    except (configparser.Error, ValueError):
+        return None
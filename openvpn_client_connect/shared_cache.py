@@ -0,0 +1,247 @@
+"""
+    A cache shared by every client-connect process on a host.
+
+    Sites that run the plain exec-per-connect script (no service) still
+    see the same user connect to several openvpn instances in quick
+    succession.  This cache lives in a memory-mapped file, so that each
+    short-lived script process can pick up the IAM answers and routes that
+    a sibling worked out moments ago.
+
+    Layout: a header, then a fixed number of fixed-size slots, so the
+    file (and the memory it maps) never grows past slots * slot_bytes.
+    A key hashes to two neighbouring slots; a new entry replaces the one
+    of those that is expired or expires soonest.
+
+    Reads take no lock.  Each slot carries a sequence number that a
+    writer makes odd before changing the slot and even again after, so a
+    reader that sees an odd number, or a number that changed while it was
+    reading, knows it saw a torn entry and treats it as a miss.  Writers
+    serialize among themselves with flock on the file.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import json
+import time
+import mmap
+import fcntl
+import struct
+import hashlib
+sys.dont_write_bytecode = True
+
+__all__ = ['SharedCache', 'open_shared_cache']
+
+_MAGIC = b'OCCSHC01'
+# magic, number of slots, bytes per slot
+_FILE_HEADER = struct.Struct('<8sII')
+_FILE_HEADER_BYTES = 64
+# sequence number, key hash, expiry (epoch seconds), payload length
+_SLOT_HEADER = struct.Struct('<I16sdI')
+_SEQ = struct.Struct('<I')
+_EMPTY_KEY = b'\0' * 16
+_READ_ATTEMPTS = 3
+
+
+def _key_hash(key):
+    """
+        16 bytes that stand for a key.
+    """
+    return hashlib.sha256(key.encode('utf-8')).digest()[:16]
+
+
+class SharedCache:
+    """
+        A fixed-size, TTL'ed key/value cache in a memory-mapped file.
+        Keys are strings; values are anything json can round-trip.
+    """
+    def __init__(self, path, slots=4096, slot_bytes=4096, default_ttl=30.0):
+        """
+            Open (creating if need be) the cache file at path.
+            If the file already exists with a valid header, its own
+            geometry wins over slots/slot_bytes, so that processes with
+            different settings never disagree about the layout.
+            Raises OSError if the file can't be opened or mapped.
+        """
+        if slot_bytes <= _SLOT_HEADER.size or slots < 2:
+            raise ValueError('the shared cache needs at least 2 slots with room for data')
+        self.path = path
+        self.default_ttl = default_ttl
+        self.stats = {'hits': 0, 'misses': 0, 'torn': 0, 'writes': 0, 'too_big': 0}
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self.slots, self.slot_bytes = self._init_file(slots, slot_bytes)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(self._fd, self._file_size(self.slots, self.slot_bytes))
+        except (OSError, ValueError):
+            os.close(self._fd)
+            raise
+
+    @staticmethod
+    def _file_size(slots, slot_bytes):
+        """
+            How big the file is for a geometry.
+        """
+        return _FILE_HEADER_BYTES + slots * slot_bytes
+
+    def _init_file(self, slots, slot_bytes):
+        """
+            With the lock held: adopt the file's geometry if it has a valid
+            header, otherwise lay out a new, empty file.
+            We never shrink a file: another process may have it mapped.
+        """
+        size = os.fstat(self._fd).st_size
+        if size >= _FILE_HEADER_BYTES:
+            magic, file_slots, file_slot_bytes = _FILE_HEADER.unpack(
+                os.pread(self._fd, _FILE_HEADER.size, 0))
+            if (magic == _MAGIC and file_slots >= 2 and file_slot_bytes > _SLOT_HEADER.size
+                    and size >= self._file_size(file_slots, file_slot_bytes)):
+                return file_slots, file_slot_bytes
+        if size > 0:
+            raise ValueError(f'{self.path} is not a shared cache file')
+        os.ftruncate(self._fd, self._file_size(slots, slot_bytes))
+        os.pwrite(self._fd, _FILE_HEADER.pack(_MAGIC, slots, slot_bytes), 0)
+        return slots, slot_bytes
+
+    def _slot_offsets(self, key_hash):
+        """
+            The two slots a key may live in.
+        """
+        first = int.from_bytes(key_hash[:8], 'little') % self.slots
+        second = (first + 1) % self.slots
+        return [_FILE_HEADER_BYTES + index * self.slot_bytes for index in (first, second)]
+
+    def _read_slot(self, offset, key_hash, now):
+        """
+            Without locking, read one slot.  Returns (found, payload bytes);
+            found is None if the slot was being written while we looked.
+        """
+        for _ in range(_READ_ATTEMPTS):
+            seq, slot_key, expires, length = _SLOT_HEADER.unpack_from(self._map, offset)
+            if seq % 2:
+                continue
+            if slot_key != key_hash or expires <= now:
+                found, payload = False, None
+            elif length > self.slot_bytes - _SLOT_HEADER.size:
+                continue
+            else:
+                start = offset + _SLOT_HEADER.size
+                found, payload = True, self._map[start:start + length]
+            if _SEQ.unpack_from(self._map, offset)[0] == seq:
+                return found, payload
+        return None, None
+
+    def get(self, key):
+        """
+            Return (True, value) if we hold a fresh value for key,
+            else (False, None).  Never blocks.
+        """
+        key_hash = _key_hash(key)
+        now = time.time()
+        for offset in self._slot_offsets(key_hash):
+            found, payload = self._read_slot(offset, key_hash, now)
+            if found is None:
+                self.stats['torn'] += 1
+                continue
+            if found:
+                try:
+                    value = json.loads(payload)
+                except ValueError:
+                    self.stats['torn'] += 1
+                    continue
+                self.stats['hits'] += 1
+                return True, value
+        self.stats['misses'] += 1
+        return False, None
+
+    def _pick_slot(self, key_hash, now):
+        """
+            With the lock held: the slot to write key_hash into.
+            Its own slot if it has one, else a free or expired one,
+            else whichever expires soonest.
+        """
+        candidates = []
+        for offset in self._slot_offsets(key_hash):
+            _, slot_key, expires, _ = _SLOT_HEADER.unpack_from(self._map, offset)
+            if slot_key == key_hash:
+                return offset
+            if slot_key == _EMPTY_KEY or expires <= now:
+                expires = 0
+            candidates.append((expires, offset))
+        return min(candidates)[1]
+
+    def put(self, key, value, ttl=None):
+        """
+            Store value under key for ttl seconds (default_ttl if None).
+            Values too big for a slot are silently not cached.
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+        if ttl <= 0:
+            return
+        payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(payload) > self.slot_bytes - _SLOT_HEADER.size:
+            self.stats['too_big'] += 1
+            return
+        key_hash = _key_hash(key)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            offset = self._pick_slot(key_hash, now)
+            # A writer that died mid-write leaves an odd number; |1 copes.
+            seq = _SEQ.unpack_from(self._map, offset)[0] | 1
+            _SEQ.pack_into(self._map, offset, seq)
+            start = offset + _SLOT_HEADER.size
+            self._map[start:start + len(payload)] = payload
+            _SLOT_HEADER.pack_into(self._map, offset, seq, key_hash, now + ttl, len(payload))
+            _SEQ.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.stats['writes'] += 1
+
+    def discard(self, key):
+        """
+            Drop key, if we hold it.  Returns True if we did.
+        """
+        key_hash = _key_hash(key)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for offset in self._slot_offsets(key_hash):
+                seq, slot_key, _, _ = _SLOT_HEADER.unpack_from(self._map, offset)
+                if slot_key == key_hash:
+                    seq |= 1
+                    _SEQ.pack_into(self._map, offset, seq)
+                    _SLOT_HEADER.pack_into(self._map, offset, seq, _EMPTY_KEY, 0, 0)
+                    _SEQ.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+                    return True
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return False
+
+    def close(self):
+        """
+            Unmap and close the file.
+        """
+        self._map.close()
+        os.close(self._fd)
+
+
+def open_shared_cache(path, slots=4096, slot_bytes=4096, default_ttl=30.0):
+    """
+        A SharedCache, or None if we can't have one.  A broken cache file
+        must never stop anyone connecting; it just means no sharing.
+    """
+    try:
+        return SharedCache(path, slots=slots, slot_bytes=slot_bytes, default_ttl=default_ttl)
+    except (OSError, ValueError):
+        return None
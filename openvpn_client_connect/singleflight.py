@@ -0,0 +1,64 @@
+"""
+    Coalescing of identical concurrent work.
+
+    People connect several devices at once, or come back on several of our
+    openvpn instances in the same second.  Each of those connects would ask
+    IAM the same questions about the same user.  A SingleFlight lets the
+    first one do the work while the rest wait for (and share) its answer.
+    Nothing is kept once the work is done, so this never serves stale data.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import sys
+import asyncio
+sys.dont_write_bytecode = True
+
+__all__ = ['SingleFlight']
+
+
+class SingleFlight:
+    """
+        Run at most one instance of the work for a given key at a time.
+        Callers that arrive while it's running get the same result
+        (or the same exception).
+    """
+    def __init__(self):
+        self._in_flight = {}
+        self.stats = {'executed': 0, 'shared': 0}
+
+    async def do(self, key, func):
+        """
+            Return the result of await func(), sharing it with anyone who
+            asks for the same key while it's running.
+            func is a zero-argument function that returns an awaitable.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            self.stats['executed'] += 1
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _task: self._forget(key, _task))
+        else:
+            self.stats['shared'] += 1
+        # shield: one caller being cancelled must not cancel everyone's work.
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        """
+            Drop a finished task, unless it's already been replaced.
+        """
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def __len__(self):
+        """
+            How many keys have work in flight.
+        """
+        return len(self._in_flight)
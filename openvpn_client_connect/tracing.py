@@ -0,0 +1,321 @@
+"""
+    Per-connect trace records, as JSON lines.
+
+    Each connect can produce one record: who (as an anonymized hash),
+    from which office, what IV_VER they sent and whether we liked it,
+    each IAM call we made and how long it took, what we pushed, and how
+    long the whole thing took.  The records are meant for offline
+    analysis, so they're written out of the connect's way:
+
+    In script mode, set OPENVPN_CLIENT_CONNECT_TRACE_FILE and the record
+    is appended with a single write after the push file is done, by a
+    forked child that the script doesn't wait for.
+
+    The service hands records to a TraceWriter, whose thread batches them
+    onto disk; a connect only ever pays for a queue put.
+
+    OPENVPN_CLIENT_CONNECT_TRACE_SALT (or the service's trace-salt) keys
+    the user hash, so that the hashes can't be reversed by hashing a list
+    of usernames.
+"""
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contributors:
+# gcox@mozilla.com
+# jdow@mozilla.com
+
+import os
+import sys
+import time
+import json
+import hmac
+import hashlib
+import threading
+import contextlib
+import contextvars
+sys.dont_write_bytecode = True
+
+__all__ = ['ConnectTrace', 'NULL_TRACE', 'TraceWriter', 'TracedSearcher',
+           'anonymize_user', 'append_record', 'current_trace', 'activate', 'deactivate',
+           'trace_from_env', 'TRACE_FILE_ENV', 'TRACE_SALT_ENV']
+
+TRACE_FILE_ENV = 'OPENVPN_CLIENT_CONNECT_TRACE_FILE'
+TRACE_SALT_ENV = 'OPENVPN_CLIENT_CONNECT_TRACE_SALT'
+
+_CURRENT_TRACE = contextvars.ContextVar('openvpn_client_connect_trace')
+
+
+def anonymize_user(username, salt=''):
+    """
+        A short, stable, keyed hash of a username.
+    """
+    if username is None:
+        return None
+    digest = hmac.new(salt.encode('utf-8'), username.encode('utf-8'), hashlib.sha256)
+    return digest.hexdigest()[:16]
+
+
+class ConnectTrace:
+    """
+        What we learn about one connect, as we learn it.
+    """
+    def __init__(self, mode, salt=''):
+        self.mode = mode
+        self.salt = salt
+        self.fields = {}
+        self.spans = []
+        self._wall_start = time.time()
+        self._start = time.perf_counter()
+
+    def __bool__(self):
+        return True
+
+    def set(self, **fields):
+        """
+            Remember some facts about this connect.
+        """
+        self.fields.update(fields)
+
+    def add_span(self, name, started, duration, outcome='ok'):
+        """
+            Record one timed call.  started is a time.perf_counter() value.
+        """
+        self.spans.append({'call': name,
+                           'start_ms': round((started - self._start) * 1000, 3),
+                           'duration_ms': round(duration * 1000, 3),
+                           'outcome': outcome})
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+            Time the block as a span; an exception marks it as an error.
+        """
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.add_span(name, started, time.perf_counter() - started, outcome)
+
+    def record(self, allowed, lines=None):
+        """
+            The finished record, as a dict ready for json.
+            lines is what we pushed, if we pushed anything.
+        """
+        record = {
+            'ts': round(self._wall_start, 6),
+            'mode': self.mode,
+            'user': anonymize_user(self.fields.get('username'), self.salt),
+            'office': self.fields.get('office'),
+            'iv_ver': self.fields.get('iv_ver'),
+            'iv_ver_allowed': self.fields.get('iv_ver_allowed'),
+            'result': 'allowed' if allowed else 'rejected',
+            'reason': self.fields.get('reason'),
+            'session': self.fields.get('session'),
+            'iam': self.spans,
+            'routes': None,
+            'push_bytes': None,
+            'duration_ms': round((time.perf_counter() - self._start) * 1000, 3),
+        }
+        if lines is not None:
+            record['routes'] = sum(1 for line in lines if line.startswith('push "route'))
+            record['push_bytes'] = sum(len(line) + 1 for line in lines)
+        return record
+
+
+class _NullTrace:
+    """
+        Stands in for a trace when tracing is off.  It's false, so that
+        any work done only for the trace can be skipped with 'if trace:'.
+    """
+    _nothing = contextlib.nullcontext()
+
+    def __bool__(self):
+        return False
+
+    def set(self, **fields):
+        """ Forget the facts """
+
+    def add_span(self, name, started, duration, outcome='ok'):
+        """ Forget the span """
+
+    def span(self, _name):
+        """ Time nothing """
+        return self._nothing
+
+
+NULL_TRACE = _NullTrace()
+
+
+def current_trace():
+    """
+        The trace of the connect we're working on, or NULL_TRACE.
+    """
+    return _CURRENT_TRACE.get(NULL_TRACE)
+
+
+def activate(trace):
+    """
+        Make trace the current one.  Returns a token for deactivate().
+    """
+    return _CURRENT_TRACE.set(trace)
+
+
+def deactivate(token):
+    """
+        Put back whatever trace was current before activate().
+    """
+    _CURRENT_TRACE.reset(token)
+
+
+def trace_from_env(mode):
+    """
+        A new trace if the environment asks for tracing, else NULL_TRACE.
+        Returns (trace, path to append the record to).
+    """
+    path = os.environ.get(TRACE_FILE_ENV)
+    if not path:
+        return NULL_TRACE, None
+    return ConnectTrace(mode, salt=os.environ.get(TRACE_SALT_ENV, '')), path
+
+
+class TracedSearcher:
+    """
+        An IAMVPNLibrary stand-in that records a span for each query.
+    """
+    def __init__(self, searcher, trace, methods):
+        self._searcher = searcher
+        self._trace = trace
+        self._methods = methods
+
+    def __getattr__(self, name):
+        method = getattr(self._searcher, name)
+        if name not in self._methods:
+            return method
+
+        def _traced(*args):
+            with self._trace.span(name):
+                return method(*args)
+        return _traced
+
+
+def _write_record(path, data):
+    """
+        Append data with a single write, swallowing errors.
+    """
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def append_record(path, record, detach=False):
+    """
+        Append one record with a single write.  Tracing must never break
+        a connect, so errors are swallowed.
+        With detach, a forked child does the write and nobody waits for
+        it, so a script that's about to exit isn't held up by the disk.
+        If we can't fork, we write it ourselves.
+    """
+    data = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+    if detach:
+        try:
+            pid = os.fork()
+        except OSError:
+            pid = None
+        if pid == 0:
+            try:
+                _write_record(path, data)
+            finally:
+                # Not sys.exit: the child mustn't run our parent's cleanup.
+                os._exit(0)  # pylint: disable=protected-access
+        if pid is not None:
+            return
+    _write_record(path, data)
+
+
+class TraceWriter:
+    """
+        Write records from a background thread, in batches.
+        submit() never blocks: if the disk can't keep up and more than
+        max_pending records are waiting, new ones are dropped and counted.
+    """
+    def __init__(self, path, batch_size=256, flush_interval=1.0, max_pending=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stats = {'written': 0, 'dropped': 0, 'write_errors': 0}
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        """
+            Queue a record for writing.
+        """
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                return
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _take_batch(self):
+        """
+            Wait for a full batch, the flush interval, or close(), and
+            take whatever is pending.
+        """
+        with self._cond:
+            if not self._closing and len(self._pending) < self.batch_size:
+                self._cond.wait(self.flush_interval)
+            batch, self._pending = self._pending, []
+            return batch, self._closing
+
+    def _run(self):
+        """
+            The writer thread.
+        """
+        while True:
+            batch, closing = self._take_batch()
+            if batch:
+                self._write(batch)
+            if closing:
+                return
+
+    def _write(self, batch):
+        """
+            Serialize and append one batch, in a single write, so that
+            several processes (prefork workers) can share one file.
+        """
+        data = ''.join(json.dumps(record, sort_keys=True) + '\n' for record in batch)
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+            try:
+                os.write(fd, data.encode('utf-8'))
+            finally:
+                os.close(fd)
+        except OSError:
+            self.stats['write_errors'] += 1
+            return
+        self.stats['written'] += len(batch)
+
+    def close(self, timeout=5.0):
+        """
+            Write out what's pending and stop the thread.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(timeout)
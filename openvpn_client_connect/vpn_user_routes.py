@@ -29,10 +29,12 @@
 
 import sys
 from argparse import ArgumentParser
-from openvpn_client_connect.per_user_configs import GetUserRoutes
+from openvpn_client_connect.per_user_configs import GetUserRoutes, configure_iam
+from openvpn_client_connect.profiling import profiled
 sys.dont_write_bytecode = True
 
 
+@profiled('vpn-user-routes')
 def main_work(argv):
     """
         Handle argument parsing, build a route list, and print it.
@@ -51,6 +53,7 @@ def main_work(argv):
                         help='User that is connecting to us')
     args = parser.parse_args(argv[1:])
 
+    configure_iam(args.conffile)
     gur = GetUserRoutes(args.conffile)
     user_routes = gur.build_user_routes(args.username, args.office_id, args.client_ip)
 
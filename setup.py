@@ -44,9 +44,25 @@ setup(
     long_description=open('README.md').read(),
     license="MPL",
     install_requires=['iamvpnlibrary>=0.31.0', 'netaddr'],
+    extras_require={'batch': ['numpy']},
     entry_points={
         'console_scripts': ['openvpn-client-connect=openvpn_client_connect.openvpn_script:main',
-                            'vpn-user-routes=openvpn_client_connect.vpn_user_routes:main'],
+                            'openvpn-client-disconnect='
+                            'openvpn_client_connect.disconnect_script:main',
+                            'vpn-user-routes=openvpn_client_connect.vpn_user_routes:main',
+                            'openvpn-client-connect-service=openvpn_client_connect.service:main',
+                            'openvpn-client-connect-profile-report='
+                            'openvpn_client_connect.profiling:report_main',
+                            'openvpn-client-connect-acl-sync='
+                            'openvpn_client_connect.acl_replica:sync_main',
+                            'openvpn-client-connect-batch-routes='
+                            'openvpn_client_connect.batch_routes:batch_main',
+                            'openvpn-client-connect-invalidate='
+                            'openvpn_client_connect.service_client:invalidate_main',
+                            'openvpn-client-connect-route-push='
+                            'openvpn_client_connect.route_push:push_main',
+                            'openvpn-client-connect-management='
+                            'openvpn_client_connect.management_auth:management_main'],
     },
     packages=['openvpn_client_connect'],
 )
@@ -0,0 +1,123 @@
+'''
+    A stand-in for openvpn's management interface, on a unix socket,
+    for tests that talk to one.
+'''
+import os
+import socket
+import threading
+
+STATUS_HEADER = ('HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\t'
+                 'Virtual IPv6 Address\tBytes Received\tBytes Sent\tConnected Since\t'
+                 'Connected Since (time_t)\tUsername\tClient ID\tPeer ID\tData Channel Cipher')
+
+
+def client_row(common_name, real_address, cid, username='UNDEF'):
+    ''' One CLIENT_LIST line of 'status 3' '''
+    return '\t'.join(['CLIENT_LIST', common_name, real_address, '10.50.0.2', '',
+                      '1000', '2000', '2026-01-01 00:00:00', '1767225600',
+                      username, str(cid), '0', 'AES-256-GCM'])
+
+
+class FakeManagement:
+    '''
+        Answers one connection at a time, like openvpn.  Every command
+        it gets is kept in self.commands.  push-update-cid is answered
+        by self.push_answer(cid, options), which by default succeeds.
+        notify() sends notifications, such as client connects, to
+        whoever is connected; the answers to those land in self.auths
+        (the config lines of each client-auth) and self.denies.
+    '''
+    def __init__(self, path, password=None):
+        self.path = path
+        self.password = password
+        self.clients = []
+        self.commands = []
+        self.connections = 0
+        self.auths = {}
+        self.denies = {}
+        self.connected = threading.Event()
+        self._stream = None
+        self._lock = threading.Lock()
+        self.push_answer = lambda cid, options: 'SUCCESS: push-update command succeeded'
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(1)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        ''' Stop listening '''
+        self._sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def notify(self, lines):
+        ''' Send lines to the connected client '''
+        self.connected.wait(5)
+        with self._lock:
+            self._stream.write(''.join(f'{line}\r\n' for line in lines).encode())
+
+    def _write(self, stream, data):
+        with self._lock:
+            stream.write(data)
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with conn:
+                self.connections += 1
+                try:
+                    self._converse(conn.makefile('rwb', buffering=0))
+                except (OSError, ValueError):
+                    pass
+                self.connected.clear()
+
+    def _converse(self, stream):
+        if self.password is not None:
+            stream.write(b'ENTER PASSWORD:')
+            if stream.readline().decode().rstrip('\r\n') != self.password:
+                stream.write(b'ERROR: bad password\r\n')
+                return
+            stream.write(b'SUCCESS: password is correct\r\n')
+        self._stream = stream
+        self._write(stream, b'>INFO:OpenVPN Management Interface Version 5 -- type \'help\' '
+                            b'for more info\r\n')
+        self.connected.set()
+        block = None
+        for raw in stream:
+            line = raw.decode().rstrip('\r\n')
+            self.commands.append(line)
+            if block is not None:
+                if line != 'END':
+                    block[1].append(line)
+                    continue
+                self.auths[block[0]] = block[1]
+                block = None
+                answers = ['SUCCESS: client-auth command succeeded']
+            elif line == 'quit':
+                return
+            elif line.startswith('client-auth '):
+                block = (line.split()[1], [])
+                continue
+            else:
+                answers = self._answer(line)
+            self._write(stream, ''.join(f'{answer}\r\n' for answer in answers).encode())
+
+    def _answer(self, line):
+        if line == 'status 3':
+            return ['TITLE\tOpenVPN 2.7.0', 'TIME\t2026-01-01 00:00:00\t1767225600',
+                    STATUS_HEADER] + list(self.clients) + ['GLOBAL_STATS\tMax bcast/mcast '
+                                                           'queue length\t0', 'END']
+        if line.startswith('push-update-cid '):
+            _, cid, options = line.split(' ', 2)
+            return ['>NOTIFY:info,pushed', self.push_answer(cid, options.strip('"'))]
+        if line.startswith('client-deny '):
+            _, cid, _, reason = line.split(' ', 3)
+            self.denies[cid] = reason.strip('"')
+            return ['SUCCESS: client-deny command succeeded']
+        if line.startswith('client-auth-nt ') or line == 'hold release':
+            return [f'SUCCESS: {line.split()[0]} command succeeded']
+        return [f'ERROR: unknown command [{line.split()[0]}], enter \'help\' for more options']
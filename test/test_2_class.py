@@ -475,3 +475,14 @@ class TestClass(unittest.TestCase):
                                       ('get_protocol_lines values must be strings'))
                 self.assertRegex(line, 'push "explicit-exit-notify .*"',
                                  'must push an exit-notify')
+
+    def test_render_push_block(self):
+        """ Verify that the prerendered blocks make the same text as the lines """
+        user_lines = ['push "dhcp-option DOMAIN example.com"',
+                      'push "route 10.0.0.0 255.0.0.0"']
+        for obj in self.configs['all'] + self.configs['staticonly']:
+            expected = (obj.get_dns_server_lines() + user_lines +
+                        obj.get_static_route_lines() + obj.get_protocol_lines())
+            self.assertEqual(obj.render_push_block(user_lines),
+                             '\n'.join(expected) + '\n',
+                             'render_push_block must match the joined lines')
@@ -0,0 +1,111 @@
+""" Test suite for the per-user ACL cache """
+import unittest
+from collections import namedtuple
+import test.context  # pylint: disable=unused-import
+from netaddr import AddrFormatError
+from openvpn_client_connect.acl_cache import UserACLCache
+
+FakeACL = namedtuple('FakeACL', ['rule', 'address', 'portstring', 'description'])
+
+
+class FakeClock:
+    """ A clock we move by hand """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestUserACLCache(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.clock = FakeClock()
+        self.library = UserACLCache(ttl=30, max_entries=3, clock=self.clock)
+
+    def test_hit_and_expiry(self):
+        """ Answers are served until they're ttl old """
+        self.assertEqual(self.library.get('get_allowed_vpn_ips', 'bob'), (False, None))
+        self.library.put('get_allowed_vpn_ips', 'bob', ['10.0.0.0/8'])
+        self.assertEqual(self.library.get('get_allowed_vpn_ips', 'bob'), (True, ['10.0.0.0/8']))
+        self.assertEqual(self.library.get('get_allowed_vpn_acls', 'bob'), (False, None))
+        self.clock.now += 31
+        self.assertEqual(self.library.get('get_allowed_vpn_ips', 'bob'), (False, None))
+        self.assertEqual(len(self.library), 0)
+        self.assertEqual(self.library.stats,
+                         {'hits': 1, 'misses': 3, 'expired': 1, 'evicted': 0})
+
+    def test_lru_eviction(self):
+        """ When full, the least recently used entry goes """
+        for user in ('a', 'b', 'c'):
+            self.library.put('m', user, user)
+        self.library.get('m', 'a')
+        self.library.put('m', 'd', 'd')
+        self.assertEqual(self.library.get('m', 'b'), (False, None))
+        self.assertEqual(self.library.get('m', 'a'), (True, 'a'))
+        self.assertEqual(self.library.stats['evicted'], 1)
+
+    def test_invalidate(self):
+        """ We can forget one user, or everyone """
+        self.library.put('m1', 'bob', 1)
+        self.library.put('m2', 'bob', 2)
+        self.library.put('m1', 'alice', 3)
+        self.assertEqual(self.library.invalidate_user('bob'), 2)
+        self.assertEqual(len(self.library), 1)
+        self.library.clear()
+        self.assertEqual(len(self.library), 0)
+
+    def test_invalidate_by_group_and_cidr(self):
+        """ Users are found by the groups and CIDRs in their cached answers """
+        library = UserACLCache(ttl=30, clock=self.clock)
+        library.put('get_allowed_vpn_acls', 'bob', [FakeACL('vpn_db', '10.1.0.0/16', '', ''),
+                                                    FakeACL('vpn_web', '10.2.3.0/24', '', '')])
+        library.put('get_allowed_vpn_ips', 'bob', ['10.1.0.0/16', '10.2.3.0/24'])
+        library.put('get_allowed_vpn_acls', 'alice', [FakeACL('vpn_web', '10.2.3.0/24', '', '')])
+        library.put('get_allowed_vpn_ips', 'carol', ['192.168.0.0/16', '2001:db8::/32'])
+        library.put('user_allowed_to_vpn', 'dave', True)
+        self.assertEqual(library.users_in_group('vpn_web'), {'bob', 'alice'})
+        self.assertEqual(library.users_overlapping('10.0.0.0/8'), {'bob', 'alice'})
+        self.assertEqual(library.users_overlapping('10.1.2.3/32'), {'bob'})
+        self.assertEqual(library.users_overlapping('2001:db8:1::/48'), {'carol'})
+        self.assertEqual(library.users_overlapping('::/0'), {'carol'})
+        with self.assertRaises(AddrFormatError):
+            library.users_overlapping('not a cidr')
+
+        self.assertEqual(library.invalidate(groups=['vpn_db']), (['bob'], 2))
+        self.assertEqual(library.users_in_group('vpn_web'), {'alice'})
+        self.assertEqual(library.invalidate(users=['dave'], cidrs=['192.168.1.0/24']),
+                         (['carol', 'dave'], 2))
+        self.assertEqual(len(library), 1)
+        # A re-cached answer replaces the old one in the index, too.
+        library.put('get_allowed_vpn_acls', 'alice', [FakeACL('vpn_db', '10.1.0.0/16', '', '')])
+        self.assertEqual(library.users_in_group('vpn_web'), set())
+        self.assertEqual(library.users_in_group('vpn_db'), {'alice'})
+
+    def test_index_follows_eviction(self):
+        """ Evicted and expired users drop out of the reverse index """
+        self.library.put('get_allowed_vpn_acls', 'bob', [FakeACL('g', '10.0.0.0/8', '', '')])
+        for user in ('a', 'b', 'c'):
+            self.library.put('m', user, user)
+        self.assertEqual(self.library.users_in_group('g'), set())
+        self.library.put('get_allowed_vpn_ips', 'bob', ['10.0.0.0/8'])
+        self.clock.now += 31
+        self.library.get('get_allowed_vpn_ips', 'bob')
+        self.assertEqual(self.library.users_overlapping('10.0.0.0/8'), set())
+
+    def test_stale_fetch_not_cached(self):
+        """ An answer fetched across an invalidation isn't kept """
+        epoch = self.library.epoch
+        self.library.invalidate(users=['bob'])
+        self.library.put('m', 'bob', 'old', epoch=epoch)
+        self.assertEqual(self.library.get('m', 'bob'), (False, None))
+        self.library.put('m', 'bob', 'new', epoch=self.library.epoch)
+        self.assertEqual(self.library.get('m', 'bob'), (True, 'new'))
+
+    def test_disabled(self):
+        """ A ttl of 0 caches nothing """
+        library = UserACLCache(ttl=0)
+        library.put('m', 'bob', 1)
+        self.assertEqual(library.get('m', 'bob'), (False, None))
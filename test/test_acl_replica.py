@@ -0,0 +1,216 @@
+""" Test suite for the local ACL replica """
+import unittest
+import os
+import io
+import tempfile
+import contextlib
+import sqlite3
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_connect import per_user_configs
+from openvpn_client_connect.acl_replica import ACLReplica, sync_users, sync_work
+
+
+class FakeClock:
+    """ A clock that only moves when told to """
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestACLReplica(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, 'acls.sqlite')
+        self.clock = FakeClock()
+        self.library = ACLReplica(self.path, max_staleness=60, clock=self.clock)
+        self.acl = per_user_configs.CachedACL('vpn_example', '10.0.0.0/8', '', 'example')
+
+    def tearDown(self):
+        """ Clean up """
+        self.library.close()
+        self.tmpdir.cleanup()
+
+    def test_store_and_read(self):
+        """ What's stored for a user comes back out """
+        self.assertEqual(self.library.user_allowed('foo@example.com'), (False, None))
+        self.library.store_user('foo@example.com', True, ['10.0.0.0/8'], [self.acl])
+        self.assertEqual(self.library.user_allowed('foo@example.com'), (True, True))
+        self.assertEqual(self.library.user_ips('foo@example.com'), (True, ['10.0.0.0/8']))
+        self.assertEqual(self.library.user_acls('foo@example.com'),
+                         (True, [('vpn_example', '10.0.0.0/8', '', 'example')]))
+        # Storing again replaces, rather than adds to, what we had.
+        self.library.store_user('foo@example.com', False, [], [])
+        self.assertEqual(self.library.user_allowed('foo@example.com'), (True, False))
+        self.assertEqual(self.library.user_ips('foo@example.com'), (True, []))
+
+    def test_staleness(self):
+        """ Rows older than max_staleness are not used """
+        self.library.store_user('foo@example.com', True, ['10.0.0.0/8'], [])
+        self.clock.now += 61
+        self.assertEqual(self.library.user_allowed('foo@example.com'), (False, None))
+        self.assertEqual(self.library.user_ips('foo@example.com'), (False, None))
+        self.assertEqual(self.library.user_acls('foo@example.com'), (False, None))
+        self.assertEqual(self.library.counts(), {'users': 1, 'stale': 1})
+
+    def test_enroll_and_stalest(self):
+        """ Enrolled users are synced first, and enrolling keeps rows """
+        self.library.store_user('old@example.com', True, [], [])
+        self.clock.now += 10
+        self.library.store_user('new@example.com', True, [], [])
+        self.library.enroll_users(['fresh@example.com', 'old@example.com'])
+        self.assertEqual(self.library.stalest_users(2), ['fresh@example.com', 'old@example.com'])
+        self.assertEqual(self.library.user_allowed('old@example.com'), (True, True))
+        self.assertEqual(self.library.user_allowed('fresh@example.com'), (False, None))
+
+    def test_mark_stale(self):
+        """ Marked users go to IAM, and are synced first """
+        self.library.store_user('foo@example.com', True, ['10.0.0.0/8'], [])
+        self.library.store_user('bar@example.com', True, ['10.0.0.0/8'], [])
+        self.assertEqual(self.library.mark_stale(['bar@example.com', 'nobody@example.com']), 1)
+        self.assertEqual(self.library.mark_stale([]), 0)
+        self.assertEqual(self.library.user_ips('bar@example.com'), (False, None))
+        self.assertEqual(self.library.user_allowed('foo@example.com'), (True, True))
+        self.assertEqual(self.library.stalest_users(1), ['bar@example.com'])
+
+    def test_fresh_allowed_ips(self):
+        """ Whole-organization jobs get the fresh, allowed users' ACLs """
+        self.library.store_user('old@example.com', True, ['10.1.0.0/16'], [])
+        self.clock.now += 61
+        self.library.store_user('foo@example.com', True, ['10.0.0.0/8', '10.2.0.0/16'], [])
+        self.library.store_user('none@example.com', True, [], [])
+        self.library.store_user('no@example.com', False, [], [])
+        self.assertEqual(self.library.fresh_allowed_ips(),
+                         {'foo@example.com': ['10.0.0.0/8', '10.2.0.0/16'],
+                          'none@example.com': []})
+
+    def test_readonly(self):
+        """ A read-only replica reads, but can't write or be created """
+        self.library.store_user('foo@example.com', True, [], [])
+        reader = ACLReplica(self.path, max_staleness=60, readonly=True, clock=self.clock)
+        self.assertEqual(reader.user_allowed('foo@example.com'), (True, True))
+        with self.assertRaises(sqlite3.Error):
+            reader.store_user('bar@example.com', True, [], [])
+        reader.close()
+        with self.assertRaises(sqlite3.Error):
+            ACLReplica(os.path.join(self.tmpdir.name, 'missing'), readonly=True)
+
+    def test_sync_users(self):
+        """ Users are fetched and stored; failed lookups keep old rows """
+        searcher = mock.Mock()
+        searcher.failed_calls = 0
+        searcher.user_allowed_to_vpn.side_effect = lambda user: user != 'no@example.com'
+        searcher.get_allowed_vpn_ips.return_value = ['10.0.0.0/8']
+        searcher.get_allowed_vpn_acls.return_value = [self.acl]
+        self.assertEqual(sync_users(self.library, searcher,
+                                    ['foo@example.com', 'no@example.com']), (2, 0))
+        self.assertEqual(self.library.user_ips('foo@example.com'), (True, ['10.0.0.0/8']))
+        self.assertEqual(self.library.user_allowed('no@example.com'), (True, False))
+
+        def _failing(_user):
+            searcher.failed_calls += 1
+            return False
+        searcher.user_allowed_to_vpn.side_effect = _failing
+        self.assertEqual(sync_users(self.library, searcher, ['foo@example.com']), (0, 1))
+        self.assertEqual(self.library.user_allowed('foo@example.com'), (True, True))
+
+
+class TestACLReplicaIntegration(unittest.TestCase):
+    """ Test connects using the replica """
+
+    def setUp(self):
+        """ Write out a config with a replica in it, and fill the replica """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, 'acls.sqlite')
+        self.conffile = os.path.join(self.tmpdir.name, 'replica.conf')
+        self.write_conf(write_through=False)
+        replica = ACLReplica(self.path)
+        replica.store_user('foo@example.com', True, ['10.0.0.0/8', '192.168.50.0/24'],
+                           [per_user_configs.CachedACL('vpn_example', '10.0.0.0/8', '', '')])
+        replica.close()
+        per_user_configs.configure_iam(self.conffile)
+
+    def write_conf(self, write_through):
+        """ The config for the replica """
+        with open(self.conffile, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('[acl-replica]\n'
+                             f'path = {self.path}\n'
+                             'max-staleness = 600\n'
+                             f'write-through = {str(write_through).lower()}\n')
+
+    def tearDown(self):
+        """ Put the process back to talking straight to IAM """
+        per_user_configs.configure_iam('test_configs/empty.conf')
+        self.tmpdir.cleanup()
+
+    def test_settings(self):
+        """ The settings come out of the config """
+        self.assertEqual(per_user_configs.replica_settings(self.conffile),
+                         {'path': self.path, 'max-staleness': 600.0, 'write-through': False})
+        self.assertIsNone(per_user_configs.replica_settings('test_configs/empty.conf'))
+
+    def test_replica_hit_skips_iam(self):
+        """ A user in the replica connects without IAM being asked """
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            self.assertTrue(per_user_configs.user_may_vpn('foo@example.com'))
+            routes = per_user_configs.GetUserRoutes(
+                'test_configs/get_user_routes.conf').build_user_routes('foo@example.com',
+                                                                       None, None)
+        self.assertNotEqual(routes, [])
+        mock_library.assert_not_called()
+
+    def test_replica_miss_goes_live(self):
+        """ A user we don't have asks IAM, and isn't stored without write-through """
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            mock_library.return_value.user_allowed_to_vpn.return_value = True
+            self.assertTrue(per_user_configs.user_may_vpn('bar@example.com'))
+            self.assertTrue(per_user_configs.user_may_vpn('bar@example.com'))
+        self.assertEqual(mock_library.return_value.user_allowed_to_vpn.call_count, 2)
+
+    def test_unreachable_iam_fails_closed(self):
+        """ A replica miss with IAM down is a no """
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', side_effect=RuntimeError):
+            self.assertFalse(per_user_configs.user_may_vpn('bar@example.com'))
+            self.assertTrue(per_user_configs.user_may_vpn('foo@example.com'))
+
+    def test_write_through(self):
+        """ With write-through, a live lookup puts the user in the replica """
+        self.write_conf(write_through=True)
+        per_user_configs.configure_iam('test_configs/empty.conf')
+        per_user_configs.configure_iam(self.conffile)
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            searcher = mock_library.return_value
+            searcher.user_allowed_to_vpn.return_value = True
+            searcher.get_allowed_vpn_ips.return_value = ['10.1.0.0/16']
+            searcher.get_allowed_vpn_acls.return_value = []
+            self.assertTrue(per_user_configs.user_may_vpn('bar@example.com'))
+            self.assertTrue(per_user_configs.user_may_vpn('bar@example.com'))
+        searcher.user_allowed_to_vpn.assert_called_once_with('bar@example.com')
+        replica = ACLReplica(self.path, readonly=True)
+        self.assertEqual(replica.user_ips('bar@example.com'), (True, ['10.1.0.0/16']))
+        replica.close()
+
+    def test_sync_work(self):
+        """ The sync job enrolls listed users and fetches them """
+        users_file = os.path.join(self.tmpdir.name, 'users')
+        with open(users_file, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('# who may VPN\nbar@example.com\n\n')
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library, \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            searcher = mock_library.return_value
+            searcher.user_allowed_to_vpn.return_value = True
+            searcher.get_allowed_vpn_ips.return_value = ['10.1.0.0/16']
+            searcher.get_allowed_vpn_acls.return_value = []
+            self.assertTrue(sync_work(['acl-sync', '--conf', self.conffile,
+                                       '--users-file', users_file, '--batch', '1']))
+        self.assertIn('synced 1, failed 0, 2 users', output.getvalue())
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', side_effect=RuntimeError), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(sync_work(['acl-sync', '--conf', self.conffile]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(sync_work(['acl-sync', '--conf', 'test_configs/empty.conf']))
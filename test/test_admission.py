@@ -0,0 +1,77 @@
+""" Test suite for service-mode admission control """
+import unittest
+import asyncio
+import test.context  # pylint: disable=unused-import
+from openvpn_client_connect.admission import AdmissionController, AdmissionRejected
+
+
+class TestAdmissionController(unittest.TestCase):
+    """ Class of tests """
+
+    def test_admits_under_limit(self):
+        """ With free slots, you get straight in """
+        library = AdmissionController(max_in_flight=2, max_queue=0)
+
+        async def _run():
+            loop = asyncio.get_running_loop()
+            async with library.admit(loop.time() + 5) as waited:
+                self.assertEqual(library.in_flight, 1)
+                return waited
+        self.assertLess(asyncio.run(_run()), 1)
+        snap = library.snapshot()
+        self.assertEqual(snap['admitted'], 1)
+        self.assertEqual(snap['in_flight'], 0)
+
+    def test_queue_full(self):
+        """ Beyond the slots and the queue, you're turned away """
+        library = AdmissionController(max_in_flight=1, max_queue=1)
+
+        async def _hold(loop, release):
+            async with library.admit(loop.time() + 5):
+                await release.wait()
+
+        async def _run():
+            loop = asyncio.get_running_loop()
+            release = asyncio.Event()
+            holder = asyncio.create_task(_hold(loop, release))
+            waiter = asyncio.create_task(_hold(loop, release))
+            await asyncio.sleep(0.01)
+            self.assertEqual(library.queue_depth, 1)
+            with self.assertRaises(AdmissionRejected) as rejected:
+                async with library.admit(loop.time() + 5):
+                    pass  # pragma: no cover
+            release.set()
+            await asyncio.gather(holder, waiter)
+            return rejected.exception.reason
+        self.assertEqual(asyncio.run(_run()), 'queue_full')
+        snap = library.snapshot()
+        self.assertEqual(snap['admitted'], 2)
+        self.assertEqual(snap['rejected']['queue_full'], 1)
+        self.assertEqual(snap['queue_depth_peak'], 1)
+        self.assertGreater(snap['wait_seconds_max'], 0)
+
+    def test_deadline_too_close(self):
+        """ If we know we can't make your deadline, say so now """
+        library = AdmissionController(initial_service_seconds=1.0)
+
+        async def _run():
+            loop = asyncio.get_running_loop()
+            async with library.admit(loop.time() + 0.5):
+                pass  # pragma: no cover
+        with self.assertRaises(AdmissionRejected) as rejected:
+            asyncio.run(_run())
+        self.assertEqual(rejected.exception.reason, 'deadline')
+
+    def test_queue_timeout(self):
+        """ Waiting in the queue past your deadline gets you rejected """
+        library = AdmissionController(max_in_flight=1, max_queue=5)
+
+        async def _run():
+            loop = asyncio.get_running_loop()
+            async with library.admit(loop.time() + 5):
+                async with library.admit(loop.time() + 0.05):
+                    pass  # pragma: no cover
+        with self.assertRaises(AdmissionRejected) as rejected:
+            asyncio.run(_run())
+        self.assertEqual(rejected.exception.reason, 'timeout')
+        self.assertEqual(library.queue_depth, 0)
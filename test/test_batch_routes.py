@@ -0,0 +1,91 @@
+""" Test suite for whole-organization route computation """
+import unittest
+import os
+import io
+import json
+import random
+import tempfile
+import contextlib
+import test.context  # pylint: disable=unused-import
+from openvpn_client_connect import per_user_configs
+from openvpn_client_connect import batch_routes
+from openvpn_client_connect.batch_routes import BatchRouteEngine, batch_work
+
+
+def random_acls(rand, count):
+    """ A made-up user's ACLs, some inside free and office routes """
+    acls = []
+    for _ in range(count):
+        choice = rand.random()
+        if choice < 0.2:
+            acls.append(f'10.8.{rand.randrange(256)}.0/24')
+        elif choice < 0.35:
+            acls.append(f'10.{rand.randrange(192, 256)}.{rand.randrange(256)}.'
+                        f'{rand.randrange(256)}/32')
+        elif choice < 0.4:
+            acls.append(f'2001:db8:{rand.randrange(16):x}::/48')
+        else:
+            prefix = rand.choice([8, 12, 16, 20, 23, 24, 25, 28, 30, 32])
+            address = rand.getrandbits(32)
+            acls.append(f'{address >> 24}.{(address >> 16) & 255}.{(address >> 8) & 255}.'
+                        f'{address & 255}/{prefix}')
+    return acls
+
+
+@unittest.skipIf(batch_routes.numpy is None, 'numpy is not installed')
+class TestBatchRoutes(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.user_routes = per_user_configs.GetUserRoutes('test_configs/get_user_routes.conf')
+        self.library = BatchRouteEngine(self.user_routes)
+
+    def test_matches_scalar_path(self):
+        """ Every user's routes are the same as build_routes_from_acls gives """
+        rand = random.Random(4)
+        users_acls = {f'user{num}': random_acls(rand, rand.randrange(0, 12))
+                      for num in range(400)}
+        users_acls['adjacent'] = ['192.168.0.0/24', '192.168.1.0/24', '192.168.2.0/24']
+        users_acls['host-bits'] = ['172.16.5.9/16', '0.0.0.0/0']
+        users_acls['covered'] = ['10.8.1.0/24', '10.200.0.1/32']
+        for situation in [(None, None), ('site1', None), (None, '10.238.3.4')]:
+            batch = self.library.build_routes(users_acls, *situation, server_ip='10.238.0.1')
+            for user, acls in users_acls.items():
+                scalar = self.user_routes.build_routes_from_acls(acls, *situation,
+                                                                 server_ip='10.238.0.1')
+                self.assertEqual([str(route) for route in batch[user]],
+                                 [str(route) for route in scalar], f'{user}: {acls}')
+
+    def test_nonoffice_routes(self):
+        """ The non-office part matches, and users without ACLs get nothing """
+        users_acls = {'none': [], 'some': ['192.168.50.0/24', '10.10.4.0/24']}
+        result = self.library.nonoffice_routes(users_acls)
+        self.assertEqual(result['none'], [])
+        self.assertEqual(result['some'], self.user_routes.build_nonoffice_routes(
+            users_acls['some']))
+        self.assertEqual(self.library.nonoffice_routes({}), {})
+
+    def test_ipv6_free_routes(self):
+        """ IPv6 free routes go to everyone, after their IPv4 routes """
+        self.user_routes.config['FREE_ROUTES'].append(
+            per_user_configs.IPNetwork('2001:db8::/32'))
+        library = BatchRouteEngine(self.user_routes)
+        users_acls = {'v4': ['192.168.50.0/24'], 'v6': ['2001:db9::/48', '2001:db8:1::/48']}
+        batch = library.nonoffice_routes(users_acls)
+        for user, acls in users_acls.items():
+            # pylint: disable=protected-access
+            self.assertEqual(batch[user], self.user_routes._compute_nonoffice_routes(acls))
+
+    def test_batch_work(self):
+        """ The command line prints everyone's routes as JSON """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            acls_file = os.path.join(tmpdir, 'acls.json')
+            with open(acls_file, 'w', encoding='utf-8') as filehandle:
+                json.dump({'foo': ['192.168.50.0/24']}, filehandle)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.assertTrue(batch_work(['batch', '--conf', 'test_configs/get_user_routes.conf',
+                                            '--acls-file', acls_file]))
+        self.assertIn('192.168.50.0/24', json.loads(output.getvalue())['foo'])
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertFalse(batch_work(['batch', '--conf', 'test_configs/get_user_routes.conf']))
@@ -0,0 +1,60 @@
+""" Test suite for the precompiled script bundles """
+import unittest
+import os
+import sys
+import zipfile
+import tempfile
+import subprocess
+import test.context  # pylint: disable=unused-import
+import build_bundle
+from benchmarks.bench_startup import write_stand_in_iam
+
+
+class TestBundle(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Build a bundle with a stand-in IAM library in it """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        iam_dir = os.path.join(self.tmpdir.name, 'iam')
+        write_stand_in_iam(iam_dir)
+        self.bundle = os.path.join(self.tmpdir.name, 'openvpn-client-connect.pyz')
+        self.modules = build_bundle.build_bundle(
+            self.bundle, build_bundle.BUNDLES['openvpn-client-connect'],
+            interpreter=sys.executable, search_path=[iam_dir] + sys.path)
+
+    def tearDown(self):
+        """ Clean up """
+        self.tmpdir.cleanup()
+
+    def test_contents(self):
+        """ Modules are there as bytecode only, with data files alongside """
+        with zipfile.ZipFile(self.bundle) as archive:
+            names = archive.namelist()
+        self.assertIn('openvpn_client_connect/openvpn_script.pyc', names)
+        self.assertIn('iamvpnlibrary/__init__.pyc', names)
+        self.assertIn('netaddr/__init__.pyc', names)
+        sources = [name for name in names if name.endswith('.py')]
+        self.assertEqual(sources, ['__main__.py'])
+        self.assertEqual(self.modules, len([name for name in names if name.endswith('.pyc')]))
+        with open(self.bundle, 'rb') as filehandle:
+            self.assertEqual(filehandle.readline(), f'#!{sys.executable}\n'.encode('utf-8'))
+
+    def test_connect(self):
+        """ The bundle runs a connect on its own, with -sE """
+        output_file = os.path.join(self.tmpdir.name, 'push.conf')
+        env = {'common_name': 'bob', 'username': 'bob', 'trusted_ip': '8.7.6.5',
+               'IV_VER': '2.6.8', 'PATH': os.environ.get('PATH', '')}
+        proc = subprocess.run([sys.executable, '-sE', self.bundle,
+                               '--conf', 'test_configs/udp_dynamic.conf', output_file],
+                              env=env, check=False, stderr=subprocess.PIPE, text=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        with open(output_file, 'r', encoding='utf-8') as filehandle:
+            self.assertIn('push "route 10.0.0.0 255.0.0.0"', filehandle.read().splitlines())
+
+    def test_missing_package(self):
+        """ Asking for a package we can't find is an error, not an empty bundle """
+        with self.assertRaises(build_bundle.BundleError):
+            build_bundle.find_package('no_such_package_here')
+        with self.assertRaises(build_bundle.BundleError):
+            build_bundle.find_package('test_configs')
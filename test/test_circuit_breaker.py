@@ -0,0 +1,177 @@
+""" Test suite for the IAM circuit breaker """
+import unittest
+import os
+import asyncio
+import threading
+import tempfile
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_connect import per_user_configs
+from openvpn_client_connect.circuit_breaker import CircuitBreaker, CircuitOpenError
+from openvpn_client_connect.iam_async import AsyncIAMAdapter
+
+
+def _boom():
+    """ A call that always fails """
+    raise RuntimeError('IAM is down')
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.library = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+    def test_opens_after_failures(self):
+        """ Enough consecutive failures open the breaker """
+        self.assertEqual(self.library.state, CircuitBreaker.CLOSED)
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                self.library.call(_boom)
+        self.assertEqual(self.library.state, CircuitBreaker.OPEN)
+        func = mock.Mock()
+        with self.assertRaises(CircuitOpenError):
+            self.library.call(func)
+        func.assert_not_called()
+
+    def test_success_resets_count(self):
+        """ Failures must be consecutive """
+        with self.assertRaises(RuntimeError):
+            self.library.call(_boom)
+        self.assertEqual(self.library.call(lambda: 'ok'), 'ok')
+        with self.assertRaises(RuntimeError):
+            self.library.call(_boom)
+        self.assertEqual(self.library.state, CircuitBreaker.CLOSED)
+
+    def test_slow_calls_count(self):
+        """ A slow success is a failure """
+        library = CircuitBreaker(failure_threshold=1, slow_call_seconds=0.5)
+        library.record_success(elapsed=1.0)
+        self.assertEqual(library.state, CircuitBreaker.OPEN)
+
+    def test_half_open(self):
+        """ After the cool-off, exactly one probe goes through """
+        for _ in range(2):
+            self.library.record_failure()
+        with mock.patch('time.time', return_value=10**10):
+            self.assertTrue(self.library.allow_request())
+            self.assertEqual(self.library.state, CircuitBreaker.HALF_OPEN)
+            self.assertFalse(self.library.allow_request())
+            self.library.record_failure()
+            self.assertEqual(self.library.state, CircuitBreaker.OPEN)
+        with mock.patch('time.time', return_value=10**11):
+            self.assertTrue(self.library.allow_request())
+            self.library.record_success()
+        self.assertEqual(self.library.state, CircuitBreaker.CLOSED)
+
+    def test_state_file_is_shared(self):
+        """ Two breakers on one state file see each other's failures """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file = os.path.join(tmpdir, 'breaker.json')
+            first = CircuitBreaker(failure_threshold=2, state_file=state_file)
+            second = CircuitBreaker(failure_threshold=2, state_file=state_file)
+            first.record_failure()
+            second.record_failure()
+            self.assertEqual(first.state, CircuitBreaker.OPEN)
+            self.assertFalse(second.allow_request())
+            # A trashed file is treated as closed:
+            with open(state_file, 'w', encoding='utf-8') as filehandle:
+                filehandle.write('garbage')
+            self.assertTrue(second.allow_request())
+
+    def test_unusable_state_file(self):
+        """ A state file we can't open leaves the breaker working in memory """
+        library = CircuitBreaker(failure_threshold=2,
+                                 state_file='/nonexistent/dir/breaker.json')
+        self.assertTrue(library.allow_request())
+        library.record_failure()
+        library.record_failure()
+        self.assertEqual(library.state, CircuitBreaker.OPEN)
+
+
+class TestCircuitBreakerIntegration(unittest.TestCase):
+    """ Test the breaker's hookups into the IAM callers """
+
+    def setUp(self):
+        """ Write out a config with a breaker in it """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.conffile = os.path.join(self.tmpdir.name, 'breaker.conf')
+        with open(self.conffile, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('[iam-circuit-breaker]\nfailure-threshold = 1\n'
+                             'reset-seconds = 60\n')
+
+    def tearDown(self):
+        """ Put the process back to talking straight to IAM """
+        per_user_configs.configure_iam('test_configs/empty.conf')
+        self.tmpdir.cleanup()
+
+    def test_configure_iam(self):
+        """ configure_iam builds a breaker only when asked to """
+        breaker = per_user_configs.configure_iam(self.conffile)
+        self.assertIsInstance(breaker, CircuitBreaker)
+        self.assertEqual(breaker.failure_threshold, 1)
+        self.assertIsNone(per_user_configs.configure_iam('test_configs/empty.conf'))
+
+    def test_open_breaker_fails_fast(self):
+        """ Once open, we don't even try to reach IAM """
+        per_user_configs.configure_iam(self.conffile)
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary',
+                        side_effect=RuntimeError) as mock_library:
+            self.assertFalse(per_user_configs.user_may_vpn('foo@example.com'))
+            self.assertFalse(per_user_configs.user_may_vpn('foo@example.com'))
+        mock_library.assert_called_once()
+
+    def test_unusable_state_file_connects(self):
+        """ A breaker state file in a missing directory doesn't stop connects """
+        with open(self.conffile, 'a', encoding='utf-8') as filehandle:
+            filehandle.write('state-file = /nonexistent/dir/breaker.json\n')
+        per_user_configs.configure_iam(self.conffile)
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            mock_library.return_value.user_allowed_to_vpn.return_value = True
+            self.assertTrue(per_user_configs.user_may_vpn('foo@example.com'))
+
+    def test_guarded_queries_fail_closed(self):
+        """ A query that blows up gives the least-privilege answer """
+        per_user_configs.configure_iam(self.conffile)
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            mock_library.return_value.get_allowed_vpn_ips.side_effect = OSError
+            gur = per_user_configs.GetUserRoutes('test_configs/get_user_routes.conf')
+            self.assertEqual(gur.build_user_routes('foo@example.com', None, None), [])
+
+    def test_async_adapter_uses_breaker(self):
+        """ The async adapter stops calling IAM once the breaker opens """
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        factory = mock.Mock(side_effect=RuntimeError)
+        library = AsyncIAMAdapter(max_workers=1, searcher_factory=factory,
+                                  circuit_breaker=breaker)
+        self.assertFalse(asyncio.run(library.user_allowed_to_vpn('bob')))
+        self.assertFalse(asyncio.run(library.user_allowed_to_vpn('bob')))
+        factory.assert_called_once()
+        library.close()
+
+    def test_async_adapter_state_file_off_loop(self):
+        """ The async adapter doesn't lock the state file on the event loop """
+        searcher = mock.Mock()
+        searcher.user_allowed_to_vpn.side_effect = [True, RuntimeError]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            breaker = CircuitBreaker(state_file=os.path.join(tmpdir, 'breaker.json'))
+            library = AsyncIAMAdapter(max_workers=1, searcher_factory=lambda: searcher,
+                                      circuit_breaker=breaker)
+            threads = []
+            real_update = breaker._update  # pylint: disable=protected-access
+
+            def _update(mutator):
+                threads.append(threading.current_thread())
+                return real_update(mutator)
+
+            async def _run():
+                with mock.patch.object(breaker, '_update', side_effect=_update):
+                    return (threading.current_thread(),
+                            await library.user_allowed_to_vpn('bob'),
+                            await library.user_allowed_to_vpn('bob'))
+            loop_thread, first, second = asyncio.run(_run())
+            library.close()
+        self.assertEqual((first, second), (True, False))
+        self.assertTrue(threads)
+        self.assertNotIn(loop_thread, threads)
@@ -160,6 +160,23 @@ class PublicTestsMixin():
         ret = self.library.route_exclusion(_input, remove_routes)
         self.assertEqual(proper_output, ret)
 
+    def test_nonoffice_routes_memo(self):
+        """
+            The same ACL set, in any order, shares one computation
+            and gets the same answer as the unmemoized work.
+        """
+        acls = ['10.8.1.0/24', '192.168.50.0/24', '10.0.0.0/8', '10.238.1.0/24']
+        expected = self.library._compute_nonoffice_routes(acls)
+        self.assertEqual(self.library.build_nonoffice_routes(acls), expected)
+        self.assertEqual(self.library.build_nonoffice_routes(list(reversed(acls)) + acls[:1]),
+                         expected)
+        self.assertEqual(self.library.memo_stats, {'hits': 1, 'misses': 1})
+        # Callers can't damage the memo:
+        self.library.build_nonoffice_routes(acls).clear()
+        self.assertEqual(self.library.build_nonoffice_routes(acls), expected)
+        self.assertEqual(per_user_configs.set_fingerprint(['a', 'b', 'a']),
+                         per_user_configs.set_fingerprint(['b', 'a']))
+
     def test_build_user_routes_bad(self):
         """
             This is failed-user test.
@@ -0,0 +1,149 @@
+""" Test suite for the asyncio IAM adapter """
+import unittest
+import time
+import asyncio
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_connect.iam_async import AsyncIAMAdapter
+from openvpn_client_connect.metrics import MetricsRegistry
+from openvpn_client_connect.circuit_breaker import CircuitBreaker
+
+
+class LDAPishError(Exception):
+    """ Something a directory library might raise """
+
+
+class TestAsyncIAMAdapter(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.searcher = mock.Mock()
+        self.searcher.user_allowed_to_vpn.return_value = True
+        self.searcher.verify_sudo_user.return_value = 'sudo-target'
+        self.searcher.get_allowed_vpn_ips.return_value = ['10.0.0.0/8']
+        self.searcher.get_allowed_vpn_acls.return_value = ['an-acl']
+        self.library = AsyncIAMAdapter(max_workers=2, timeout=1,
+                                       searcher_factory=lambda: self.searcher)
+
+    def tearDown(self):
+        """ Shut down the executor """
+        self.library.close()
+
+    def test_passthrough(self):
+        """ Successful calls hand back what IAM said """
+        async def _run():
+            return (await self.library.user_allowed_to_vpn('bob'),
+                    await self.library.verify_sudo_user('bob', 'root'),
+                    await self.library.get_allowed_vpn_ips('bob'),
+                    await self.library.get_allowed_vpn_acls('bob'))
+        res = asyncio.run(_run())
+        self.assertEqual(res, (True, 'sudo-target', ['10.0.0.0/8'], ['an-acl']))
+        self.searcher.verify_sudo_user.assert_called_once_with('bob', 'root')
+        self.searcher.get_allowed_vpn_ips.assert_called_once_with('bob')
+
+    def test_timeout_fails_closed(self):
+        """ A slow IAM gives the least-privilege answer """
+        self.searcher.user_allowed_to_vpn.side_effect = lambda _: time.sleep(0.5)
+        self.searcher.verify_sudo_user.side_effect = lambda _a, _b: time.sleep(0.5)
+        self.searcher.get_allowed_vpn_ips.side_effect = lambda _: time.sleep(0.5)
+
+        async def _run():
+            return (await self.library.user_allowed_to_vpn('bob', timeout=0.05),
+                    await self.library.verify_sudo_user('bob', 'root', timeout=0.05),
+                    await self.library.get_allowed_vpn_ips('bob', timeout=0.05))
+        self.assertEqual(asyncio.run(_run()), (False, 'bob', []))
+
+    def test_timeout_raises_from_call(self):
+        """ call() tells you about the timeout """
+        self.searcher.get_allowed_vpn_ips.side_effect = lambda _: time.sleep(0.5)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(self.library.call('get_allowed_vpn_ips', 'bob', timeout=0.05))
+
+    def test_metrics(self):
+        """ Latency and errors are recorded per method """
+        registry = MetricsRegistry()
+        self.library.register_metrics(registry)
+        self.library.register_metrics(MetricsRegistry())
+        self.searcher.get_allowed_vpn_ips.side_effect = lambda _: time.sleep(0.5)
+
+        async def _run():
+            await self.library.user_allowed_to_vpn('bob')
+            await self.library.get_allowed_vpn_ips('bob', timeout=0.05)
+        asyncio.run(_run())
+        self.assertEqual(registry.get('iam_call_seconds').count(
+            method='user_allowed_to_vpn'), 1)
+        self.assertEqual(registry.get('iam_call_seconds').count(
+            method='get_allowed_vpn_ips'), 0)
+        self.assertEqual(registry.get('iam_call_errors_total').value(
+            method='get_allowed_vpn_ips', kind='timeout'), 1)
+
+    def test_library_errors_fail_closed(self):
+        """ Any error from the library gives the least-privilege answer """
+        self.searcher.user_allowed_to_vpn.side_effect = LDAPishError
+        self.searcher.get_allowed_vpn_acls.side_effect = LDAPishError
+
+        async def _run():
+            return (await self.library.user_allowed_to_vpn('bob'),
+                    await self.library.get_allowed_vpn_acls('bob'))
+        self.assertEqual(asyncio.run(_run()), (False, []))
+        with self.assertRaises(LDAPishError):
+            asyncio.run(self.library.call('user_allowed_to_vpn', 'bob'))
+
+    def test_reconnect_after_error(self):
+        """ A searcher that errors is rebuilt; one that's only slow is kept """
+        factory = mock.Mock(return_value=self.searcher)
+        library = AsyncIAMAdapter(max_workers=1, timeout=1, searcher_factory=factory)
+        self.searcher.get_allowed_vpn_ips.side_effect = [LDAPishError, ['10.0.0.0/8']]
+        self.searcher.user_allowed_to_vpn.side_effect = lambda _: time.sleep(0.5)
+
+        async def _run():
+            return (await library.get_allowed_vpn_ips('bob'),
+                    await library.get_allowed_vpn_ips('bob'),
+                    await library.user_allowed_to_vpn('bob', timeout=0.05),
+                    await library.get_allowed_vpn_acls('bob'))
+        self.assertEqual(asyncio.run(_run()), ([], ['10.0.0.0/8'], False, ['an-acl']))
+        self.assertEqual(factory.call_count, 2)
+        library.close()
+
+    def test_reconnect_after_breaker_trips(self):
+        """ A slow call that opens the breaker drops the searcher too """
+        factory = mock.Mock(return_value=self.searcher)
+        library = AsyncIAMAdapter(max_workers=1, timeout=1, searcher_factory=factory,
+                                  circuit_breaker=CircuitBreaker(failure_threshold=1,
+                                                                 reset_timeout=0))
+        delays = iter([0.5, 0])
+        self.searcher.user_allowed_to_vpn.side_effect = lambda _: not time.sleep(next(delays))
+
+        async def _run():
+            return (await library.user_allowed_to_vpn('bob', timeout=0.05),
+                    await library.user_allowed_to_vpn('bob'))
+        self.assertEqual(asyncio.run(_run()), (False, True))
+        self.assertEqual(factory.call_count, 2)
+        library.close()
+
+    def test_unreachable_iam(self):
+        """ Failing to build the library fails closed, and is retried """
+        library = AsyncIAMAdapter(max_workers=1, timeout=1)
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', side_effect=RuntimeError) as mock_lib:
+            self.assertFalse(asyncio.run(library.user_allowed_to_vpn('bob')))
+            self.assertEqual(asyncio.run(library.get_allowed_vpn_acls('bob')), [])
+        self.assertEqual(mock_lib.call_count, 2)
+        library.close()
+
+    def test_unknown_method(self):
+        """ We only proxy the queries we actually make """
+        with self.assertRaises(ValueError):
+            asyncio.run(self.library.call('delete_everyone'))
+
+    def test_cancellation(self):
+        """ Cancelling the caller cancels the wait """
+        self.searcher.get_allowed_vpn_ips.side_effect = lambda _: time.sleep(0.5)
+
+        async def _run():
+            task = asyncio.create_task(self.library.get_allowed_vpn_ips('bob'))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await task
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(_run())
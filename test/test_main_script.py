@@ -1,6 +1,8 @@
 """ Test suite for the openvpn_client_connect class """
 import unittest
 import os
+import json
+import tempfile
 from io import StringIO
 import test.context  # pylint: disable=unused-import
 import mock
@@ -52,7 +54,8 @@ class TestMainScript(unittest.TestCase):
                                                   username_as='username_as')
         mock_lines_dynroute.assert_called_once_with(username_is='username_is',
                                                     username_as='username_as',
-                                                    client_ip='client_ip')
+                                                    client_ip='client_ip',
+                                                    server_ip=None)
         mock_lines_statroute.assert_called_once_with()
         mock_lines_proto.assert_called_once_with()
 
@@ -121,7 +124,7 @@ class TestMainScript(unittest.TestCase):
         os.environ['username'] = 'bobby.tables'
         os.environ['trusted_ip'] = '10.20.30.40'
         os.environ['IV_VER'] = '2.4.6'
-        with mock.patch.object(self.script, 'build_lines'), \
+        with mock.patch.object(self.script, 'build_user_lines'), \
                 mock.patch.object(self.script, 'userid_allowed', return_value=False):
             result = self.script.main_work(['script', '--conf', 'test/context.py', 'outfile'])
         self.assertFalse(result, 'When user is disallowed, main_work must fail')
@@ -132,7 +135,7 @@ class TestMainScript(unittest.TestCase):
         os.environ['username'] = 'bobby.tables'
         os.environ['trusted_ip'] = '10.20.30.40'
         os.environ['IV_VER'] = '2.4.6'
-        with mock.patch.object(self.script, 'build_lines'), \
+        with mock.patch.object(self.script, 'build_user_lines'), \
                 mock.patch.object(self.script, 'userid_allowed', return_value=True):
             with mock.patch('builtins.open', side_effect=IOError):
                 result = self.script.main_work(['script', '--conf', 'test/context.py', 'outfile'])
@@ -144,7 +147,7 @@ class TestMainScript(unittest.TestCase):
         os.environ['username'] = 'bobby.tables'
         os.environ['trusted_ip'] = '10.20.30.40'
         os.environ['IV_VER'] = '2.4.6'
-        with mock.patch.object(self.script, 'build_lines') as mock_buildlines, \
+        with mock.patch.object(self.script, 'build_user_lines') as mock_buildlines, \
                 mock.patch('openvpn_client_connect.client_connect.ClientConnect') \
                         as mock_connector, \
                 mock.patch.object(self.script, 'client_version_allowed', return_value=True), \
@@ -156,7 +159,125 @@ class TestMainScript(unittest.TestCase):
         mock_buildlines.assert_called_once_with(config_object=mock_cc,
                                                 username_is='bob-device',
                                                 username_as='bobby.tables',
-                                                client_ip='10.20.30.40')
+                                                client_ip='10.20.30.40',
+                                                server_ip=None)
+        mock_cc.render_push_block.assert_called_once_with(mock_buildlines.return_value)
         file_handle = mock_open.return_value.__enter__.return_value
-        file_handle.write.assert_called_once()
+        file_handle.write.assert_called_once_with(mock_cc.render_push_block.return_value)
         self.assertTrue(result, 'With all environmental variables, main_work must work')
+
+    def test_24_output_matches_build_lines(self):
+        ''' The prerendered push file is build_lines, one line per line. '''
+        os.environ['common_name'] = 'bob-device'
+        os.environ['username'] = 'bobby.tables'
+        os.environ['trusted_ip'] = '10.20.30.40'
+        os.environ['IV_VER'] = '2.4.6'
+        conf = 'test_configs/udp4_static.conf'
+        user_lines = ['push "dhcp-option DOMAIN example.com"',
+                      'push "route 10.1.0.0 255.255.0.0"']
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(self.script, 'userid_allowed', return_value=True), \
+                mock.patch.object(self.script, 'build_user_lines', return_value=user_lines):
+            outfile = os.path.join(tmpdir, 'outfile')
+            self.assertTrue(self.script.main_work(['script', '--conf', conf, outfile]))
+            with open(outfile, 'r', encoding='utf-8') as filehandle:
+                written = filehandle.read()
+            expected = self.script.build_lines(
+                openvpn_client_connect.client_connect.ClientConnect(conf), 'bob-device',
+                'bobby.tables', '10.20.30.40')
+        self.assertEqual(written, '\n'.join(expected) + '\n')
+        self.assertIn(user_lines[1], written)
+
+    def test_24_explicit_environ(self):
+        ''' An environment handed to main_work is used instead of ours. '''
+        environ = {'common_name': 'bob-device', 'username': 'bobby.tables',
+                   'trusted_ip': '10.20.30.40', 'IV_VER': '2.4.6',
+                   'ifconfig_local': '10.50.0.1'}
+        with mock.patch.object(self.script, 'build_user_lines') as mock_buildlines, \
+                mock.patch('openvpn_client_connect.client_connect.ClientConnect') \
+                        as mock_connector, \
+                mock.patch.object(self.script, 'client_version_allowed', return_value=True), \
+                mock.patch.object(self.script, 'userid_allowed', return_value=True), \
+                mock.patch('builtins.open', create=True,
+                           return_value=mock.MagicMock(spec=StringIO())):
+            result = self.script.main_work(['script', '--conf', 'test/context.py', 'outfile'],
+                                           environ=environ)
+        self.assertTrue(result, 'With all variables in environ, main_work must work')
+        self.assertNotIn('common_name', os.environ)
+        mock_buildlines.assert_called_once_with(config_object=mock_connector.return_value,
+                                                username_is='bob-device',
+                                                username_as='bobby.tables',
+                                                client_ip='10.20.30.40',
+                                                server_ip='10.50.0.1')
+
+    def test_25_service_socket(self):
+        ''' With --service-socket, the service decides and we just write. '''
+        os.environ['common_name'] = 'bob-device'
+        os.environ['username'] = 'bobby.tables'
+        os.environ['trusted_ip'] = '10.20.30.40'
+        os.environ['IV_VER'] = '2.4.6'
+        argv = ['script', '--conf', 'test/context.py', '--service-socket', '/x.sock', 'outfile']
+        with mock.patch.object(self.script, 'service_request',
+                               return_value={'status': 'deny', 'reason': 'version'}), \
+                mock.patch.object(self.script, 'build_lines') as mock_buildlines:
+            result = self.script.main_work(argv)
+        self.assertFalse(result, 'When the service denies, main_work must fail')
+        with mock.patch.object(self.script, 'service_request', return_value=None):
+            result = self.script.main_work(argv)
+        self.assertFalse(result, 'When the service is down, main_work must fail')
+        with mock.patch.object(self.script, 'service_request',
+                               return_value={'status': 'ok', 'lines': ['a', 'b']}) as mock_sr, \
+                mock.patch('builtins.open', create=True,
+                           return_value=mock.MagicMock(spec=StringIO())) as mock_open:
+            result = self.script.main_work(argv)
+        self.assertTrue(result, 'When the service allows, main_work must work')
+        mock_buildlines.assert_not_called()
+        self.assertEqual(mock_sr.call_args[0][1]['env']['common_name'], 'bob-device')
+        self.assertEqual(mock_sr.call_args[0][1]['conf'], os.path.abspath('test/context.py'))
+        file_handle = mock_open.return_value.__enter__.return_value
+        file_handle.write.assert_called_once_with('a\nb\n')
+
+    def test_26_trace_records(self):
+        ''' With tracing on, each run appends one record. '''
+        os.environ['common_name'] = 'bob-device'
+        os.environ['username'] = 'bobby.tables'
+        os.environ['trusted_ip'] = '10.20.30.40'
+        os.environ['IV_VER'] = '2.3'
+        children = []
+        real_fork = os.fork
+
+        def _fork():
+            pid = real_fork()
+            if pid:
+                children.append(pid)
+            return pid
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trace_file = os.path.join(tmpdir, 'trace.jsonl')
+            outfile = os.path.join(tmpdir, 'outfile')
+            with mock.patch.dict(os.environ, {'OPENVPN_CLIENT_CONNECT_TRACE_FILE': trace_file}), \
+                    mock.patch.object(os, 'fork', side_effect=_fork):
+                with mock.patch.object(self.script, 'client_version_allowed',
+                                       return_value=False):
+                    self.assertFalse(self.script.main_work(
+                        ['script', '--conf', 'test/context.py', outfile]))
+                with mock.patch.object(self.script, 'service_request',
+                                       return_value={'status': 'ok',
+                                                     'lines': ['push "route 10.0.0.0"', 'b']}):
+                    self.assertTrue(self.script.main_work(
+                        ['script', '--conf', 'test/context.py', '--service-socket', '/x.sock',
+                         outfile]))
+            # The records are written by children that the script doesn't wait for:
+            for pid in children:
+                os.waitpid(pid, 0)
+            with open(trace_file, 'r', encoding='utf-8') as filehandle:
+                records = [json.loads(line) for line in filehandle]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['result'], 'rejected')
+        self.assertEqual(records[0]['reason'], 'version')
+        self.assertFalse(records[0]['iv_ver_allowed'])
+        self.assertEqual(records[0]['iv_ver'], '2.3')
+        self.assertNotIn('bob', records[0]['user'])
+        self.assertEqual(records[0]['user'], records[1]['user'])
+        self.assertEqual(records[1]['result'], 'allowed')
+        self.assertEqual(records[1]['routes'], 1)
+        self.assertEqual(records[1]['push_bytes'], 24)
@@ -0,0 +1,81 @@
+""" Test suite for the management interface client """
+import unittest
+import os
+import tempfile
+import test.context  # pylint: disable=unused-import
+from test.fake_management import FakeManagement, client_row
+from openvpn_client_connect.management import (
+    ManagementClient, ManagementError, client_ip_of)
+
+
+class TestManagementClient(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, 'management')
+        self.server = FakeManagement(self.path)
+
+    def tearDown(self):
+        """ Clean up """
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def test_client_ip_of(self):
+        """ The address comes out of every form of Real Address """
+        self.assertEqual(client_ip_of('8.7.6.5:1194'), '8.7.6.5')
+        self.assertEqual(client_ip_of('udp4:8.7.6.5:1194'), '8.7.6.5')
+        self.assertEqual(client_ip_of('tcp4-server:8.7.6.5:1194'), '8.7.6.5')
+        self.assertEqual(client_ip_of('[2001:db8::1]:1194'), '2001:db8::1')
+        self.assertEqual(client_ip_of('8.7.6.5'), '8.7.6.5')
+
+    def test_clients(self):
+        """ status 3 is read into ManagedClients """
+        self.server.clients = [client_row('bob', 'udp4:8.7.6.5:5555', 3),
+                               client_row('alice', '1.2.3.4:6666', 4, username='alice')]
+        with ManagementClient(self.path) as management:
+            clients = management.clients()
+        self.assertEqual([client.cid for client in clients], ['3', '4'])
+        self.assertEqual(clients[0].common_name, 'bob')
+        self.assertIsNone(clients[0].username)
+        self.assertEqual(clients[0].client_ip, '8.7.6.5')
+        self.assertEqual(clients[1].username, 'alice')
+        # The greeting is a notification, kept aside.
+        self.assertTrue(management.notifications[0].startswith('>INFO:'))
+
+    def test_push_update(self):
+        """ Options are sent quoted and comma-separated """
+        with ManagementClient(self.path) as management:
+            management.push_update('3', ['route 10.0.0.0 255.0.0.0',
+                                         '-route 10.1.0.0 255.255.0.0'])
+        self.assertIn('push-update-cid 3 "route 10.0.0.0 255.0.0.0, '
+                      '-route 10.1.0.0 255.255.0.0"', self.server.commands)
+        self.assertIn('>NOTIFY:info,pushed', management.notifications)
+
+    def test_errors(self):
+        """ ERROR: answers raise """
+        self.server.push_answer = lambda cid, options: 'ERROR: client not found'
+        with ManagementClient(self.path) as management:
+            with self.assertRaises(ManagementError):
+                management.push_update('99', ['route 10.0.0.0 255.0.0.0'])
+            with self.assertRaises(ManagementError):
+                management.command('frobnicate')
+
+    def test_quote(self):
+        """ Quotes and backslashes are escaped """
+        self.assertEqual(ManagementClient.quote('a "b" \\c'), '"a \\"b\\" \\\\c"')
+
+    def test_password(self):
+        """ A password is sent when asked for, and a wrong one fails """
+        self.server.close()
+        self.server = FakeManagement(self.path, password='sekrit')
+        with ManagementClient(self.path, password='sekrit') as management:
+            self.assertEqual(management.clients(), [])
+        with self.assertRaises(ManagementError):
+            ManagementClient(self.path, password='wrong').connect()
+
+    def test_no_server(self):
+        """ Nothing listening is a ManagementError """
+        with self.assertRaises(ManagementError):
+            ManagementClient(os.path.join(self.tmpdir.name, 'nothing')).connect()
@@ -0,0 +1,138 @@
+""" Test suite for answering client-connects over the management interface """
+import unittest
+import os
+import io
+import time
+import asyncio
+import tempfile
+import contextlib
+import test.context  # pylint: disable=unused-import
+from test.test_service import fake_searcher
+from test.fake_management import FakeManagement
+from openvpn_client_connect.iam_async import AsyncIAMAdapter
+from openvpn_client_connect.service import ConnectService
+from openvpn_client_connect.management_auth import ManagementAuthenticator, management_work
+
+
+def connect_event(cid, kid, **env):
+    """ The notification openvpn sends for a connecting client """
+    env.setdefault('trusted_ip', '8.7.6.5')
+    env.setdefault('IV_VER', '2.6.8')
+    return ([f'>CLIENT:CONNECT,{cid},{kid}'] +
+            [f'>CLIENT:ENV,{name}={value}' for name, value in env.items()] +
+            ['>CLIENT:ENV,END'])
+
+
+class TestManagementAuth(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.conffile = 'test_configs/udp_dynamic.conf'
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, 'management')
+        self.server = FakeManagement(self.path)
+        self.searcher = fake_searcher()
+        self.service = ConnectService(
+            self.conffile,
+            iam=AsyncIAMAdapter(max_workers=4, searcher_factory=lambda: self.searcher))
+        self.library = ManagementAuthenticator(self.service, self.path, conf_file=self.conffile)
+
+    def tearDown(self):
+        """ Clean up """
+        self.service.close()
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def serve(self, events, until):
+        """
+            Connect, send the events once we're connected, and answer
+            until until() is true (or we give up).
+        """
+        connections = self.server.connections
+
+        async def _run():
+            serving = asyncio.create_task(self.library.serve_once())
+            while self.server.connections == connections and not serving.done():
+                await asyncio.sleep(0.01)
+            await asyncio.get_running_loop().run_in_executor(None, self.server.notify, events)
+            deadline = time.monotonic() + 5
+            while not until() and time.monotonic() < deadline and not serving.done():
+                await asyncio.sleep(0.01)
+            serving.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await serving
+        asyncio.run(_run())
+
+    def test_connect_allowed(self):
+        """ An allowed client gets what the service would push """
+        self.serve(connect_event(7, 1, common_name='bob', username='bob'),
+                   lambda: '7' in self.server.auths)
+        allowed, expected = asyncio.run(self.service.handle_connect(
+            {'common_name': 'bob', 'username': 'bob', 'trusted_ip': '8.7.6.5',
+             'IV_VER': '2.6.8'}, self.conffile))
+        self.assertTrue(allowed)
+        self.assertEqual(self.server.auths['7'], expected)
+        self.assertIn('client-auth 7 1', self.server.commands)
+        self.assertEqual(self.library.stats['allowed'], 1)
+
+    def test_connect_denied(self):
+        """ A refused client is denied, with the reason """
+        self.serve(connect_event(8, 0, common_name='badguy'),
+                   lambda: '8' in self.server.denies)
+        self.assertEqual(self.server.denies['8'], 'not_allowed')
+        self.assertEqual(self.server.auths, {})
+        self.serve(connect_event(9, 0), lambda: '9' in self.server.denies)
+        self.assertEqual(self.server.denies['9'], 'missing_common_name')
+
+    def test_many_at_once(self):
+        """ Connects are worked on together, and each gets its own answer """
+        self.searcher.get_allowed_vpn_ips.side_effect = lambda user: (
+            time.sleep(0.1), ['10.0.0.0/8'])[1]
+        events = []
+        for cid in range(20):
+            events += connect_event(cid, 0, common_name=f'user{cid}')
+        started = time.monotonic()
+        self.serve(events, lambda: len(self.server.auths) == 20)
+        self.assertEqual(sorted(self.server.auths, key=int), [str(cid) for cid in range(20)])
+        # Twenty 0.1s lookups, four at a time.
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(self.server.auths['3'], self.server.auths['17'])
+
+    def test_reauth_and_other_events(self):
+        """ Renegotiations pass; other notifications are ignored """
+        events = (['>CLIENT:ESTABLISHED,4', '>CLIENT:ENV,common_name=bob', '>CLIENT:ENV,END',
+                   '>CLIENT:ADDRESS,4,10.50.0.2,1', '>BYTECOUNT_CLI:4,100,200',
+                   '>CLIENT:REAUTH,4,2', '>CLIENT:ENV,common_name=bob', '>CLIENT:ENV,END'])
+        self.serve(events, lambda: 'client-auth-nt 4 2' in self.server.commands)
+        self.assertIn('client-auth-nt 4 2', self.server.commands)
+        self.assertEqual(self.library.stats['connects'], 0)
+        self.assertEqual(self.library.stats['reauths'], 1)
+
+    def test_odd_events_and_hold(self):
+        """ Events without enough to go on are dropped; a hold is released """
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.serve(['>CLIENT:REAUTH,4,2', '>CLIENT:ENV,END', '>CLIENT:CONNECT,5',
+                        '>CLIENT:ENV,END'],
+                       lambda: self.library.stats['reauths'] == 1)
+        self.assertEqual(self.library.stats['connects'], 0)
+        self.library.hold_release = True
+        self.server.commands.clear()
+        self.serve([], lambda: 'hold release' in self.server.commands)
+        self.assertIn('hold release', self.server.commands)
+        self.assertEqual(output.getvalue(), '')
+
+    def test_password(self):
+        """ The management password is sent when asked for """
+        self.server.close()
+        self.server = FakeManagement(self.path, password='sekrit')
+        self.library.password = 'sekrit'
+        self.serve(connect_event(7, 1, common_name='bob'), lambda: '7' in self.server.auths)
+        self.assertIn('7', self.server.auths)
+
+    def test_management_work_arguments(self):
+        """ Each --conf needs its --management """
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(management_work(['x', '--conf', self.conffile,
+                                              '--conf', self.conffile,
+                                              '--management', self.path]))
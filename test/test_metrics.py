@@ -0,0 +1,80 @@
+""" Test suite for the Prometheus-format metrics """
+import unittest
+import os
+import tempfile
+import test.context  # pylint: disable=unused-import
+from openvpn_client_connect.metrics import MetricsRegistry
+
+
+class TestMetrics(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.library = MetricsRegistry(prefix='test')
+
+    def test_counter(self):
+        """ Counters add up per label set and render sorted """
+        counter = self.library.counter('things_total', 'Things', ['kind'])
+        counter.inc(kind='b')
+        counter.inc(kind='a')
+        counter.inc(2, kind='b')
+        self.assertEqual(counter.value(kind='b'), 3)
+        self.assertEqual(counter.value(kind='c'), 0)
+        self.assertEqual(self.library.render(),
+                         '# HELP test_things_total Things\n'
+                         '# TYPE test_things_total counter\n'
+                         'test_things_total{kind="a"} 1\n'
+                         'test_things_total{kind="b"} 3\n')
+        with self.assertRaises(ValueError):
+            counter.inc(flavor='a')
+
+    def test_histogram(self):
+        """ Histogram buckets are cumulative, with +Inf, sum and count """
+        histogram = self.library.histogram('size', 'Sizes', buckets=(1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(histogram.count(), 4)
+        lines = self.library.render().splitlines()
+        self.assertIn('test_size_bucket{le="1"} 2', lines)
+        self.assertIn('test_size_bucket{le="10"} 3', lines)
+        self.assertIn('test_size_bucket{le="+Inf"} 4', lines)
+        self.assertIn('test_size_sum 56.5', lines)
+        self.assertIn('test_size_count 4', lines)
+
+    def test_callback_and_escaping(self):
+        """ Callbacks are read at render time; label values are escaped """
+        values = {('say "hi"\\',): 1}
+        self.library.callback('words', 'Words', ['word'], lambda: values)
+        values[('plain',)] = 2
+        lines = self.library.render().splitlines()
+        self.assertIn('test_words{word="plain"} 2', lines)
+        self.assertIn('test_words{word="say \\"hi\\"\\\\"} 1', lines)
+        self.assertIn('# TYPE test_words gauge', lines)
+
+    def test_duplicates(self):
+        """ A name can only be registered once """
+        self.library.counter('once', 'Once')
+        with self.assertRaises(ValueError):
+            self.library.histogram('once', 'Again')
+        self.assertEqual(self.library.get('once').name, 'test_once')
+
+    def test_textfile(self):
+        """ The textfile is the rendered registry, with no temp files left """
+        self.library.counter('things_total', 'Things').inc()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'client_connect.prom')
+            self.library.write_textfile(path)
+            self.assertEqual(os.listdir(tmpdir), ['client_connect.prom'])
+            with open(path, 'r', encoding='utf-8') as filehandle:
+                self.assertEqual(filehandle.read(), self.library.render())
+
+    def test_const_labels(self):
+        """ Constant labels go on every sample, alongside any others """
+        library = MetricsRegistry(prefix='test', const_labels={'worker': '3'})
+        library.counter('things_total', 'Things', ['kind']).inc(kind='a b')
+        library.counter('plain_total', 'Plain').inc()
+        lines = library.render().splitlines()
+        self.assertIn('test_things_total{kind="a b",worker="3"} 1', lines)
+        self.assertIn('test_plain_total{worker="3"} 1', lines)
+        self.assertIn('# TYPE test_plain_total counter', lines)
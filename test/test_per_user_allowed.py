@@ -31,3 +31,17 @@ class TestUserMayVPN(unittest.TestCase):
             res = per_user_configs.user_may_vpn('bar@example.com')
         mock_library.assert_called_once_with('bar@example.com')
         self.assertTrue(res)
+
+
+class TestFailClosedValue(unittest.TestCase):
+    """ Test fail_closed_value """
+
+    def test_fail_closed_values(self):
+        """ Every IAM query has a least-privilege answer """
+        self.assertFalse(per_user_configs.fail_closed_value('user_allowed_to_vpn', 'bob'))
+        self.assertEqual(per_user_configs.fail_closed_value('verify_sudo_user', 'bob', 'root'),
+                         'bob')
+        self.assertEqual(per_user_configs.fail_closed_value('get_allowed_vpn_ips', 'bob'), [])
+        self.assertEqual(per_user_configs.fail_closed_value('get_allowed_vpn_acls', 'bob'), [])
+        with self.assertRaises(ValueError):
+            per_user_configs.fail_closed_value('something_else')
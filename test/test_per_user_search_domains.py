@@ -277,6 +277,65 @@ class TestSearchDomainsContents(unittest.TestCase):
                          ('build_search_domains must return the defaults '
                           'when we have uninteresting inputs'))
 
+    def test_index(self):
+        """
+            The group index only holds groups that add something,
+            and follows changes to dynamic_dict.
+        """
+        self.assertEqual(sorted(self.library._domain_index),
+                         ['vpn_example_dup_1', 'vpn_example_dup_2',
+                          'vpn_example_list_1', 'vpn_example_list_2',
+                          'vpn_example_string_1'])
+        self.library.dynamic_dict = {'newgroup': ['new.example.com', 7, '']}
+        self.assertEqual(self.library._domain_index, {'newgroup': ('new.example.com',)})
+        self.assertEqual(self.library.build_search_domains(['newgroup']),
+                         ['example.com', 'example.org', 'new.example.com'])
+
+    def test_many_groups(self):
+        """
+            Big group sets (as sets or lists) give the same, sorted-group-order, answer.
+        """
+        groups = [f'unrelated_group_{num}' for num in range(5000)]
+        groups += ['vpn_example_list_2', 'vpn_example_string_1', 'vpn_example_dup_2']
+        expected = ['example.com', 'example.org',
+                    'example1.example.com', 'example2.example.net']
+        self.assertEqual(self.library.build_search_domains(groups), expected)
+        self.assertEqual(self.library.build_search_domains(set(groups)), expected)
+        self.assertEqual(self.library.build_search_domains(frozenset(groups[-3:])), expected)
+
+    def test_memoized_lines(self):
+        """
+            Users with the same relevant groups share memoized push lines,
+            and changing the config throws the memo away.
+        """
+        first = self.library.get_search_domain_lines({'vpn_example_list_2', 'bob_only'})
+        second = self.library.get_search_domain_lines(['alice_only', 'vpn_example_list_2'])
+        self.assertEqual(first, ['push "dhcp-option DOMAIN example.com"',
+                                 'push "dhcp-option DOMAIN example.org"',
+                                 'push "dhcp-option DOMAIN example1.example.com"',
+                                 'push "dhcp-option DOMAIN example2.example.net"'])
+        self.assertEqual(first, second)
+        self.assertEqual(self.library.memo_stats, {'hits': 1, 'misses': 1})
+        self.assertEqual(self.library.groups_fingerprint(['b', 'a']),
+                         self.library.groups_fingerprint({'a', 'b'}))
+        self.library.search_domains = ['example.net']
+        self.assertEqual(self.library.get_search_domain_lines(['vpn_example_string_1']),
+                         ['push "dhcp-option DOMAIN example.net"',
+                          'push "dhcp-option DOMAIN example1.example.com"'])
+        self.assertEqual(self.library.memo_stats['misses'], 2)
+
+    def test_config_is_not_mutable_in_place(self):
+        """
+            Changing what the getters return can't get around the memo:
+            only assigning changes the config.
+        """
+        before = self.library.get_search_domain_lines(['vpn_example_string_1'])
+        self.library.search_domains.append('sneaky.example.com')
+        self.library.dynamic_dict['vpn_example_string_1'] = 'sneaky.example.net'
+        self.assertEqual(self.library.get_search_domain_lines(['vpn_example_string_1']), before)
+        self.assertEqual(self.library.build_search_domains(['vpn_example_string_1']),
+                         ['example.com', 'example.org', 'example1.example.com'])
+
 
 #######################################################################
 class TestSearchDomainsUser(unittest.TestCase):
@@ -0,0 +1,160 @@
+""" Test suite for the prefork worker pool """
+import unittest
+import os
+import gc
+import sys
+import time
+import signal
+import tempfile
+import subprocess
+import test.context  # pylint: disable=unused-import
+from openvpn_client_connect import per_user_configs
+from openvpn_client_connect.prefork import PreforkServer, worker_metrics_path
+from openvpn_client_connect.service_client import service_request, service_sockets
+
+
+class TestWorkerMetricsPath(unittest.TestCase):
+    """ Class of tests """
+
+    def test_worker_metrics_path(self):
+        """ Each worker gets its own textfile """
+        self.assertEqual(worker_metrics_path('/var/lib/node/cc.prom', 3),
+                         '/var/lib/node/cc.worker3.prom')
+
+
+class TestPreload(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ A config with a shared cache and a replica """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.conffile = os.path.join(self.tmpdir.name, 'prefork.conf')
+        with open('test_configs/udp_dynamic.conf', 'r', encoding='utf-8') as filehandle:
+            config = filehandle.read()
+        with open(self.conffile, 'w', encoding='utf-8') as filehandle:
+            filehandle.write(config +
+                             f'\n[shared-cache]\npath = {self.tmpdir.name}/cache\n'
+                             f'\n[acl-replica]\npath = {self.tmpdir.name}/acls.sqlite\n'
+                             'write-through = true\n')
+
+    def tearDown(self):
+        """ Put the collector back, and forget the IAM setup """
+        gc.unfreeze()
+        gc.enable()
+        per_user_configs.reset_iam()
+        self.tmpdir.cleanup()
+
+    def test_preload_leaves_nothing_open(self):
+        """ Only the configs are loaded before the fork, not IAM handles """
+        per_user_configs.configure_iam(self.conffile)
+        # pylint: disable=protected-access
+        self.assertIsNotNone(per_user_configs._SHARED_CACHE)
+        self.assertIsNotNone(per_user_configs._ACL_REPLICA)
+        server = PreforkServer(self.conffile)
+        server.preload()
+        self.assertEqual(len(server.instances), 1)
+        self.assertIsNone(per_user_configs._SHARED_CACHE)
+        self.assertIsNone(per_user_configs._ACL_REPLICA)
+        # A worker sets up its own.
+        per_user_configs.configure_iam(self.conffile)
+        self.assertIsNotNone(per_user_configs._SHARED_CACHE)
+
+
+class TestPrefork(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Write a config and start a pool of workers on it """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.socket_path = os.path.join(self.tmpdir.name, 'service.sock')
+        self.conffile = os.path.join(self.tmpdir.name, 'prefork.conf')
+        with open('test_configs/udp_dynamic.conf', 'r', encoding='utf-8') as filehandle:
+            config = filehandle.read()
+        with open(self.conffile, 'w', encoding='utf-8') as filehandle:
+            filehandle.write(config + '\n[service]\n'
+                             'max-requests = 2\n'
+                             'health-interval = 0.1\n'
+                             'health-timeout = 1.0\n'
+                             'request-timeout = 2.0\n')
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([repo_dir] + sys.path)
+        self.proc = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, '-B', '-m', 'openvpn_client_connect.service',
+             '--conf', self.conffile, '--workers', '2', '--socket', self.socket_path],
+            env=env, cwd=repo_dir, stderr=subprocess.DEVNULL)
+        self.assertTrue(self.wait_for(lambda: self.stats() is not None), 'pool never started')
+
+    def tearDown(self):
+        """ Stop the pool """
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def wait_for(check, timeout=10.0):
+        """ Poll check until it's true or we give up """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if check():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def stats(self):
+        """ Some worker's stats, or None """
+        response = service_request(self.socket_path, {'command': 'stats'}, timeout=2.0)
+        return None if response is None else response['stats']
+
+    def connect(self):
+        """ A connect that is refused before IAM would be asked """
+        return service_request(self.socket_path,
+                               {'command': 'connect', 'env': {'common_name': 'bob'}})
+
+    def worker_pids(self):
+        """ The pids of the parent's workers, from /proc """
+        with open(f'/proc/{self.proc.pid}/task/{self.proc.pid}/children',
+                  'r', encoding='utf-8') as filehandle:
+            return {int(pid) for pid in filehandle.read().split()}
+
+    def test_workers_answer(self):
+        """ Connects are served by workers, with the usual answers """
+        self.assertEqual(self.connect(), {'status': 'deny', 'reason': 'missing_trusted_ip'})
+        self.assertIn(self.stats()['worker']['slot'], (0, 1))
+        self.assertEqual(len(self.worker_pids()), 2)
+
+    def test_worker_sockets(self):
+        """ Each worker can be reached on its own socket """
+        # The pool answers once one worker is up; wait for the other.
+        self.assertTrue(self.wait_for(lambda: len(service_sockets(self.socket_path)) == 2))
+        sockets = service_sockets(self.socket_path)
+        slots = {service_request(path, {'command': 'stats'})['stats']['worker']['slot']
+                 for path in sockets}
+        self.assertEqual(slots, {0, 1})
+        for path in sockets:
+            self.assertEqual(service_request(path, {'command': 'invalidate', 'users': ['bob']}),
+                             {'status': 'ok', 'users': ['bob'], 'entries': 0})
+
+    def test_recycling(self):
+        """ Workers retire after max-requests connects, and are replaced """
+        before = self.worker_pids()
+        for _ in range(6):
+            self.assertEqual(self.connect()['status'], 'deny')
+        self.assertTrue(self.wait_for(lambda: len(self.worker_pids() - before) >= 2))
+        self.assertTrue(self.wait_for(lambda: len(self.worker_pids()) == 2))
+
+    def test_stuck_worker_is_killed(self):
+        """ A worker that stops sending heartbeats is killed and replaced """
+        stuck = min(self.worker_pids())
+        os.kill(stuck, signal.SIGSTOP)
+        self.assertTrue(self.wait_for(lambda: stuck not in self.worker_pids()))
+        self.assertTrue(self.wait_for(lambda: len(self.worker_pids()) == 2))
+        self.assertIsNotNone(self.stats())
+
+    def test_clean_shutdown(self):
+        """ SIGTERM stops the workers and the parent, and removes the socket """
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(timeout=10), 0)
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertEqual(service_sockets(self.socket_path), [self.socket_path])
@@ -0,0 +1,84 @@
+""" Test suite for opt-in connect profiling """
+import unittest
+import os
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_connect import profiling
+
+
+@profiling.profiled('unittest')
+def _some_work(value):
+    """ Something to profile """
+    return sum(range(value))
+
+
+class TestProfiling(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.spool = self.tmpdir.name
+
+    def tearDown(self):
+        """ Clean up the spool """
+        self.tmpdir.cleanup()
+
+    def _dumps(self):
+        """ What's in the spool """
+        return [name for name in os.listdir(self.spool) if name.endswith('.prof')]
+
+    def test_off_by_default(self):
+        """ Without the environment switch, nothing is written """
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(_some_work(10), 45)
+        self.assertEqual(self._dumps(), [])
+
+    def test_dump_per_call(self):
+        """ With the switch, each call leaves a dump """
+        with mock.patch.dict(os.environ, {profiling.PROFILE_DIR_ENV: self.spool}):
+            self.assertEqual(_some_work(10), 45)
+            self.assertEqual(_some_work(10), 45)
+        dumps = self._dumps()
+        self.assertEqual(len(dumps), 2)
+        for dump in dumps:
+            self.assertTrue(dump.startswith('unittest.'))
+
+    def test_sampling(self):
+        """ The rate controls how often we profile """
+        env = {profiling.PROFILE_DIR_ENV: self.spool, profiling.PROFILE_RATE_ENV: '0'}
+        with mock.patch.dict(os.environ, env):
+            _some_work(10)
+        env[profiling.PROFILE_RATE_ENV] = 'garbage'
+        with mock.patch.dict(os.environ, env):
+            _some_work(10)
+        self.assertEqual(self._dumps(), [])
+        env[profiling.PROFILE_RATE_ENV] = '0.5'
+        with mock.patch.dict(os.environ, env), \
+                mock.patch('random.random', side_effect=[0.1, 0.9]):
+            _some_work(10)
+            _some_work(10)
+        self.assertEqual(len(self._dumps()), 1)
+
+    def test_unwritable_spool(self):
+        """ A broken spool must not break the connect """
+        with mock.patch.dict(os.environ, {profiling.PROFILE_DIR_ENV: '/nonexistent/spool'}):
+            self.assertEqual(_some_work(10), 45)
+
+    def test_report(self):
+        """ The report tool merges dumps and ranks functions """
+        with mock.patch.dict(os.environ, {profiling.PROFILE_DIR_ENV: self.spool}):
+            for _ in range(3):
+                _some_work(1000)
+        with open(os.path.join(self.spool, 'junk.prof'), 'w', encoding='utf-8') as filehandle:
+            filehandle.write('not a profile')
+        output = StringIO()
+        self.assertTrue(profiling.report_work(['report', self.spool], output=output))
+        self.assertIn('Merged 3 profile dumps', output.getvalue())
+        self.assertIn('_some_work', output.getvalue())
+        output = StringIO()
+        self.assertFalse(profiling.report_work(['report', '--name', 'nope', self.spool],
+                                               output=output))
+        self.assertIn('No profile dumps found', output.getvalue())
@@ -0,0 +1,206 @@
+""" Test suite for pushing route changes to connected clients """
+import unittest
+import os
+import io
+import json
+import tempfile
+import contextlib
+import test.context  # pylint: disable=unused-import
+import mock
+from test.fake_management import FakeManagement, client_row
+from openvpn_client_connect.management import ManagementError
+from openvpn_client_connect.client_connect import ClientConnect
+from openvpn_client_connect.per_user_configs import GetUserRoutes
+from openvpn_client_connect.session_table import SessionTable
+from openvpn_client_connect.route_push import (
+    RoutePusher, route_options, chunk_options, push_work)
+
+
+class TestRoutePush(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.conffile = 'test_configs/udp_dynamic.conf'
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, 'management')
+        self.state = os.path.join(self.tmpdir.name, 'state.json')
+        self.server = FakeManagement(self.path)
+        self.server.clients = [client_row('bob', '1.2.3.4:5555', 3),
+                               client_row('alice', '1.2.3.5:5555', 4)]
+        self.acls = {'bob': ['172.16.0.0/12'], 'alice': ['192.168.1.0/24']}
+        self.searcher = mock.Mock()
+        self.searcher.verify_sudo_user.side_effect = lambda user_is, _user_as: user_is
+        self.searcher.get_allowed_vpn_ips.side_effect = lambda user: list(self.acls[user])
+        self.library = RoutePusher(self.conffile, self.path, state_file=self.state)
+
+    def tearDown(self):
+        """ Clean up """
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def run_pusher(self, pusher=None, **kwargs):
+        """ One run, with our fake IAM """
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', return_value=self.searcher):
+            return (pusher or self.library).run(**kwargs)
+
+    def pushes(self):
+        """ The push-update-cid commands the server got """
+        return [command for command in self.server.commands
+                if command.startswith('push-update-cid')]
+
+    def test_route_options(self):
+        """ Push lines become bare options """
+        self.assertEqual(route_options(['push "route 10.0.0.0 255.0.0.0"']),
+                         ['route 10.0.0.0 255.0.0.0'])
+
+    def test_chunk_options(self):
+        """ Chunks stay under the limit, and nothing is lost """
+        options = [f'route 10.{i}.0.0 255.255.0.0' for i in range(50)]
+        chunks = chunk_options(options, limit=100)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(sum(chunks, []), options)
+        for chunk in chunks:
+            self.assertLessEqual(len(', '.join(chunk)), 100)
+        self.assertEqual(chunk_options(['x' * 200], limit=100), [['x' * 200]])
+
+    def test_first_run_pushes_nothing(self):
+        """ New sessions are recorded, not pushed to """
+        stats = self.run_pusher()
+        self.assertEqual(stats['clients'], 2)
+        self.assertEqual(stats['new'], 2)
+        self.assertEqual(self.pushes(), [])
+        with open(self.state, 'r', encoding='utf-8') as filehandle:
+            state = json.load(filehandle)
+        self.assertIn('route 172.16.0.0 255.240.0.0', state['3|bob|1.2.3.4:5555']['routes'])
+
+    def test_delta_pushed(self):
+        """ Only what changed is sent, and only to who it changed for """
+        self.run_pusher()
+        self.acls['bob'] = ['192.168.0.0/16']
+        stats = self.run_pusher()
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['added'], 1)
+        self.assertEqual(stats['removed'], 1)
+        self.assertEqual(self.pushes(), [
+            'push-update-cid 3 "route 192.168.0.0 255.255.0.0"',
+            'push-update-cid 3 "-route 172.16.0.0 255.240.0.0"'])
+        # And now there's nothing more to do.
+        self.server.commands.clear()
+        self.assertEqual(self.run_pusher()['updated'], 0)
+        self.assertEqual(self.pushes(), [])
+
+    def test_seeded_from_connect(self):
+        """ A new session starts from what client-connect pushed, and gets the delta """
+        conffile = os.path.join(self.tmpdir.name, 'sessions.conf')
+        sessions_dir = os.path.join(self.tmpdir.name, 'sessions')
+        with open(self.conffile, 'r', encoding='utf-8') as filehandle:
+            config = filehandle.read()
+        with open(conffile, 'w', encoding='utf-8') as filehandle:
+            filehandle.write(config + "\n[static-mapping]\nROUTES_4 = ['10.99.0.0 255.255.0.0']\n"
+                             f'\n[session-cache]\ndirectory = {sessions_dir}\n')
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', return_value=self.searcher):
+            connect_lines = (['push "dhcp-option DNS 10.20.75.120"'] +
+                             ClientConnect.format_route_lines(GetUserRoutes(conffile)
+                                                              .build_user_routes(
+                                                                  'bob', None, '1.2.3.4')) +
+                             ['push "route 10.99.0.0 255.255.0.0"'])
+        env = {'common_name': 'bob', 'username': 'bob', 'trusted_ip': '1.2.3.4',
+               'IV_VER': '2.6.8', 'ifconfig_local': '10.50.0.1'}
+        SessionTable(sessions_dir).remember('bob-key', 'snap', connect_lines, env=env)
+        # bob's ACLs change before we first see his session.
+        self.acls['bob'] = ['192.168.0.0/16']
+        library = RoutePusher(conffile, self.path, state_file=self.state)
+        with mock.patch.object(GetUserRoutes, 'get_office_routes', autospec=True,
+                               side_effect=GetUserRoutes.get_office_routes) as office_routes:
+            stats = self.run_pusher(library)
+        self.assertEqual((stats['new'], stats['updated']), (2, 1))
+        self.assertEqual(self.pushes(), [
+            'push-update-cid 3 "route 192.168.0.0 255.255.0.0"',
+            'push-update-cid 3 "-route 172.16.0.0 255.240.0.0"'])
+        # Worked out with what client-connect had: its ifconfig_local too.
+        self.assertIn(mock.call(mock.ANY, None, '1.2.3.4', '10.50.0.1'),
+                      office_routes.call_args_list)
+        self.assertEqual(library.sessions['3|bob|1.2.3.4:5555']['env'], env)
+        self.assertNotIn('route 10.99.0.0 255.255.0.0',
+                         library.sessions['3|bob|1.2.3.4:5555']['routes'])
+
+    def test_state_survives(self):
+        """ A new pusher picks up where the last one left off """
+        self.run_pusher()
+        # Still there, as a free route.
+        self.acls['alice'] = ['10.8.0.0/16']
+        stats = self.run_pusher(RoutePusher(self.conffile, self.path, state_file=self.state))
+        self.assertEqual(stats['new'], 0)
+        self.assertEqual(stats['removed'], 1)
+        self.assertEqual(self.pushes(), ['push-update-cid 4 "-route 192.168.1.0 255.255.255.0"'])
+
+    def test_gone_sessions_dropped(self):
+        """ Disconnected sessions are forgotten """
+        self.run_pusher()
+        self.server.clients = self.server.clients[:1]
+        self.assertEqual(self.run_pusher()['gone'], 1)
+        self.assertEqual(list(self.library.sessions), ['3|bob|1.2.3.4:5555'])
+
+    def test_iam_failure_leaves_routes(self):
+        """ A made-up answer from IAM doesn't take routes away """
+        self.run_pusher()
+        self.searcher.failed_calls = 0
+
+        def failing(_user):
+            self.searcher.failed_calls += 1
+            return []
+        self.searcher.get_allowed_vpn_ips.side_effect = failing
+        stats = self.run_pusher()
+        self.assertEqual(stats['skipped'], 2)
+        self.assertEqual(self.pushes(), [])
+        self.assertIn('route 172.16.0.0 255.240.0.0',
+                      self.library.sessions['3|bob|1.2.3.4:5555']['routes'])
+
+    def test_user_filter(self):
+        """ With users given, only their known sessions are looked at """
+        self.run_pusher()
+        self.acls = {'bob': ['192.168.0.0/16'], 'alice': ['192.168.0.0/16']}
+        stats = self.run_pusher(users={'alice'})
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual([push.split()[1] for push in self.pushes()], ['4', '4'])
+
+    def test_refused_push(self):
+        """ A refused push is counted and not recorded as sent """
+        self.run_pusher()
+        self.acls['bob'] = ['192.168.0.0/16']
+        self.server.push_answer = lambda cid, options: 'ERROR: client not found'
+        stats = self.run_pusher()
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(len(self.pushes()), 1)
+        self.assertIn('route 172.16.0.0 255.240.0.0',
+                      self.library.sessions['3|bob|1.2.3.4:5555']['routes'])
+
+    def test_old_openvpn(self):
+        """ An openvpn without push-update-cid stops the run """
+        self.run_pusher()
+        self.acls['bob'] = ['192.168.0.0/16']
+        self.server.push_answer = lambda cid, options: 'ERROR: unknown command, enter help'
+        with self.assertRaises(ManagementError):
+            self.run_pusher()
+
+    def test_dry_run(self):
+        """ A dry run says what it would do and does nothing """
+        self.run_pusher()
+        self.acls['bob'] = ['192.168.0.0/16']
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.run_pusher(dry_run=True)
+        self.assertIn('would push to bob (3)', output.getvalue())
+        self.assertEqual(self.pushes(), [])
+        self.assertEqual(self.run_pusher()['updated'], 1)
+
+    def test_push_work(self):
+        """ The command line runs once and reports """
+        argv = ['openvpn-client-connect-route-push', '--conf', self.conffile,
+                '--management', self.path, '--state', self.state]
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', return_value=self.searcher), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertTrue(push_work(argv))
+        self.assertIn('new 2', output.getvalue())
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(push_work(argv[:4] + [os.path.join(self.tmpdir.name, 'nope')]))
@@ -0,0 +1,326 @@
+""" Test suite for the client-connect service """
+import unittest
+import os
+import io
+import json
+import contextlib
+import asyncio
+import tempfile
+from collections import namedtuple
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_connect.openvpn_script
+from openvpn_client_connect.client_connect import ClientConnect
+from openvpn_client_connect.iam_async import AsyncIAMAdapter
+from openvpn_client_connect.service import ConnectService, load_service_settings
+from openvpn_client_connect.service_client import service_request, invalidate_work
+from openvpn_client_connect.shared_cache import SharedCache
+from openvpn_client_connect.acl_replica import ACLReplica
+from openvpn_client_connect.session_table import SessionTable
+
+FakeACL = namedtuple('FakeACL', ['rule', 'address', 'portstring', 'description'])
+
+
+def fake_searcher():
+    """ Make a mock IAM searcher with one fairly normal user """
+    searcher = mock.Mock()
+    searcher.user_allowed_to_vpn.side_effect = lambda user: user != 'badguy'
+    searcher.verify_sudo_user.side_effect = lambda user_is, _user_as: user_is
+    searcher.get_allowed_vpn_ips.return_value = ['10.0.0.0/8', '192.168.50.0/24']
+    searcher.get_allowed_vpn_acls.return_value = [FakeACL('vpn_example', '10.0.0.0/8',
+                                                          '', '')]
+    return searcher
+
+
+class TestConnectService(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.conffile = 'test_configs/udp_dynamic.conf'
+        self.searcher = fake_searcher()
+        self.iam = AsyncIAMAdapter(max_workers=2, searcher_factory=lambda: self.searcher)
+        self.library = ConnectService(self.conffile, iam=self.iam)
+        self.env = {'common_name': 'bob', 'username': 'bob', 'trusted_ip': '8.7.6.5',
+                    'IV_VER': '2.6.8'}
+
+    def tearDown(self):
+        """ Shut down the executor """
+        self.library.close()
+
+    def test_settings_defaults(self):
+        """ A config without a [service] section gets defaults """
+        settings = load_service_settings(self.conffile)
+        self.assertEqual(settings['max-in-flight'], 32)
+        self.assertIsInstance(settings['request-timeout'], float)
+
+    def test_matches_script_output(self):
+        """ The service must push the same lines as the script would """
+        allowed, lines = asyncio.run(self.library.handle_connect(self.env))
+        self.assertTrue(allowed)
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', return_value=self.searcher):
+            expected = openvpn_client_connect.openvpn_script.build_lines(
+                ClientConnect(self.conffile), 'bob', 'bob', '8.7.6.5')
+        self.assertEqual(lines, expected)
+        self.assertIn('push "explicit-exit-notify 2"', lines)
+
+    def test_rejections(self):
+        """ Each kind of refusal comes back with a reason """
+        for missing, reason in (('common_name', 'missing_common_name'),
+                                ('trusted_ip', 'missing_trusted_ip'),
+                                ('IV_VER', 'missing_iv_ver')):
+            env = dict(self.env)
+            del env[missing]
+            self.assertEqual(asyncio.run(self.library.handle_connect(env)), (False, reason))
+        env = dict(self.env, common_name='badguy')
+        self.assertEqual(asyncio.run(self.library.handle_connect(env)),
+                         (False, 'not_allowed'))
+        with mock.patch.object(self.library.config_object, 'client_version_allowed',
+                               return_value=False):
+            self.assertEqual(asyncio.run(self.library.handle_connect(self.env)),
+                             (False, 'version'))
+
+    def test_handle_request(self):
+        """ Request dispatching """
+        res = asyncio.run(self.library.handle_request({'command': 'connect',
+                                                       'env': self.env}))
+        self.assertEqual(res['status'], 'ok')
+        res = asyncio.run(self.library.handle_request({'command': 'stats'}))
+        self.assertEqual(res['stats']['admission']['admitted'], 1)
+        res = asyncio.run(self.library.handle_request({'command': 'nope'}))
+        self.assertEqual(res, {'status': 'error', 'reason': 'unknown_command'})
+        res = asyncio.run(self.library.handle_request(['connect']))
+        self.assertEqual(res, {'status': 'error', 'reason': 'bad_request'})
+
+    def test_socket_roundtrip(self):
+        """ Talk to the service over its socket, as the script would """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, 'service.sock')
+
+            async def _run():
+                server = await self.library.start(socket_path)
+                async with server:
+                    return await asyncio.to_thread(
+                        service_request, socket_path, {'command': 'connect', 'env': self.env})
+            res = asyncio.run(_run())
+        self.assertEqual(res['status'], 'ok')
+        self.assertIn('push "route 10.0.0.0 255.0.0.0"', res['lines'])
+
+    def test_no_service(self):
+        """ If the service isn't there, the client gets None """
+        self.assertIsNone(service_request('/nonexistent/service.sock', {'command': 'stats'}))
+
+    def test_concurrent_connects_share_iam(self):
+        """ One user on several instances at once costs one set of IAM calls """
+        office_env = dict(self.env, trusted_ip='8.4.5.6')
+
+        async def _run():
+            return await asyncio.gather(self.library.handle_connect(self.env),
+                                        self.library.handle_connect(office_env),
+                                        self.library.handle_connect(self.env))
+        results = asyncio.run(_run())
+        self.assertTrue(all(allowed for allowed, _ in results))
+        self.searcher.user_allowed_to_vpn.assert_called_once_with('bob')
+        self.searcher.get_allowed_vpn_ips.assert_called_once_with('bob')
+        self.searcher.get_allowed_vpn_acls.assert_called_once_with('bob')
+        # ... but the office-specific parts still differ:
+        self.assertEqual(results[0], results[2])
+        self.assertNotEqual(results[0], results[1])
+        self.assertEqual(self.library.stats()['singleflight']['shared'], 6)
+
+    def test_metrics(self):
+        """ Connects and refusals show up in the metrics """
+        asyncio.run(self.library.handle_connect(self.env))
+        asyncio.run(self.library.handle_connect(dict(self.env, common_name='badguy')))
+        env = dict(self.env)
+        del env['IV_VER']
+        asyncio.run(self.library.handle_connect(env))
+        metrics = self.library.metrics
+        self.assertEqual(metrics.get('connects_total').value(result='allowed'), 1)
+        self.assertEqual(metrics.get('connect_rejections_total').value(reason='not_allowed'), 1)
+        self.assertEqual(metrics.get('connect_rejections_total').value(
+            reason='missing_iv_ver'), 1)
+        for phase in ('queue', 'authorize', 'profile', 'render'):
+            self.assertEqual(metrics.get('connect_phase_seconds').count(phase=phase),
+                             1 if phase in ('profile', 'render') else 2)
+        self.assertEqual(metrics.get('connect_phase_seconds').count(phase='total'), 3)
+        self.assertEqual(metrics.get('iam_call_seconds').count(method='get_allowed_vpn_acls'),
+                         1)
+        text = asyncio.run(self.library.handle_request({'command': 'metrics'}))['metrics']
+        self.assertIn('openvpn_client_connect_push_routes_count 1\n', text)
+        self.assertIn('openvpn_client_connect_cache_requests_total'
+                      '{cache="routes",result="miss"} 1\n', text)
+
+    def test_metrics_http(self):
+        """ The HTTP endpoint serves the exposition on localhost """
+        async def _fetch(path):
+            server = await self.library.start_metrics_http(port=0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(f'GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n'.encode())
+                response = await reader.read()
+                writer.close()
+                return response.decode()
+        response = asyncio.run(_fetch('/metrics'))
+        self.assertTrue(response.startswith('HTTP/1.0 200 OK'))
+        self.assertIn('# TYPE openvpn_client_connect_connects_total counter', response)
+        self.assertTrue(asyncio.run(_fetch('/')).startswith('HTTP/1.0 404'))
+
+    def test_trace_records(self):
+        """ With trace-file set, each connect leaves a record with its IAM spans """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trace_file = os.path.join(tmpdir, 'trace.jsonl')
+            settings = dict(load_service_settings(self.conffile), **{'trace-file': trace_file})
+            library = ConnectService(self.conffile, iam=AsyncIAMAdapter(
+                max_workers=2, searcher_factory=lambda: self.searcher), settings=settings)
+            asyncio.run(library.handle_connect(dict(self.env, trusted_ip='8.4.5.6')))
+            asyncio.run(library.handle_connect(dict(self.env, IV_VER='')))
+            library.close()
+            with open(trace_file, 'r', encoding='utf-8') as filehandle:
+                records = [json.loads(line) for line in filehandle]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['result'], 'allowed')
+        self.assertEqual(records[0]['office'], 'sfo1')
+        self.assertTrue(records[0]['iv_ver_allowed'])
+        self.assertEqual(sorted(span['call'] for span in records[0]['iam']),
+                         ['get_allowed_vpn_acls', 'get_allowed_vpn_ips',
+                          'user_allowed_to_vpn', 'verify_sudo_user'])
+        self.assertGreater(records[0]['routes'], 0)
+        self.assertEqual(records[1]['reason'], 'missing_iv_ver')
+
+    def test_multiple_instances(self):
+        """ One user on two instances costs one set of ACL lookups """
+        library = ConnectService([self.conffile, 'test_configs/tcp_dynamic.conf'],
+                                 iam=self.iam)
+        udp_ok, udp_lines = asyncio.run(library.handle_connect(self.env, self.conffile))
+        tcp_ok, tcp_lines = asyncio.run(library.handle_connect(
+            self.env, os.path.abspath('test_configs/tcp_dynamic.conf')))
+        self.assertTrue(udp_ok and tcp_ok)
+        self.assertIn('push "explicit-exit-notify 2"', udp_lines)
+        self.assertNotIn('push "explicit-exit-notify 2"', tcp_lines)
+        self.searcher.get_allowed_vpn_acls.assert_called_once_with('bob')
+        self.searcher.get_allowed_vpn_ips.assert_called_once_with('bob')
+        self.assertEqual(library.stats()['acl_cache']['hits'], 2)
+        self.assertEqual(len(library.stats()['instances']), 2)
+        self.assertEqual(asyncio.run(library.handle_connect(self.env, 'test_configs/empty.conf')),
+                         (False, 'unknown_conf'))
+        res = asyncio.run(library.handle_request({'command': 'connect', 'env': self.env,
+                                                  'conf': 'test_configs/tcp_dynamic.conf'}))
+        self.assertEqual(res, {'status': 'ok', 'lines': tcp_lines})
+        res = asyncio.run(library.handle_request({'command': 'connect', 'env': self.env,
+                                                  'conf': ['x']}))
+        self.assertEqual(res['reason'], 'bad_request')
+
+    def test_no_blocking_iam_connect(self):
+        """ Loading and reloading configs doesn't connect to IAM """
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_iam:
+            library = ConnectService([self.conffile, 'test_configs/tcp_dynamic.conf'],
+                                     iam=self.iam)
+            library.reload()
+            allowed, _ = asyncio.run(library.handle_connect(self.env))
+        self.assertTrue(allowed)
+        mock_iam.assert_not_called()
+        self.assertIsNone(library.get_instance().user_routes.iam_searcher)
+        self.assertIsNone(library.get_instance().user_search_domains.iam_searcher)
+
+    def test_failures_not_cached(self):
+        """ A fail-closed answer from an IAM blip isn't remembered """
+        self.searcher.get_allowed_vpn_ips.side_effect = [RuntimeError, ['10.0.0.0/8']]
+        _, first = asyncio.run(self.library.handle_connect(self.env))
+        _, second = asyncio.run(self.library.handle_connect(self.env))
+        self.assertNotIn('push "route 10.0.0.0 255.0.0.0"', first)
+        self.assertIn('push "route 10.0.0.0 255.0.0.0"', second)
+
+    def test_unexpected_errors(self):
+        """ Errors nobody planned for still get an answer, and get counted """
+        class LDAPishError(Exception):
+            """ Not a RuntimeError, not a timeout """
+        self.searcher.get_allowed_vpn_ips.side_effect = LDAPishError
+        allowed, lines = asyncio.run(self.library.handle_connect(self.env))
+        self.assertTrue(allowed)
+        self.assertNotIn('push "route 10.0.0.0 255.0.0.0"', lines)
+        with mock.patch.object(self.library.config_object, 'get_dns_server_lines',
+                               side_effect=ValueError):
+            self.assertEqual(asyncio.run(self.library.handle_connect(self.env)),
+                             (False, 'error'))
+        metrics = self.library.metrics
+        self.assertEqual(metrics.get('connects_total').value(result='allowed'), 1)
+        self.assertEqual(metrics.get('connect_rejections_total').value(reason='error'), 1)
+
+    def test_invalidate(self):
+        """ After an ACL change, the affected users are asked about again """
+        asyncio.run(self.library.handle_connect(self.env))
+        asyncio.run(self.library.handle_connect(self.env))
+        self.searcher.get_allowed_vpn_ips.assert_called_once_with('bob')
+        res = asyncio.run(self.library.handle_request({'command': 'invalidate',
+                                                       'groups': ['vpn_nobody']}))
+        self.assertEqual(res, {'status': 'ok', 'users': [], 'entries': 0})
+        res = asyncio.run(self.library.handle_request({'command': 'invalidate',
+                                                       'groups': ['vpn_example']}))
+        self.assertEqual(res, {'status': 'ok', 'users': ['bob'], 'entries': 2})
+        asyncio.run(self.library.handle_connect(self.env))
+        self.assertEqual(self.searcher.get_allowed_vpn_ips.call_count, 2)
+        res = asyncio.run(self.library.handle_request({'command': 'invalidate',
+                                                       'cidrs': ['192.168.50.7/32']}))
+        self.assertEqual(res['users'], ['bob'])
+        for request, reason in (({}, 'bad_request'), ({'users': 'bob'}, 'bad_request'),
+                                ({'cidrs': ['10.0.0.0/99']}, 'bad_cidr')):
+            res = asyncio.run(self.library.handle_request(dict(request, command='invalidate')))
+            self.assertEqual(res, {'status': 'error', 'reason': reason})
+
+    def test_invalidate_command_line(self):
+        """ The invalidate command line talks to the service's socket """
+        asyncio.run(self.library.handle_connect(self.env))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, 'service.sock')
+
+            async def _run(argv):
+                server = await self.library.start(socket_path)
+                async with server:
+                    return await asyncio.to_thread(invalidate_work, argv)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.assertTrue(asyncio.run(_run(['invalidate', '--socket', socket_path,
+                                                  '--user', 'bob'])))
+            self.assertIn('dropped 2 entries for 1 users: bob', output.getvalue())
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertFalse(asyncio.run(_run(['invalidate', '--socket', socket_path,
+                                                   '--cidr', 'nonsense'])))
+                self.assertFalse(invalidate_work(['invalidate', '--socket', socket_path,
+                                                  '--user', 'bob']))
+
+    def test_invalidate_host_stores(self):
+        """ With --conf, the host's cache, replica and sessions forget too """
+        asyncio.run(self.library.handle_connect(self.env))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, 'service.sock')
+            conffile = os.path.join(tmpdir, 'host.conf')
+            with open(conffile, 'w', encoding='utf-8') as filehandle:
+                filehandle.write(f'[service]\nsocket = {socket_path}\n'
+                                 f'[shared-cache]\npath = {tmpdir}/cache\n'
+                                 f'[acl-replica]\npath = {tmpdir}/acls.sqlite\n'
+                                 f'[session-cache]\ndirectory = {tmpdir}/sessions\n')
+            cache = SharedCache(os.path.join(tmpdir, 'cache'))
+            cache.put('iam:get_allowed_vpn_ips\x1fbob', ['10.0.0.0/8'])
+            cache.put('iam:get_allowed_vpn_ips\x1falice', ['10.0.0.0/8'])
+            replica = ACLReplica(os.path.join(tmpdir, 'acls.sqlite'))
+            replica.store_user('bob', True, ['10.0.0.0/8'], [])
+            sessions = SessionTable(os.path.join(tmpdir, 'sessions'))
+            sessions.remember('key', 'snap', ['a'], env=self.env)
+
+            async def _run(argv):
+                server = await self.library.start(socket_path)
+                async with server:
+                    return await asyncio.to_thread(invalidate_work, argv)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                # bob is only named by the service, as in the group.
+                self.assertTrue(asyncio.run(_run(['invalidate', '--conf', conffile,
+                                                  '--group', 'vpn_example'])))
+            self.assertIn('shared cache: dropped 1 entries', output.getvalue())
+            self.assertIn('acl replica: marked 1 users stale', output.getvalue())
+            self.assertIn('session table: removed 1 sessions', output.getvalue())
+            self.assertEqual(cache.get('iam:get_allowed_vpn_ips\x1fbob'), (False, None))
+            self.assertEqual(cache.get('iam:get_allowed_vpn_ips\x1falice')[0], True)
+            self.assertEqual(replica.user_ips('bob'), (False, None))
+            cache.close()
+            replica.close()
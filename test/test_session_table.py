@@ -0,0 +1,246 @@
+""" Test suite for the reconnect session table """
+import unittest
+import os
+import time
+import tempfile
+import contextlib
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_connect.openvpn_script
+import openvpn_client_connect.disconnect_script
+from openvpn_client_connect.session_table import (
+    SessionTable, session_key, config_snapshot, session_table_from_config)
+
+
+class FakeClock:
+    """ A clock that only moves when told to """
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+class TestSessionTable(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.clock = FakeClock()
+        self.library = SessionTable(os.path.join(self.tmpdir.name, 'sessions'),
+                                    window=60, max_age=600, clock=self.clock)
+        self.env = {'common_name': 'bob', 'username': 'bob', 'trusted_ip': '1.2.3.4',
+                    'IV_VER': '2.6.8'}
+
+    def tearDown(self):
+        """ Clean up """
+        self.tmpdir.cleanup()
+
+    def test_session_key(self):
+        """ The key changes with anything the push output depends on """
+        key = session_key('a.conf', self.env)
+        self.assertEqual(key, session_key('a.conf', dict(self.env)))
+        self.assertNotEqual(key, session_key('b.conf', self.env))
+        self.assertNotEqual(key, session_key('a.conf', dict(self.env, trusted_ip='1.2.3.5')))
+        self.assertNotEqual(key, session_key('a.conf', dict(self.env, IV_VER='2.6.9')))
+
+    def test_config_snapshot(self):
+        """ Editing the config changes its snapshot """
+        conf = os.path.join(self.tmpdir.name, 'a.conf')
+        with open(conf, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('[a]\n')
+        before = config_snapshot(conf)
+        with open(conf, 'a', encoding='utf-8') as filehandle:
+            filehandle.write('b = 1\n')
+        self.assertNotEqual(config_snapshot(conf), before)
+        self.assertIsNone(config_snapshot(os.path.join(self.tmpdir.name, 'missing')))
+
+    def test_reconnect_reuses(self):
+        """ Only a disconnected session, inside its window, is reused, and only once """
+        self.library.remember('k', 'snap', ['a', 'b'])
+        self.assertIsNone(self.library.reuse('k', 'snap'), 'Still connected')
+        self.assertTrue(self.library.close('k'))
+        self.clock.now += 30
+        self.assertEqual(self.library.reuse('k', 'snap'), ['a', 'b'])
+        self.assertIsNone(self.library.reuse('k', 'snap'), 'Already reused')
+        self.assertTrue(self.library.close('k'))
+        self.assertFalse(self.library.close('unknown'))
+
+    def test_release(self):
+        """ A released session can be reused again, but its window isn't restarted """
+        self.library.remember('k', 'snap', ['a'])
+        self.library.close('k')
+        self.clock.now += 30
+        self.assertEqual(self.library.reuse('k', 'snap'), ['a'])
+        self.assertTrue(self.library.release('k'))
+        self.assertFalse(self.library.release('k'))
+        self.assertEqual(self.library.reuse('k', 'snap'), ['a'])
+        self.library.release('k')
+        self.clock.now += 31
+        self.assertIsNone(self.library.reuse('k', 'snap'))
+
+    def test_no_reuse(self):
+        """ Past the window, past max_age, or under a changed config: no reuse """
+        self.library.remember('k', 'snap', ['a'])
+        self.library.close('k')
+        self.clock.now += 61
+        self.assertIsNone(self.library.reuse('k', 'snap'))
+        self.library.remember('k', 'snap', ['a'])
+        self.library.close('k')
+        self.assertIsNone(self.library.reuse('k', 'other-snap'))
+        self.library.remember('k', 'snap', ['a'])
+        self.clock.now += 601
+        self.library.close('k')
+        self.assertIsNone(self.library.reuse('k', 'snap'))
+        self.assertIsNone(self.library.reuse('k', None))
+
+    def test_connected(self):
+        """ Only connected sessions are listed, newest first, with their env """
+        self.library.remember('old', 'snap', ['a'], env=self.env)
+        self.clock.now += 1
+        self.library.remember('new', 'snap', ['b'], env=dict(self.env, ifconfig_local='10.0.0.1'))
+        self.library.remember('gone', 'snap', ['c'])
+        self.library.close('gone')
+        connected = self.library.connected()
+        self.assertEqual([entry['lines'] for entry in connected], [['b'], ['a']])
+        self.assertEqual(connected[0]['env']['ifconfig_local'], '10.0.0.1')
+
+    def test_forget(self):
+        """ A user's sessions, open or closed, can be dropped """
+        self.library.remember('bob-open', 'snap', ['a'], env=self.env)
+        self.library.remember('bob-closed', 'snap', ['a'], env=dict(self.env, IV_VER='2.6.9'))
+        self.library.close('bob-closed')
+        self.library.remember('alice', 'snap', ['a'], env=dict(self.env, common_name='alice',
+                                                               username='alice'))
+        self.assertEqual(self.library.forget(['bob']), 2)
+        self.assertEqual(os.listdir(self.library.directory), ['alice.open'])
+        self.assertEqual(self.library.forget(['nobody']), 0)
+
+    def test_prune(self):
+        """ Pruning removes expired closed sessions and very old open ones """
+        for key in ('closed-old', 'closed-new', 'open-old'):
+            self.library.remember(key, 'snap', [])
+        self.library.close('closed-old')
+        self.clock.now += 61
+        self.library.close('closed-new')
+        os.utime(os.path.join(self.library.directory, 'open-old.open'),
+                 (self.clock.now - 601, self.clock.now - 601))
+        self.assertEqual(self.library.prune(), 2)
+        self.assertEqual(sorted(os.listdir(self.library.directory)), ['closed-new.closed'])
+
+    def test_from_config(self):
+        """ The table comes from a [session-cache] section, if there is one """
+        conf = os.path.join(self.tmpdir.name, 'a.conf')
+        with open(conf, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('[session-cache]\ndirectory = /tmp/x\nwindow = 5\n')
+        table = session_table_from_config(conf)
+        self.assertEqual((table.directory, table.window, table.max_age), ('/tmp/x', 5.0, 3600.0))
+        self.assertIsNone(session_table_from_config('test_configs/empty.conf'))
+        self.assertIsNone(session_table_from_config('test/context.py'))
+
+
+class TestReconnectFastPath(unittest.TestCase):
+    """ Test the connect and disconnect scripts together """
+
+    def setUp(self):
+        """ Write out a config with a session table """
+        self.script = openvpn_client_connect.openvpn_script
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.conffile = os.path.join(self.tmpdir.name, 'session.conf')
+        with open(self.conffile, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('[session-cache]\n'
+                             f'directory = {os.path.join(self.tmpdir.name, "sessions")}\n'
+                             'window = 60\n')
+        self.outfile = os.path.join(self.tmpdir.name, 'outfile')
+        self.env = {'common_name': 'bob-device', 'username': 'bobby.tables',
+                    'trusted_ip': '10.20.30.40', 'IV_VER': '2.4.6'}
+
+    def tearDown(self):
+        """ Clean up """
+        self.tmpdir.cleanup()
+
+    def _connect(self, allowed=True):
+        """ Run client-connect; returns (result, how many times lines were built) """
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch.object(self.script, 'build_user_lines',
+                                  return_value=['push "route 10.0.0.0"']) as mock_buildlines, \
+                mock.patch('openvpn_client_connect.client_connect.ClientConnect') \
+                as mock_connector, \
+                mock.patch.object(self.script, 'client_version_allowed', return_value=True), \
+                mock.patch.object(self.script, 'userid_allowed', return_value=allowed):
+            mock_connector.return_value.render_push_block.side_effect = \
+                lambda lines: ''.join(f'{line}\n' for line in lines)
+            result = self.script.main_work(['script', '--conf', self.conffile, self.outfile])
+        return result, mock_buildlines.call_count
+
+    def _disconnect(self):
+        """ Run client-disconnect """
+        with mock.patch.dict(os.environ, self.env):
+            return openvpn_client_connect.disconnect_script.main_work(
+                ['script', '--conf', self.conffile])
+
+    def test_reconnect(self):
+        """ A reconnect after a disconnect skips the work, with the same output """
+        self.assertEqual(self._connect(), (True, 1))
+        with open(self.outfile, 'r', encoding='utf-8') as filehandle:
+            first = filehandle.read()
+        os.unlink(self.outfile)
+        self.assertEqual(self._connect(), (True, 1), 'No disconnect, no reuse')
+        self.assertTrue(self._disconnect())
+        self.assertEqual(self._connect(), (True, 0))
+        with open(self.outfile, 'r', encoding='utf-8') as filehandle:
+            self.assertEqual(filehandle.read(), first)
+        self.assertTrue(self._disconnect())
+        self.env['trusted_ip'] = '10.20.30.41'
+        self.assertEqual(self._connect(), (True, 1), 'A new address is a new session')
+
+    def test_disabled_user(self):
+        """ A user turned off since last time doesn't get their old session back """
+        self.assertEqual(self._connect(), (True, 1))
+        self.assertTrue(self._disconnect())
+        os.unlink(self.outfile)
+        self.assertEqual(self._connect(allowed=False), (False, 0))
+        self.assertFalse(os.path.exists(self.outfile))
+        # The session is still there for when they're allowed again.
+        self.assertEqual(self._connect(), (True, 0))
+
+    def test_service_miss_skips_checks(self):
+        """ With a service and nothing to reuse, only the service asks IAM """
+        argv = ['script', '--conf', self.conffile, '--service-socket', '/x.sock', self.outfile]
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch.object(self.script, 'service_request',
+                                  return_value={'status': 'ok', 'lines': ['a']}) as mock_sr, \
+                mock.patch('openvpn_client_connect.client_connect.ClientConnect') \
+                as mock_connector, \
+                mock.patch.object(self.script, 'userid_allowed') as mock_allowed:
+            self.assertTrue(self.script.main_work(argv))
+            mock_connector.assert_not_called()
+            mock_allowed.assert_not_called()
+            self.assertTrue(self._disconnect())
+            # A reused session has no service to check it, so we do:
+            mock_allowed.return_value = True
+            self.assertTrue(self.script.main_work(argv))
+        mock_sr.assert_called_once()
+        mock_allowed.assert_called_once_with(mock_connector.return_value, 'bob-device')
+
+    def test_config_change(self):
+        """ Editing the config sends reconnects down the slow path """
+        self._connect()
+        self._disconnect()
+        with open(self.conffile, 'a', encoding='utf-8') as filehandle:
+            filehandle.write('max-age = 600\n')
+        self.assertEqual(self._connect(), (True, 1))
+
+    def test_disconnect_needs_env(self):
+        """ A disconnect with no client to speak of fails """
+        self.env = {}
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertFalse(self._disconnect())
+
+    def test_disconnect_without_table(self):
+        """ With no session table, a disconnect has nothing to do """
+        with mock.patch.dict(os.environ, self.env):
+            self.assertTrue(openvpn_client_connect.disconnect_script.main_work(
+                ['script', '--conf', 'test_configs/empty.conf']))
@@ -0,0 +1,166 @@
+""" Test suite for the host-wide shared cache """
+import unittest
+import os
+import sys
+import time
+import struct
+import tempfile
+import subprocess
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_connect import per_user_configs
+from openvpn_client_connect.shared_cache import SharedCache, open_shared_cache, _key_hash
+
+
+class TestSharedCache(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, 'cache')
+        self.library = SharedCache(self.path, slots=8, slot_bytes=128, default_ttl=30)
+
+    def tearDown(self):
+        """ Clean up """
+        self.library.close()
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        """ What goes in comes out, and nothing else does """
+        self.assertEqual(self.library.get('k'), (False, None))
+        self.library.put('k', {'ips': ['10.0.0.0/8']})
+        self.assertEqual(self.library.get('k'), (True, {'ips': ['10.0.0.0/8']}))
+        self.library.put('k', [1])
+        self.assertEqual(self.library.get('k'), (True, [1]))
+        self.assertEqual(self.library.get('other'), (False, None))
+
+    def test_discard(self):
+        """ A discarded key is gone, and others stay """
+        self.library.put('k', 1)
+        self.library.put('other', 2)
+        self.assertTrue(self.library.discard('k'))
+        self.assertFalse(self.library.discard('k'))
+        self.assertEqual(self.library.get('k'), (False, None))
+        self.assertEqual(self.library.get('other'), (True, 2))
+
+    def test_size_is_capped(self):
+        """ The file never grows, and big values aren't cached """
+        size = os.path.getsize(self.path)
+        self.assertEqual(size, 64 + 8 * 128)
+        for num in range(100):
+            self.library.put(f'key{num}', num)
+        self.library.put('big', 'x' * 200)
+        self.assertEqual(self.library.get('big'), (False, None))
+        self.assertEqual(self.library.stats['too_big'], 1)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(self.library.get('key99'), (True, 99))
+
+    def test_expiry(self):
+        """ Entries go stale after their ttl """
+        self.library.put('k', 1, ttl=10)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertEqual(self.library.get('k'), (False, None))
+        self.library.put('j', 1, ttl=0)
+        self.assertEqual(self.library.get('j'), (False, None))
+
+    def test_shared_between_processes(self):
+        """ Another process's writes are visible here """
+        code = ('import sys; from openvpn_client_connect.shared_cache import SharedCache; '
+                f'SharedCache({self.path!r}).put("from-child", ["10.1.0.0/16"])')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.run([sys.executable, '-B', '-c', code], env=env, check=True)
+        self.assertEqual(self.library.get('from-child'), (True, ['10.1.0.0/16']))
+
+    def test_existing_geometry_wins(self):
+        """ A second opener with other settings adopts the file's layout """
+        other = SharedCache(self.path, slots=1000, slot_bytes=4096)
+        self.assertEqual((other.slots, other.slot_bytes), (8, 128))
+        other.put('k', 'v')
+        self.assertEqual(self.library.get('k'), (True, 'v'))
+        other.close()
+
+    def test_torn_entries_miss(self):
+        """ A slot that is mid-write (odd sequence number) reads as a miss """
+        self.library.put('k', 'v')
+        # pylint: disable=protected-access
+        for offset in self.library._slot_offsets(_key_hash('k')):
+            seq = struct.unpack_from('<I', self.library._map, offset)[0]
+            if seq:
+                struct.pack_into('<I', self.library._map, offset, seq + 1)
+        self.assertEqual(self.library.get('k'), (False, None))
+        self.assertGreater(self.library.stats['torn'], 0)
+        # The next write recovers the slot:
+        self.library.put('k', 'w')
+        self.assertEqual(self.library.get('k'), (True, 'w'))
+
+    def test_not_a_cache_file(self):
+        """ A file that isn't ours is refused, and open_shared_cache copes """
+        bogus = os.path.join(self.tmpdir.name, 'bogus')
+        with open(bogus, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('important data')
+        with self.assertRaises(ValueError):
+            SharedCache(bogus)
+        self.assertIsNone(open_shared_cache(bogus))
+        self.assertIsNone(open_shared_cache('/nonexistent/dir/cache'))
+        with open(bogus, 'r', encoding='utf-8') as filehandle:
+            self.assertEqual(filehandle.read(), 'important data')
+
+
+class TestSharedCacheIntegration(unittest.TestCase):
+    """ Test script mode's use of the shared cache """
+
+    def setUp(self):
+        """ Write out a config with a shared cache in it """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.conffile = os.path.join(self.tmpdir.name, 'shared.conf')
+        with open(self.conffile, 'w', encoding='utf-8') as filehandle:
+            filehandle.write('[shared-cache]\n'
+                             f'path = {os.path.join(self.tmpdir.name, "cache")}\n'
+                             'slots = 64\nslot-bytes = 2048\nttl = 60\n')
+        per_user_configs.configure_iam(self.conffile)
+
+    def tearDown(self):
+        """ Put the process back to talking straight to IAM """
+        per_user_configs.configure_iam('test_configs/empty.conf')
+        self.tmpdir.cleanup()
+
+    def test_second_lookup_skips_iam(self):
+        """ A later process (here: a later object) doesn't connect to IAM """
+        acl = per_user_configs.CachedACL('vpn_example', '10.0.0.0/8', '', '')
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            searcher = mock_library.return_value
+            searcher.get_allowed_vpn_ips.return_value = ['10.0.0.0/8', '192.168.50.0/24']
+            searcher.get_allowed_vpn_acls.return_value = [acl]
+            first = per_user_configs.GetUserRoutes('test_configs/get_user_routes.conf')
+            first_routes = first.build_user_routes('foo@example.com', None, None)
+            first_domains = per_user_configs.GetUserSearchDomains(
+                'test_configs/get_user_routes.conf').get_search_domains('foo@example.com')
+            self.assertEqual(mock_library.call_count, 2)
+            second = per_user_configs.GetUserRoutes('test_configs/get_user_routes.conf')
+            self.assertEqual(second.build_user_routes('foo@example.com', None, None),
+                             first_routes)
+            self.assertEqual(per_user_configs.GetUserSearchDomains(
+                'test_configs/get_user_routes.conf').get_search_domains('foo@example.com'),
+                             first_domains)
+        self.assertEqual(mock_library.call_count, 2)
+        searcher.get_allowed_vpn_ips.assert_called_once_with('foo@example.com')
+        searcher.get_allowed_vpn_acls.assert_called_once_with('foo@example.com')
+
+    def test_authorization_not_shared(self):
+        """ Every connect asks IAM whether the user may VPN """
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            mock_library.return_value.user_allowed_to_vpn.return_value = True
+            self.assertTrue(per_user_configs.user_may_vpn('foo@example.com'))
+            self.assertTrue(per_user_configs.user_may_vpn('foo@example.com'))
+        self.assertEqual(mock_library.return_value.user_allowed_to_vpn.call_count, 2)
+
+    def test_unreachable_iam_not_cached(self):
+        """ Failing to connect fails closed, and the failure isn't shared """
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', side_effect=RuntimeError):
+            gur = per_user_configs.GetUserRoutes('test_configs/get_user_routes.conf')
+            self.assertEqual(gur.build_user_routes('foo@example.com', None, None), [])
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary') as mock_library:
+            mock_library.return_value.get_allowed_vpn_ips.return_value = ['10.0.0.0/8']
+            gur = per_user_configs.GetUserRoutes('test_configs/get_user_routes.conf')
+            self.assertNotEqual(gur.build_user_routes('foo@example.com', None, None), [])
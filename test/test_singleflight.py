@@ -0,0 +1,72 @@
+""" Test suite for singleflight coalescing """
+import unittest
+import asyncio
+import test.context  # pylint: disable=unused-import
+from openvpn_client_connect.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.library = SingleFlight()
+        self.calls = []
+
+    async def _work(self, value):
+        """ Slow-ish work that records that it ran """
+        self.calls.append(value)
+        await asyncio.sleep(0.02)
+        return value * 2
+
+    def test_concurrent_calls_share(self):
+        """ Concurrent callers for one key share a single execution """
+        async def _run():
+            return await asyncio.gather(*[self.library.do('k', lambda: self._work(21))
+                                          for _ in range(5)])
+        self.assertEqual(asyncio.run(_run()), [42] * 5)
+        self.assertEqual(self.calls, [21])
+        self.assertEqual(self.library.stats, {'executed': 1, 'shared': 4})
+        self.assertEqual(len(self.library), 0)
+
+    def test_different_keys(self):
+        """ Different keys don't share """
+        async def _run():
+            return await asyncio.gather(self.library.do('a', lambda: self._work(1)),
+                                        self.library.do('b', lambda: self._work(2)))
+        self.assertEqual(asyncio.run(_run()), [2, 4])
+        self.assertEqual(sorted(self.calls), [1, 2])
+
+    def test_no_caching_afterwards(self):
+        """ Once the work is done, the next caller does it again """
+        async def _run():
+            await self.library.do('k', lambda: self._work(1))
+            await self.library.do('k', lambda: self._work(1))
+        asyncio.run(_run())
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_exceptions_shared(self):
+        """ Everyone waiting gets the failure """
+        async def _fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError('nope')
+
+        async def _run():
+            return await asyncio.gather(self.library.do('k', _fail),
+                                        self.library.do('k', _fail),
+                                        return_exceptions=True)
+        results = asyncio.run(_run())
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+
+    def test_cancelled_caller(self):
+        """ One caller giving up doesn't take the work away from others """
+        async def _run():
+            first = asyncio.create_task(self.library.do('k', lambda: self._work(5)))
+            second = asyncio.create_task(self.library.do('k', lambda: self._work(5)))
+            await asyncio.sleep(0.005)
+            first.cancel()
+            return await second
+        self.assertEqual(asyncio.run(_run()), 10)
+        self.assertEqual(self.calls, [5])
@@ -0,0 +1,36 @@
+""" Test that the per-connect entry points stay cheap to import """
+import unittest
+import os
+import sys
+import subprocess
+import test.context  # pylint: disable=unused-import
+
+# Modules that only the service, tooling, or an opt-in feature needs.
+# Pulling one of these in at import time puts its cost on every connect.
+HEAVY_MODULES = ('asyncio', 'concurrent.futures', 'cProfile', 'pstats',
+                 'sqlite3', 'numpy', 'http.server')
+ENTRY_MODULES = ('openvpn_client_connect.openvpn_script',
+                 'openvpn_client_connect.vpn_user_routes')
+
+
+class TestStartupImports(unittest.TestCase):
+    """ Class of tests """
+
+    def _imported_by(self, module):
+        """ The set of modules a fresh interpreter has after importing module """
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([repo_dir] + sys.path)
+        proc = subprocess.run([sys.executable, '-B', '-c',
+                               f'import sys, {module}; print("\\n".join(sys.modules))'],
+                              env=env, cwd=repo_dir, check=True,
+                              stdout=subprocess.PIPE, text=True)
+        return set(proc.stdout.split())
+
+    def test_no_heavy_imports(self):
+        """ The exec-per-connect scripts don't import service/tooling modules """
+        for module in ENTRY_MODULES:
+            imported = self._imported_by(module)
+            self.assertIn(module, imported)
+            for heavy in HEAVY_MODULES:
+                self.assertNotIn(heavy, imported, f'{module} imports {heavy}')
@@ -0,0 +1,134 @@
+""" Test suite for per-connect trace records """
+import unittest
+import os
+import json
+import tempfile
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_connect import tracing
+
+
+class TestTracing(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, 'trace.jsonl')
+
+    def tearDown(self):
+        """ Clean up """
+        self.tmpdir.cleanup()
+
+    def _records(self):
+        """ What's been written """
+        with open(self.path, 'r', encoding='utf-8') as filehandle:
+            return [json.loads(line) for line in filehandle]
+
+    def test_anonymize(self):
+        """ Hashes are stable, short, and depend on the salt """
+        self.assertEqual(tracing.anonymize_user('bob'), tracing.anonymize_user('bob'))
+        self.assertEqual(len(tracing.anonymize_user('bob')), 16)
+        self.assertNotEqual(tracing.anonymize_user('bob'),
+                            tracing.anonymize_user('bob', salt='pepper'))
+        self.assertIsNone(tracing.anonymize_user(None))
+
+    def test_record(self):
+        """ A trace turns into a record with what we learned """
+        trace = tracing.ConnectTrace('service')
+        trace.set(username='bob', office='sfo1', iv_ver='2.6.8', iv_ver_allowed=True)
+        with trace.span('get_allowed_vpn_ips'):
+            pass
+        with self.assertRaises(KeyError):
+            with trace.span('get_allowed_vpn_acls'):
+                raise KeyError
+        record = trace.record(True, ['push "route 10.0.0.0 255.0.0.0"', 'push "x"'])
+        self.assertEqual(record['user'], tracing.anonymize_user('bob'))
+        self.assertEqual(record['office'], 'sfo1')
+        self.assertEqual(record['result'], 'allowed')
+        self.assertEqual(record['routes'], 1)
+        self.assertEqual(record['push_bytes'], 41)
+        self.assertEqual([(span['call'], span['outcome']) for span in record['iam']],
+                         [('get_allowed_vpn_ips', 'ok'), ('get_allowed_vpn_acls', 'error')])
+        self.assertGreaterEqual(record['duration_ms'], 0)
+        rejected = tracing.ConnectTrace('script').record(False)
+        self.assertEqual(rejected['result'], 'rejected')
+        self.assertIsNone(rejected['routes'])
+
+    def test_null_trace(self):
+        """ With tracing off, everything is a cheap no-op """
+        self.assertIs(tracing.current_trace(), tracing.NULL_TRACE)
+        self.assertFalse(tracing.NULL_TRACE)
+        tracing.NULL_TRACE.set(username='bob')
+        with tracing.NULL_TRACE.span('connect'):
+            pass
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(tracing.trace_from_env('script'), (tracing.NULL_TRACE, None))
+        with mock.patch.dict(os.environ, {tracing.TRACE_FILE_ENV: self.path}):
+            trace, path = tracing.trace_from_env('script')
+        self.assertTrue(trace)
+        self.assertEqual(path, self.path)
+
+    def test_activate(self):
+        """ The current trace is scoped """
+        trace = tracing.ConnectTrace('script')
+        token = tracing.activate(trace)
+        self.assertIs(tracing.current_trace(), trace)
+        tracing.deactivate(token)
+        self.assertIs(tracing.current_trace(), tracing.NULL_TRACE)
+
+    def test_traced_searcher(self):
+        """ Only the IAM queries are timed """
+        trace = tracing.ConnectTrace('script')
+        searcher = mock.Mock()
+        searcher.get_allowed_vpn_ips.return_value = ['10.0.0.0/8']
+        traced = tracing.TracedSearcher(searcher, trace, ('get_allowed_vpn_ips',))
+        self.assertEqual(traced.get_allowed_vpn_ips('bob'), ['10.0.0.0/8'])
+        self.assertIs(traced.something_else, searcher.something_else)
+        self.assertEqual([span['call'] for span in trace.spans], ['get_allowed_vpn_ips'])
+
+    def test_append_record(self):
+        """ Script mode appends one line per record, and never raises """
+        tracing.append_record(self.path, {'a': 1})
+        tracing.append_record(self.path, {'a': 2})
+        self.assertEqual(self._records(), [{'a': 1}, {'a': 2}])
+        tracing.append_record('/nonexistent/trace.jsonl', {'a': 3})
+
+    def test_append_record_detached(self):
+        """ Detached, a child process does the write; without fork, we do """
+        children = []
+
+        def _fork():
+            pid = real_fork()
+            if pid:
+                children.append(pid)
+            return pid
+        real_fork = os.fork
+        with mock.patch.object(os, 'fork', side_effect=_fork):
+            tracing.append_record(self.path, {'a': 1}, detach=True)
+        self.assertEqual(len(children), 1)
+        _, status = os.waitpid(children[0], 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(self._records(), [{'a': 1}])
+        with mock.patch.object(os, 'fork', side_effect=OSError):
+            tracing.append_record(self.path, {'a': 2}, detach=True)
+        self.assertEqual(self._records(), [{'a': 1}, {'a': 2}])
+
+    def test_writer(self):
+        """ The writer batches records and flushes on close """
+        writer = tracing.TraceWriter(self.path, batch_size=2, flush_interval=10)
+        for num in range(5):
+            writer.submit({'num': num})
+        writer.close()
+        self.assertEqual([record['num'] for record in self._records()], list(range(5)))
+        self.assertEqual(writer.stats['written'], 5)
+
+    def test_writer_overflow(self):
+        """ A writer that can't keep up drops rather than blocks """
+        writer = tracing.TraceWriter('/nonexistent/trace.jsonl', batch_size=100,
+                                     flush_interval=10, max_pending=3)
+        for num in range(5):
+            writer.submit({'num': num})
+        writer.close()
+        self.assertEqual(writer.stats['dropped'], 2)
+        self.assertEqual(writer.stats['write_errors'], 1)